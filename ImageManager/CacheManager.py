@@ -0,0 +1,317 @@
+"""
+    Bounded on-disk LRU cache for image binaries, and in-memory cache for image metadata.
+    Entries are keyed by tenant, image id and object ETag, so a replaced binary never serves stale bytes.
+    Files are written to a temporary name and renamed into place once complete. Each process keeps
+    its own directory, as the LRU index lives in memory.
+
+    Misses are coalesced: the first request for a binary starts a single background fetch into a
+    temporary file and every concurrent request for the same binary follows that file as it grows,
+    instead of opening its own transfer from the object store.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from .conf import CONFIG
+from .Metrics import CACHE_LOOKUPS
+
+LOGGER = logging.getLogger('image-manager.' + __name__)
+
+
+class Flight(object):
+    """ A single fetch of an object into a temporary file, followed by any number of readers """
+
+    def __init__(self, path):
+        self.path = path
+        self.written = 0
+        self.done = False
+        self.error = None
+        self.cacheable = True
+        self._cond = threading.Condition()
+
+    def advance(self, size):
+        with self._cond:
+            self.written += size
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self._cond.notify_all()
+
+    def follow(self, reader, start, stop, chunk_size=None):
+        """ Yields the [start, stop) interval of the object as soon as the fetch has written it """
+        chunk_size = chunk_size or CONFIG.download_chunk_size
+        position = start
+        try:
+            reader.seek(start)
+            while position < stop:
+                with self._cond:
+                    while self.written <= position and not self.done:
+                        self._cond.wait()
+                    if self.error is not None and self.written <= position:
+                        raise IOError("fetch of %s failed: %s" % (self.path, self.error))
+                    available = min(self.written, stop)
+                if available <= position:
+                    break
+                while position < available:
+                    chunk = reader.read(min(chunk_size, available - position))
+                    position += len(chunk)
+                    yield chunk
+        finally:
+            reader.close()
+
+
+class BinaryCache(object):
+
+    def __init__(self, directory, capacity):
+        self.directory = directory
+        self.capacity = capacity
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.fetches = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    @property
+    def enabled(self):
+        return self.capacity > 0
+
+    def _workdir(self):
+        # gunicorn forks its workers after import, so the directory is resolved lazily per process
+        pid = os.getpid()
+        if self._pid != pid:
+            path = os.path.join(self.directory, str(pid))
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(path)
+            self._pid = pid
+            self._entries.clear()
+            self._flights.clear()
+            self.used = 0
+        return os.path.join(self.directory, str(pid))
+
+    def open(self, tenant, imageid, etag):
+        """ Returns an open file for the cached binary, or None on a miss """
+        if not self.enabled:
+            return None
+        with self._lock:
+            key = (tenant, imageid, etag)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                CACHE_LOOKUPS.labels('binary', 'miss').inc()
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            CACHE_LOOKUPS.labels('binary', 'hit').inc()
+            return open(entry[0], 'rb')
+
+    def follow(self, tenant, imageid, etag, start, stop, opener=None):
+        """
+            Streams [start, stop) of the binary from the fetch already in flight for it. If there is
+            none and an opener (returning the object's chunks) is given, a new fetch is started.
+            Returns None if there is nothing to follow.
+        """
+        key = (tenant, imageid, etag)
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+            elif opener is None:
+                return None
+            else:
+                fd, tmp = tempfile.mkstemp(dir=self._workdir(), suffix='.part')
+                flight = Flight(tmp)
+                self._flights[key] = flight
+                self.fetches += 1
+                fetcher = threading.Thread(target=self._fetch, args=(key, flight, fd, opener))
+                fetcher.daemon = True
+                fetcher.start()
+            reader = open(flight.path, 'rb')
+        return flight.follow(reader, start, stop)
+
+    def _fetch(self, key, flight, fd, opener):
+        error = None
+        try:
+            with os.fdopen(fd, 'wb', buffering=0) as target:
+                for chunk in opener():
+                    target.write(chunk)
+                    flight.advance(len(chunk))
+        except Exception as err:
+            LOGGER.error("failed to fetch binary %s: %s", key, err)
+            error = err
+        with self._lock:
+            self._flights.pop(key, None)
+            if error is None and flight.cacheable:
+                self._store(key, flight.path)
+            else:
+                os.unlink(flight.path)
+        flight.finish(error)
+
+    def _store(self, key, tmp):
+        """ Moves a complete download into the cache, evicting older entries as needed (lock held) """
+        size = os.path.getsize(tmp)
+        if not self.enabled or size > self.capacity or self._pid != os.getpid():
+            os.unlink(tmp)
+            return
+        path = os.path.join(self._workdir(), '%s-%s-%s' % key)
+        os.replace(tmp, path)
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.used -= previous[1]
+        self._entries[key] = (path, size)
+        self.used += size
+        while self.used > self.capacity:
+            _, (evicted, evicted_size) = self._entries.popitem(last=False)
+            self._remove(evicted, evicted_size)
+            self.evictions += 1
+
+    def _remove(self, path, size):
+        self.used -= size
+        try:
+            os.unlink(path)
+        except OSError as err:
+            LOGGER.error("failed to remove cached binary %s: %s", path, err)
+
+    def invalidate(self, tenant, imageid):
+        """ Drops every cached version of the given image """
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == tenant and k[1] == imageid]:
+                self._remove(*self._entries.pop(key))
+            for key, flight in self._flights.items():
+                if key[0] == tenant and key[1] == imageid:
+                    flight.cacheable = False
+
+    def remove_stale(self):
+        """ Removes the directories of processes that are gone (workers killed before cleaning up), returning how many """
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return 0
+        removed = 0
+        for name in names:
+            if not name.isdigit() or int(name) == os.getpid():
+                continue
+            try:
+                os.kill(int(name), 0)
+                continue
+            except ProcessLookupError:
+                pass
+            except PermissionError:
+                # alive, run by someone else
+                continue
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+            removed += 1
+        return removed
+
+    def stats(self):
+        with self._lock:
+            return {
+                'capacity': self.capacity,
+                'used': self.used,
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'fetches': self.fetches,
+                'coalesced': self.coalesced
+            }
+
+
+BINARY_CACHE = BinaryCache(CONFIG.binary_cache_dir, CONFIG.binary_cache_size)
+
+
+class MetadataCache(object):
+    """
+        Per-process LRU of immutable image metadata snapshots, keyed by tenant and image id.
+        Entries expire after ``ttl`` seconds and are dropped by ``invalidate`` when the image changes;
+        ``publishers`` are called with every invalidation so that other processes can drop their
+        copies too (see DatabaseModels.InvalidationChannel). Lookups racing with an invalidation
+        do not fill the cache.
+    """
+
+    def __init__(self, capacity, ttl):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.publishers = []
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.capacity > 0 and self.ttl > 0
+
+    def get(self, tenant, key, loader):
+        """ Returns the cached value, or the one returned by loader() which is then cached """
+        if not self.enabled:
+            return loader()
+        with self._lock:
+            entry = self._entries.get((tenant, key))
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end((tenant, key))
+                self.hits += 1
+                CACHE_LOOKUPS.labels('metadata', 'hit').inc()
+                return entry[1]
+            self.misses += 1
+            CACHE_LOOKUPS.labels('metadata', 'miss').inc()
+            generation = self._generation
+
+        value = loader()
+        with self._lock:
+            if generation == self._generation:
+                self._entries[(tenant, key)] = (time.monotonic() + self.ttl, value)
+                self._entries.move_to_end((tenant, key))
+                while len(self._entries) > self.capacity:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def invalidate(self, tenant, keys, propagate=True):
+        """ Drops the entries of the given keys, telling the publishers unless propagate is False """
+        keys = list(keys)
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._entries.pop((tenant, key), None)
+            self.invalidations += len(keys)
+        if propagate:
+            for publish in self.publishers:
+                publish(tenant, keys)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'capacity': self.capacity,
+                'ttl': self.ttl,
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+
+METADATA_CACHE = MetadataCache(CONFIG.metadata_cache_size, CONFIG.metadata_cache_ttl)
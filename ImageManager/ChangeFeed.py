@@ -0,0 +1,89 @@
+"""
+    Change feed of the images of a tenant: every image created, removed or whose binary was
+    uploaded or removed gets an entry, numbered in commit order, so clients only fetch what
+    changed since the last entry they saw (see ImageChange).
+
+    Waiting clients are woken up as soon as a change is committed by the same process, changes
+    committed by other workers are seen by looking at the feed every CONFIG.change_poll_interval
+    seconds. Connections go back to the pool while waiting.
+"""
+
+import json
+import threading
+import time
+from sqlalchemy import event
+
+from .conf import CONFIG
+from .DatabaseModels import db, TenantSession, get_changes
+from .SerializationModels import change_schema
+
+
+class ChangeNotifier(object):
+    """ Wakes up the requests of this process waiting for changes """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+
+    def notify(self):
+        with self._condition:
+            self._condition.notify_all()
+
+    def wait(self, timeout):
+        with self._condition:
+            self._condition.wait(timeout)
+
+
+CHANGE_NOTIFIER = ChangeNotifier()
+
+
+@event.listens_for(TenantSession, 'after_commit')
+def notify_changes(session):
+    if session.info.pop('image_changes', False):
+        CHANGE_NOTIFIER.notify()
+
+
+@event.listens_for(TenantSession, 'after_rollback')
+def forget_changes(session):
+    session.info.pop('image_changes', None)
+
+
+def wait_for_changes(since, limit, timeout):
+    """ Returns the changes following since, waiting up to timeout seconds for one if there are none """
+    deadline = time.monotonic() + timeout
+    while True:
+        changes = get_changes(since, limit)
+        remaining = deadline - time.monotonic()
+        if changes or remaining <= 0:
+            return changes
+        db.session.commit()
+        CHANGE_NOTIFIER.wait(min(remaining, CONFIG.change_poll_interval))
+
+
+def format_event(change):
+    return 'id: %d\nevent: %s\ndata: %s\n\n' % (change.seq, change.action,
+                                                json.dumps(change_schema.dump(change)))
+
+
+def stream_changes(since, limit, timeout, heartbeat=15):
+    """
+        Yields the changes following since as server-sent events, then those committed in the next
+        timeout seconds. Comments are sent every heartbeat seconds of silence to keep the
+        connection open; clients reconnect with a Last-Event-ID header once the stream ends.
+    """
+    deadline = time.monotonic() + timeout
+    last_sent = time.monotonic()
+    yield 'retry: %d\n\n' % int(CONFIG.change_poll_interval * 1000)
+    while time.monotonic() < deadline:
+        changes = get_changes(since, limit)
+        if changes:
+            for change in changes:
+                yield format_event(change)
+            since = changes[-1].seq
+            last_sent = time.monotonic()
+            if len(changes) == limit:
+                continue
+        elif time.monotonic() - last_sent >= heartbeat:
+            yield ': keepalive\n\n'
+            last_sent = time.monotonic()
+        db.session.commit()
+        CHANGE_NOTIFIER.wait(min(max(deadline - time.monotonic(), 0), CONFIG.change_poll_interval))
@@ -0,0 +1,93 @@
+"""
+    Streaming codecs for stored binaries.
+    Objects are compressed while they are uploaded and kept compressed in the object store; clients
+    accepting the stored encoding get the bytes as they are, the others get them decoded on the fly.
+    zstd is only available when the zstandard module is installed.
+"""
+
+import logging
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .conf import CONFIG
+
+LOGGER = logging.getLogger('image-manager.' + __name__)
+
+# zlib window bits selecting the gzip container
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def compressor(encoding):
+    """ Returns an object with compress(data) and flush() for the given encoding """
+    if encoding == 'gzip':
+        return zlib.compressobj(CONFIG.compression_level, zlib.DEFLATED, GZIP_WBITS)
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=CONFIG.compression_level).compressobj()
+    raise ValueError("Unsupported encoding: %s" % encoding)
+
+
+def decompressor(encoding):
+    """ Returns an object with decompress(data) for the given encoding """
+    if encoding == 'gzip':
+        return zlib.decompressobj(GZIP_WBITS)
+    if encoding == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError("Unsupported encoding: %s" % encoding)
+
+
+def upload_encoding():
+    """ The encoding new uploads are stored with, None to store them as they are """
+    if CONFIG.compression == 'none':
+        return None
+    if CONFIG.compression == 'zstd' and zstandard is None:
+        LOGGER.warning("zstandard is not installed, storing binaries with gzip instead")
+        return 'gzip'
+    return CONFIG.compression
+
+
+class EncodingWriter(object):
+    """ Compresses whatever is written before handing it to the given writer (see ObjectWriter) """
+
+    def __init__(self, writer, encoding):
+        self.writer = writer
+        self.encoding = encoding
+        self.size = 0
+        self._compressor = compressor(encoding)
+
+    def write(self, data):
+        self._send(self._compressor.compress(data))
+
+    def _send(self, data):
+        if data:
+            self.size += len(data)
+            self.writer.write(data)
+
+    def close(self):
+        self._send(self._compressor.flush())
+        return self.writer.close()
+
+    def abort(self):
+        self.writer.abort()
+
+
+def decode(chunks, encoding, start=0, stop=None):
+    """ Decompresses a stream of encoded chunks, yielding the [start, stop) interval of the result """
+    decoder = decompressor(encoding)
+    position = 0
+    try:
+        for chunk in chunks:
+            data = decoder.decompress(chunk)
+            end = position + len(data)
+            if end > start:
+                yield data[max(start - position, 0):None if stop is None else stop - position]
+            position = end
+            if stop is not None and position >= stop:
+                break
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
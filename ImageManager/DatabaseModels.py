@@ -1,35 +1,414 @@
+import base64
+import binascii
+from collections import namedtuple
 from datetime import datetime
+import json
+import logging
+import os
 import re
+import select
+import threading
+import time
+import uuid
 import sqlalchemy
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, orm, tuple_
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from .app import app
 from .utils import HTTPRequestError
 from .conf import CONFIG
-from sqlalchemy.exc import IntegrityError, InvalidRequestError
-from minio import Minio
+from .CacheManager import METADATA_CACHE
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import InvalidRequestError
+from .Metrics import timed
+from .StorageBackend import create_backend
+
+LOGGER = logging.getLogger('image-manager.' + __name__)
 
 app.config['SQLALCHEMY_DATABASE_URI'] = CONFIG.get_db_url()
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
 
-minioClient = Minio(CONFIG.s3url, CONFIG.s3user, CONFIG.s3pass, secure=False)
+
+class TenantSession(SignallingSession):
+    """ Session whose connections render unqualified tables inside the current tenant schema """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super(TenantSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        bind = super(TenantSession, self).get_bind(mapper, clause)
+        tenant = self.db.current_tenant()
+        if tenant is None or self.db.shared_tables:
+            return bind
+        return self.db.tenant_engine(tenant, bind)
+
+
+class TenantSQLAlchemy(SQLAlchemy):
+    """
+        Routes each tenant to its own schema through SQLAlchemy's schema translation instead of
+        switching the search_path of pooled connections, so requests issue no extra statement and
+        connections carry no tenant state between requests. Also applies the pool settings of CONFIG.
+
+        In shared tenancy mode every tenant uses the same tables instead, and queries on models with
+        a tenant column are restricted to the current tenant (see scope_to_tenant).
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.shared_tables = CONFIG.tenancy_mode == 'shared'
+        self._tenant = threading.local()
+        self._tenant_engines = {}
+        super(TenantSQLAlchemy, self).__init__(*args, **kwargs)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=TenantSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        super(TenantSQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if info.drivername.startswith('postgresql'):
+            options.update(pool_size=CONFIG.db_pool_size,
+                           max_overflow=CONFIG.db_max_overflow,
+                           pool_timeout=CONFIG.db_pool_timeout,
+                           pool_recycle=CONFIG.db_pool_recycle,
+                           pool_pre_ping=CONFIG.db_pool_pre_ping)
+
+    def bind_tenant(self, tenant):
+        """ Sets the tenant whose schema the current thread (or greenlet) works on, None for no tenant """
+        self._tenant.name = tenant
+
+    def current_tenant(self):
+        return getattr(self._tenant, 'name', None)
+
+    def tenant_engine(self, tenant, engine=None):
+        """ The engine (sharing the connection pool of the given one) bound to the tenant schema """
+        engine = engine or self.engine
+        key = (engine, tenant)
+        tenant_engine = self._tenant_engines.get(key)
+        if tenant_engine is None:
+            tenant_engine = engine.execution_options(schema_translate_map={None: tenant})
+            self._tenant_engines[key] = tenant_engine
+        return tenant_engine
+
+
+db = TenantSQLAlchemy(app)
+
+
+@app.teardown_request
+def unbind_tenant(exception=None):
+    db.bind_tenant(None)
+
+
+@event.listens_for(orm.Query, 'before_compile', retval=True)
+def scope_to_tenant(query):
+    """ Shared tenancy: restricts every query on a tenant scoped model to the current tenant """
+    tenant = db.current_tenant()
+    if not db.shared_tables or tenant is None:
+        return query
+    for description in query.column_descriptions:
+        entity = description['entity']
+        column = getattr(entity, 'tenant', None)
+        if column is not None:
+            query = query.enable_assertions(False).filter(column == tenant)
+    return query
+
+storage = create_backend()
 
 
 class Image(db.Model):
     __tablename__ = 'images'
+    __table_args__ = (
+        # keyset pagination order
+        db.Index('ix_images_created_id', 'created', 'id'),
+        # shared tenancy lookups
+        db.Index('ix_images_tenant_id', 'tenant', 'id'),
+        db.Index('ix_images_tenant_label', 'tenant', 'label'),
+    )
 
     id = db.Column(db.String(36), unique=True, nullable=False, primary_key=True)
-    label = db.Column(db.String(128), nullable=False)
+    # owner of the image, required to tell tenants apart in shared tenancy mode
+    tenant = db.Column(db.String(64), default=lambda: db.current_tenant())
+    label = db.Column(db.String(128), nullable=False, index=True)
     created = db.Column(db.DateTime, default=datetime.now)
     updated = db.Column(db.DateTime, onupdate=datetime.now)
 
-    fw_version = db.Column(db.String(128), nullable=False)
+    fw_version = db.Column(db.String(128), nullable=False, index=True)
     confirmed = db.Column(db.Boolean, default=False, nullable=False)
+    # stored binary (see Binary) the image points to, images uploaded before deduplication have none
+    blob = db.Column(db.String(36))
+    # filled in once the binary is uploaded
+    sha256 = db.Column(db.String(64))
+    size = db.Column(db.BigInteger)
+    # where the data of the compact <id>.bin object goes in the device memory, see IntelHex
+    segments = db.Column(db.JSON)
+    # content coding of the stored objects (None when kept as uploaded) and how much it saved
+    encoding = db.Column(db.String(16))
+    compressed_size = db.Column(db.BigInteger)
+    compression_ratio = db.Column(db.Float)
 
     def __repr__(self):
         return "<Image(label={}, fw_version={})>".format(self.label, self.fw_version)
 
+    def blob_name(self):
+        return self.blob or self.id
+
+    def binary_object(self, binary_format):
+        """ Name of the stored object holding the binary of the image in the given format """
+        return self.blob_name() + '.' + binary_format
+
+
+class ImageSnapshot(namedtuple('ImageSnapshot', [column.name for column in Image.__table__.columns])):
+    """ Read-only copy of an image row, safe to share between requests (see get_image_snapshot) """
+    __slots__ = ()
+
+    blob_name = Image.blob_name
+    binary_object = Image.binary_object
+
+    @classmethod
+    def of(cls, orm_image):
+        return cls(*(getattr(orm_image, name) for name in cls._fields))
+
+
+class Binary(db.Model):
+    """
+        A binary stored once per tenant whatever the number of images sharing its contents.
+        Its objects are named after ``blob``, a name unique to the upload that stored them, and are
+        removed when the last image referencing them goes away.
+    """
+    __tablename__ = 'binaries'
+
+    tenant = db.Column(db.String(64), primary_key=True, default=lambda: db.current_tenant() or '')
+    sha256 = db.Column(db.String(64), primary_key=True)
+    blob = db.Column(db.String(36), nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=1)
+    # described once, then copied to every image using the binary
+    size = db.Column(db.BigInteger)
+    segments = db.Column(db.JSON)
+    encoding = db.Column(db.String(16))
+    compressed_size = db.Column(db.BigInteger)
+    compression_ratio = db.Column(db.Float)
+
+    DESCRIPTION = ('blob', 'sha256', 'size', 'segments', 'encoding', 'compressed_size', 'compression_ratio')
+
+    def describe(self, orm_image):
+        for name in self.DESCRIPTION:
+            setattr(orm_image, name, getattr(self, name))
+
+
+class UploadSession(db.Model):
+    """ A resumable upload in progress: a multipart upload of <blob>.hex waiting for its chunks """
+    __tablename__ = 'upload_sessions'
+
+    id = db.Column(db.String(36), primary_key=True)
+    tenant = db.Column(db.String(64), default=lambda: db.current_tenant())
+    image_id = db.Column(db.String(36), nullable=False, index=True)
+    blob = db.Column(db.String(36), nullable=False)
+    upload_id = db.Column(db.String(256), nullable=False)
+    created = db.Column(db.DateTime, default=datetime.now)
+    # last chunk received, stale sessions are garbage collected
+    updated = db.Column(db.DateTime, default=datetime.now, index=True)
+
+
+class CollectionVersion(db.Model):
+    """
+        Version of the image collection of a tenant, bumped by every change to its images so that
+        listings can be validated (ETag, Last-Modified) without reading them.
+    """
+    __tablename__ = 'collection_versions'
+    # bookkeeping starting over in the shared tables, see TenancyMigration
+    __table_args__ = {'info': {'migrate': False}}
+
+    tenant = db.Column(db.String(64), primary_key=True, default=lambda: db.current_tenant() or '')
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+    updated = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+
+def touch_collection(session):
+    """
+        Bumps the collection version of the current tenant, once per session transaction. Its row
+        stays locked until the transaction ends, which orders the change feed (see record_change).
+    """
+    tenant = db.current_tenant() or ''
+    touched = session.info.setdefault('touched_collections', set())
+    if tenant in touched:
+        return
+    touched.add(tenant)
+    now = datetime.now()
+    table = CollectionVersion.__table__
+    bump = table.update().where(table.c.tenant == tenant).values(version=table.c.version + 1, updated=now)
+    if session.execute(bump, mapper=CollectionVersion.__mapper__).rowcount:
+        return
+    # the first writes of a tenant may run concurrently: whichever inserts the row first wins, the
+    # others wait for it to commit, insert nothing and bump its version
+    if session.get_bind(CollectionVersion.__mapper__).dialect.name == 'postgresql':
+        insert = postgresql.insert(table).on_conflict_do_nothing(index_elements=[table.c.tenant])
+    else:
+        insert = table.insert().prefix_with('OR IGNORE', dialect='sqlite')
+    session.execute(insert.values(tenant=tenant, version=0, updated=now), mapper=CollectionVersion.__mapper__)
+    session.execute(bump, mapper=CollectionVersion.__mapper__)
+
+
+class ImageChange(db.Model):
+    """ Entry of the change feed of a tenant, written in the transaction making the change """
+    __tablename__ = 'image_changes'
+    __table_args__ = (
+        db.Index('ix_image_changes_tenant_seq', 'tenant', 'seq'),
+        {'info': {'migrate': False}}
+    )
+
+    ACTIONS = ('created', 'uploaded', 'binary_removed', 'deleted')
+
+    seq = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    tenant = db.Column(db.String(64), default=lambda: db.current_tenant())
+    image_id = db.Column(db.String(36), nullable=False)
+    action = db.Column(db.String(16), nullable=False)
+    created = db.Column(db.DateTime, default=datetime.now)
+
+
+def record_change(session, image_id, action):
+    """
+        Appends an entry to the change feed of the current tenant, within the session transaction.
+        The collection row is locked (touch_collection) before the entry is flushed: concurrent
+        transactions get their seq one after the other, so that entries are numbered in commit order.
+    """
+    touch_collection(session)
+    session.add(ImageChange(image_id=image_id, action=action))
+    session.info['image_changes'] = True
+    session.info.setdefault('image_ids', set()).add(image_id)
+
 
+@event.listens_for(TenantSession, 'before_flush')
+def track_images(session, flush_context, instances):
+    """
+        Images added, changed or removed through the ORM bump the collection version, and those
+        created, removed or whose binary was uploaded or removed go to the change feed.
+    """
+    changed = False
+    for obj in session.new:
+        if isinstance(obj, Image):
+            record_change(session, obj.id, 'created')
+            changed = True
+    for obj in session.deleted:
+        if isinstance(obj, Image):
+            record_change(session, obj.id, 'deleted')
+            changed = True
+    for obj in session.dirty:
+        if isinstance(obj, Image) and obj not in session.deleted and session.is_modified(obj):
+            session.info.setdefault('image_ids', set()).add(obj.id)
+            if sqlalchemy.inspect(obj).attrs.confirmed.history.has_changes():
+                record_change(session, obj.id, 'uploaded' if obj.confirmed else 'binary_removed')
+            changed = True
+    if changed:
+        touch_collection(session)
+
+
+@event.listens_for(TenantSession, 'after_bulk_delete')
+def version_deleted_images(delete_context):
+    if delete_context.mapper.class_ is Image and delete_context.rowcount:
+        touch_collection(delete_context.session)
+
+
+@event.listens_for(TenantSession, 'after_commit')
+def invalidate_images(session):
+    """ Drops the cached metadata of the images changed by the transaction """
+    session.info.pop('touched_collections', None)
+    image_ids = session.info.pop('image_ids', None)
+    if image_ids:
+        METADATA_CACHE.invalidate(db.current_tenant(), image_ids)
+
+
+@event.listens_for(TenantSession, 'after_rollback')
+def forget_images(session):
+    session.info.pop('touched_collections', None)
+    session.info.pop('image_ids', None)
+
+
+class InvalidationChannel(object):
+    """
+        Relays metadata cache invalidations between processes (gunicorn workers, replicas) through
+        Postgres LISTEN/NOTIFY on the given channel. Each process listens on a dedicated connection
+        from a background thread, started on first use as workers are forked after import; the
+        whole cache is dropped whenever that connection is lost, as notifications may be missed.
+    """
+
+    # ids per notification, payloads are limited to 8000 bytes
+    BATCH = 100
+
+    def __init__(self, channel, cache):
+        self.channel = channel
+        self.cache = cache
+        self.origin = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.origin = str(uuid.uuid4())
+        listener = threading.Thread(target=self._listen)
+        listener.daemon = True
+        listener.start()
+
+    def publish(self, tenant, image_ids):
+        self.start()
+        image_ids = list(image_ids)
+        try:
+            with db.engine.connect() as connection:
+                for start in range(0, len(image_ids), self.BATCH):
+                    payload = json.dumps({'origin': self.origin, 'tenant': tenant,
+                                          'ids': image_ids[start:start + self.BATCH]})
+                    connection.execute(sqlalchemy.text("SELECT pg_notify(:channel, :payload)"),
+                                       channel=self.channel, payload=payload)
+        except Exception as err:
+            LOGGER.error("failed to publish metadata invalidation: %s", err)
+
+    def _listen(self):
+        while True:
+            connection = None
+            try:
+                connection = db.engine.raw_connection()
+                connection.connection.set_isolation_level(0)
+                connection.cursor().execute('LISTEN "%s"' % self.channel)
+                self.cache.clear()
+                while True:
+                    if select.select([connection.connection], [], [], 5) == ([], [], []):
+                        continue
+                    connection.connection.poll()
+                    while connection.connection.notifies:
+                        self._receive(connection.connection.notifies.pop(0).payload)
+            except Exception as err:
+                LOGGER.error("metadata invalidation channel lost, reconnecting: %s", err)
+                self.cache.clear()
+                time.sleep(1)
+            finally:
+                if connection is not None:
+                    connection.invalidate()
+
+    def _receive(self, payload):
+        message = json.loads(payload)
+        if message['origin'] != self.origin:
+            self.cache.invalidate(message['tenant'], message['ids'], propagate=False)
+
+
+INVALIDATION_CHANNEL = None
+if CONFIG.metadata_cache_channel and CONFIG.dbdriver.startswith('postgresql'):
+    INVALIDATION_CHANNEL = InvalidationChannel(CONFIG.metadata_cache_channel, METADATA_CACHE)
+    METADATA_CACHE.publishers.append(INVALIDATION_CHANNEL.publish)
+
+
+def get_collection_version():
+    """ Returns the (version, last modification) pair of the current tenant images, (0, None) if untouched """
+    row = db.session.query(CollectionVersion.version, CollectionVersion.updated) \
+        .filter_by(tenant=db.current_tenant() or '').first()
+    return (row.version, row.updated) if row else (0, None)
+
+
+def get_changes(since, limit):
+    """ Entries of the current tenant change feed following the given sequence number """
+    return ImageChange.query.filter(ImageChange.seq > since).order_by(ImageChange.seq).limit(limit).all()
+
+
+@timed('image_lookup')
 def assert_image_exists(image_id):
     try:
         return Image.query.filter_by(id=image_id).one()
@@ -37,6 +416,50 @@ def assert_image_exists(image_id):
         raise HTTPRequestError(404, "No such image: %s" % image_id)
 
 
+def get_image_snapshot(image_id):
+    """ Read-only metadata of the image, from the metadata cache when possible """
+    if INVALIDATION_CHANNEL is not None:
+        INVALIDATION_CHANNEL.start()
+    return METADATA_CACHE.get(db.current_tenant(), image_id,
+                              lambda: ImageSnapshot.of(assert_image_exists(image_id)))
+
+
+def assert_session_exists(image_id, session_id):
+    try:
+        return UploadSession.query.filter_by(id=session_id, image_id=image_id).one()
+    except sqlalchemy.orm.exc.NoResultFound:
+        raise HTTPRequestError(404, "No such upload session: %s" % session_id)
+
+
+def find_binary(sha256):
+    return Binary.query.filter_by(sha256=sha256).one_or_none()
+
+
+def acquire_binary(sha256):
+    """ Adds a reference to the tenant binary with the given digest and returns it, None if there is none """
+    binary = Binary.query.filter_by(sha256=sha256).with_for_update().one_or_none()
+    if binary is not None:
+        binary.refcount += 1
+    return binary
+
+
+def release_binary(orm_image):
+    """
+        Drops the reference the image holds on its binary. Returns the blob name whose objects are
+        to be removed: the binary one once unreferenced, the image one for images that predate it.
+    """
+    if orm_image.blob is None:
+        return orm_image.id
+    binary = Binary.query.filter_by(sha256=orm_image.sha256, blob=orm_image.blob).with_for_update().one_or_none()
+    if binary is None:
+        return orm_image.blob
+    binary.refcount -= 1
+    if binary.refcount > 0:
+        return None
+    db.session.delete(binary)
+    return binary.blob
+
+
 def get_all_images():
     return Image.query.all()
 
@@ -48,6 +471,44 @@ def get_all_images_filter(label):
         raise HTTPRequestError(400, 'Invalid query param supplied')
 
 
+CURSOR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(image):
+    """ Opaque pagination cursor pointing right after the given image """
+    position = '%s|%s' % (image.created.strftime(CURSOR_DATE_FORMAT), image.id)
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        created, image_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|', 1)
+        return datetime.strptime(created, CURSOR_DATE_FORMAT), image_id
+    except (ValueError, binascii.Error):
+        raise HTTPRequestError(400, 'Invalid pagination cursor')
+
+
+def get_images_page(filters, cursor=None, page_size=20, columns=None):
+    """
+        Keyset paginated listing ordered by (created, id).
+        Returns the page and the cursor of the next one (None on the last page).
+        If columns are given (they must include created and id), rows are plain tuples instead of Images.
+    """
+    try:
+        query = db.session.query(*columns) if columns else Image.query
+        query = query.filter_by(**filters)
+        if cursor:
+            created, image_id = decode_cursor(cursor)
+            query = query.filter(tuple_(Image.created, Image.id) > tuple_(created, image_id))
+        images = query.order_by(Image.created, Image.id).limit(page_size + 1).all()
+    except InvalidRequestError:
+        raise HTTPRequestError(400, 'Invalid query param supplied')
+
+    if len(images) > page_size:
+        return images[:page_size], encode_cursor(images[page_size - 1])
+    return images, None
+
+
 def handle_consistency_exception(error):
     # message = error.message.replace('\n','')
     message = re.sub(r"(^\(.*?\))|\n", "", error.message)
@@ -0,0 +1,242 @@
+"""
+    Binary patches between two images of a tenant, so devices upgrading from one to the other only
+    download what changed.
+
+    Patches are computed once, in a pool of worker processes off the request path, and kept in the
+    object store under a name derived from the SHA-256 of both images: they never go stale and are
+    shared by every pair of images with the same contents. Until a patch is ready, requests for it
+    are told to retry later. Every worker asked for a missing patch may start building it, so on
+    Postgres a build holds an advisory lock named after the patch: the workers (of every replica)
+    that cannot take it leave the build to its holder. Elsewhere builds are only deduplicated
+    within a process.
+
+    Under gunicorn's gevent workers the builder threads are greenlets, monkey patched like the rest
+    of the worker: they read both binaries from the store cooperatively, then wait on a future,
+    whose result the pool's own (patched) thread waits for with select. diff() is CPU bound and
+    would stall every request of the worker if it ran there, hence the pool, created on first use
+    in each worker, as one inherited through gunicorn's fork would not work. Its processes only run
+    diff() and never touch gevent, sockets or the database.
+
+    Patch format (integers are unsigned, big endian):
+        b'IMDELTA1', source size (8 bytes), target size (8 bytes), then instructions up to the end:
+        0x01, offset (8 bytes), length (4 bytes): copy length bytes found at offset of the source
+        0x02, length (4 bytes), data: insert the length bytes that follow
+"""
+
+import logging
+import os
+import re
+import struct
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from sqlalchemy import text
+
+from .conf import CONFIG
+from .Compression import EncodingWriter, decode, upload_encoding
+from .DatabaseModels import db
+from .StorageBackend import ObjectNotFound
+from .StorageManager import object_location
+from .UploadManager import ObjectWriter
+
+LOGGER = logging.getLogger('image-manager.' + __name__)
+
+MAGIC = b'IMDELTA1'
+HEADER = struct.Struct('>8sQQ')
+COPY = struct.Struct('>BQI')
+INSERT = struct.Struct('>BI')
+BLOCK_SIZE = 32
+MAX_INSERT = 2 ** 32 - 1
+# user metadata holding the size of a (compressed) patch once decoded
+DECODED_SIZE = 'X-Amz-Meta-Decoded-Size'
+# delta/<source>-<target>.<format>, each image named by its sha256 or, lacking one, its id
+PATCH_NAME = re.compile(r'^delta/([0-9a-f]{64}|[0-9a-f-]{36})-([0-9a-f]{64}|[0-9a-f-]{36})\.[a-z]+$')
+# class of the Postgres advisory locks held while building a patch, the other key hashing its name
+LOCK_CLASS = 0x494d444c
+
+
+def matching_length(source, source_start, target, target_start, step=4096):
+    """ Number of equal bytes from source[source_start:] and target[target_start:] on """
+    length = 0
+    limit = min(len(source) - source_start, len(target) - target_start)
+    while step:
+        while length + step <= limit and \
+                source[source_start + length:source_start + length + step] == \
+                target[target_start + length:target_start + length + step]:
+            length += step
+        step //= 8
+    return length
+
+
+def diff(source, target, block_size=BLOCK_SIZE):
+    """ Returns a patch turning source into target (see module documentation for its format) """
+    index = {}
+    for offset in range(0, len(source) - block_size + 1, block_size):
+        index.setdefault(source[offset:offset + block_size], offset)
+
+    patch = bytearray(HEADER.pack(MAGIC, len(source), len(target)))
+
+    def insert(start, stop):
+        for chunk in range(start, stop, MAX_INSERT):
+            data = target[chunk:min(stop, chunk + MAX_INSERT)]
+            patch.extend(INSERT.pack(2, len(data)))
+            patch.extend(data)
+
+    literal = position = 0
+    last = len(target) - block_size
+    while position <= last:
+        offset = index.get(target[position:position + block_size])
+        if offset is None:
+            position += 1
+            continue
+        length = block_size + matching_length(source, offset + block_size, target, position + block_size)
+        while position > literal and offset > 0 and source[offset - 1] == target[position - 1]:
+            position, offset, length = position - 1, offset - 1, length + 1
+        insert(literal, position)
+        while length:
+            run = min(length, MAX_INSERT)
+            patch.extend(COPY.pack(1, offset, run))
+            position, offset, length = position + run, offset + run, length - run
+        literal = position
+    insert(literal, len(target))
+    return bytes(patch)
+
+
+def read_binary(storage, tenant, object_name, encoding):
+    chunks = storage.stream(*object_location(tenant, object_name))
+    if encoding is not None:
+        chunks = decode(chunks, encoding)
+    return b''.join(chunks)
+
+
+def patch_name(source, target, binary_format):
+    """ Object holding the patch between two images, named after their contents """
+    return 'delta/%s-%s.%s' % (source.sha256 or source.id, target.sha256 or target.id, binary_format)
+
+
+def patch_images(name):
+    """ The (source, target) pair of sha256 digests or image ids a patch_name was built from, None if it is not one """
+    match = PATCH_NAME.match(name)
+    return match.groups() if match else None
+
+
+def object_header(stat, name):
+    """ Looks up a header stored with the object (the store does not normalize their case) """
+    for key, value in stat.metadata.items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+
+def decoded_size(stat):
+    size = object_header(stat, DECODED_SIZE)
+    return int(size) if size is not None else None
+
+
+def is_stored(storage, tenant, name):
+    try:
+        storage.stat(*object_location(tenant, name))
+    except ObjectNotFound:
+        return False
+    return True
+
+
+@contextmanager
+def build_lock(tenant, name):
+    """ Tells whether this process may build the patch, holding a Postgres advisory lock meanwhile """
+    if db.engine.dialect.name != 'postgresql':
+        yield True
+        return
+    connection = db.engine.connect()
+    try:
+        key = '%s/%s' % (tenant, name)
+        acquired = connection.execute(text("SELECT pg_try_advisory_lock(:class, hashtext(:key))"),
+                                      {'class': LOCK_CLASS, 'key': key}).scalar()
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                connection.execute(text("SELECT pg_advisory_unlock(:class, hashtext(:key))"),
+                                   {'class': LOCK_CLASS, 'key': key})
+    finally:
+        connection.close()
+
+
+class DeltaBuilder(object):
+    """ Computes patches in the background, at most once at a time for a given patch (see build_lock) """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.builds = 0
+        self.failures = 0
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    def _executor(self):
+        # the pool cannot be shared with the processes gunicorn forks after import
+        if self._pid != os.getpid():
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            self._pid = os.getpid()
+        return self._pool
+
+    def request(self, storage, tenant, name, source, target):
+        """
+            Starts building the named patch unless it is already being built.
+            source and target are (object name, encoding) pairs of the stored binaries.
+        """
+        key = (tenant, name)
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        builder = threading.Thread(target=self._build, args=(key, storage, source, target))
+        builder.daemon = True
+        builder.start()
+
+    def _build(self, key, storage, source, target):
+        tenant, name = key
+        try:
+            with build_lock(tenant, name) as acquired:
+                if not acquired:
+                    LOGGER.debug("%s for %s is being built by another worker", name, tenant)
+                    return
+                if is_stored(storage, tenant, name):
+                    # by another worker since it was requested
+                    return
+                self._write(storage, tenant, name, source, target)
+        except Exception as err:
+            LOGGER.error("failed to build %s for %s: %s", name, tenant, err)
+            self.failures += 1
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def _write(self, storage, tenant, name, source, target):
+        writer = None
+        try:
+            source_data = read_binary(storage, tenant, *source)
+            target_data = read_binary(storage, tenant, *target)
+            patch = self._executor().submit(diff, source_data, target_data).result()
+
+            encoding = upload_encoding()
+            bucket, object_key = object_location(tenant, name)
+            metadata = {DECODED_SIZE: str(len(patch))}
+            if encoding is not None:
+                metadata['Content-Encoding'] = encoding
+            writer = ObjectWriter(storage, bucket, object_key, metadata=metadata)
+            if encoding is not None:
+                writer = EncodingWriter(writer, encoding)
+            writer.write(patch)
+            writer.close()
+            LOGGER.info("built %s for %s: %d bytes for a %d bytes target", name, tenant,
+                        len(patch), len(target_data))
+            self.builds += 1
+        except Exception:
+            if writer is not None:
+                writer.abort()
+            raise
+
+
+DELTA_BUILDER = DeltaBuilder(CONFIG.delta_workers)
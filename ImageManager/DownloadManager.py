@@ -0,0 +1,160 @@
+"""
+    Streams stored binaries straight from the object store to the client.
+    Supports single byte ranges (206) and conditional requests (ETag / Last-Modified)
+    so devices can resume interrupted transfers and skip images they already have.
+    Compressed objects are served as stored to clients accepting their encoding, decoded otherwise.
+    Whole objects of a filesystem storage backend are handed to the WSGI server as files, which it
+    may send with sendfile.
+"""
+
+import base64
+import logging
+from flask import Response
+from werkzeug.wsgi import wrap_file
+
+from .conf import CONFIG
+from .CacheManager import BINARY_CACHE
+from .Compression import decode
+from .Metrics import DOWNLOADED_BYTES, count_bytes
+from .StorageBackend import ObjectNotFound, StorageError, iter_file
+from .StorageManager import object_location
+from .utils import HTTPRequestError
+
+LOGGER = logging.getLogger('image-manager.' + __name__)
+
+
+def stat_binary(storage, tenant, object_name):
+    try:
+        return storage.stat(*object_location(tenant, object_name))
+    except ObjectNotFound:
+        raise HTTPRequestError(404, "Image does not have an binary file")
+    except StorageError as err:
+        LOGGER.error(err.message)
+        raise HTTPRequestError(404, "Image does not have an binary file")
+
+
+def open_binary(storage, tenant, imageid, object_name, etag, start, stop, size):
+    """
+        Returns an iterator over the [start, stop) bytes of the object, from the local cache when possible,
+        along with the X-Cache header value (None for local files, which are not cached).
+        Concurrent misses share a single fetch of the whole object, which also fills the cache;
+        ranged misses with no fetch to join go straight to the store.
+    """
+    bucket, key = object_location(tenant, object_name)
+    if storage.local:
+        return iter_file(storage.open(bucket, key), start, stop), None
+
+    cached = BINARY_CACHE.open(tenant, imageid, etag)
+    if cached is not None:
+        return iter_file(cached, start, stop), 'HIT'
+
+    def fetch():
+        return storage.stream(bucket, key)
+
+    # only a whole object download starts a fetch others may join
+    opener = fetch if start == 0 and stop == size else None
+    body = BINARY_CACHE.follow(tenant, imageid, etag, start, stop, opener)
+    if body is None:
+        body = storage.stream(bucket, key, start, stop - start)
+    return body, 'MISS'
+
+
+def is_not_modified(request, etag, last_modified):
+    """ Evaluates If-None-Match (preferred) and If-Modified-Since against the stored object """
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since and last_modified:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def requested_range(request, etag, size):
+    """
+        Returns the (start, stop) byte interval asked by the client, or None for the whole object.
+        Multi-range requests and stale If-Range validators fall back to the whole object.
+
+        :raises HTTPRequestError: (416) if the range cannot be satisfied
+    """
+    if request.range is None or len(request.range.ranges) != 1:
+        return None
+    if request.if_range.etag and request.if_range.etag != etag:
+        return None
+    interval = request.range.range_for_length(size)
+    if interval is None:
+        raise HTTPRequestError(416, "Requested range not satisfiable")
+    return interval
+
+
+def accepts_encoding(request, encoding):
+    return request.accept_encodings.quality(encoding) > 0
+
+
+def stream_binary(request, storage, tenant, imageid, object_name, sha256=None, encoding=None, size=None,
+                  stat=None):
+    """
+        Builds a streamed response for the given object, honoring Range and conditional headers.
+        If the SHA-256 recorded at upload time is given, full responses carry it in a Digest header.
+
+        Objects stored with a content coding (encoding) are sent as they are to clients accepting
+        it; the others get them decoded on the fly, size being the decoded size of the object.
+        Both representations have their own ETag, and ranges apply to the one being sent.
+        The object stat may be given if the caller already holds it.
+    """
+    stat = stat or stat_binary(storage, tenant, object_name)
+    # werkzeug compares naive UTC datetimes
+    last_modified = stat.last_modified.replace(tzinfo=None) if stat.last_modified else None
+
+    headers = {'Accept-Ranges': 'bytes'}
+    decoding = encoding is not None and not accepts_encoding(request, encoding)
+    if encoding is not None:
+        headers['Vary'] = 'Accept-Encoding'
+    if decoding:
+        etag, length = stat.etag + '-identity', size
+    else:
+        etag, length = stat.etag, stat.size
+
+    if is_not_modified(request, etag, last_modified):
+        response = Response(status=304, headers=headers)
+    else:
+        try:
+            interval = requested_range(request, etag, length)
+        except HTTPRequestError:
+            headers['Content-Range'] = 'bytes */%d' % length
+            return Response(status=416, headers=headers)
+
+        if encoding is not None and not decoding:
+            headers['Content-Encoding'] = encoding
+        if interval is None:
+            start, stop, status = 0, length, 200
+            if sha256 and 'Content-Encoding' not in headers:
+                headers['Digest'] = 'SHA-256=' + base64.b64encode(bytes.fromhex(sha256)).decode()
+        else:
+            start, stop = interval
+            status = 206
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, length)
+        headers['Content-Length'] = str(stop - start)
+
+        body = ()
+        cache = None
+        if request.method != 'HEAD' and stop > start:
+            if decoding:
+                # the stored object is decoded from its first byte whatever the range asked
+                chunks, cache = open_binary(storage, tenant, imageid, object_name, stat.etag, 0, stat.size, stat.size)
+                body = count_bytes(decode(chunks, encoding, start, stop), DOWNLOADED_BYTES)
+            elif storage.local and interval is None:
+                # the server may send the file with sendfile, past the byte counter
+                DOWNLOADED_BYTES.inc(length)
+                body = wrap_file(request.environ, storage.open(*object_location(tenant, object_name)),
+                                 CONFIG.download_chunk_size)
+            else:
+                chunks, cache = open_binary(storage, tenant, imageid, object_name, stat.etag, start, stop, stat.size)
+                body = count_bytes(chunks, DOWNLOADED_BYTES)
+        if cache is not None:
+            headers['X-Cache'] = cache
+        response = Response(body, status=status, headers=headers, mimetype='application/octet-stream',
+                            direct_passthrough=True)
+
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    return response
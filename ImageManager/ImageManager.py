@@ -1,40 +1,196 @@
 """
     Handles CRUD operations for firmware binary images
     Each image consists of an metadata entry and optionally an binary file
-    Binary files are stored temporarily at /tmp/. This implementation assumes /tmp/ is cleaned on a regular basis
-    and no effort to remove temporary files are made.
+    Binary files are streamed to and from the object store, no temporary copies are kept on disk.
 """
 
+import hashlib
 import json
 import logging
-import os
 import uuid
+from datetime import datetime, timezone
+from urllib.parse import urlencode
 from flask import request
-from flask import send_from_directory
 from flask import Blueprint
 from flask import jsonify
-from minio.error import ResponseError
+from flask import Response
+from flask import stream_with_context
+from sqlalchemy.exc import IntegrityError
 
 from .utils import *
 from .DatabaseModels import *
 from .SerializationModels import *
 from .TenancyManager import init_tenant_context
+from .conf import CONFIG
+from .DownloadManager import stat_binary, stream_binary, is_not_modified
+from .CacheManager import BINARY_CACHE, METADATA_CACHE
+from .StorageBackend import ObjectNotFound, StorageError
+from .StorageManager import object_location, tenant_prefix, list_objects_page
+from .UploadManager import BinaryUpload, process_stored, requested_digest
+from .Compression import upload_encoding
+from .DeltaManager import DELTA_BUILDER, patch_name, decoded_size, object_header
+from .PresignManager import presigned_download, presigned_put
+from .Metrics import UPLOADED_BYTES
+from .ChangeFeed import wait_for_changes, stream_changes
+from .ResumableUpload import start_upload, put_chunk, received_chunks, complete_upload, abort_upload, \
+    purge_stale_sessions
 from .app import app
 
 image = Blueprint('image', __name__)
 
 LOGGER = logging.getLogger('image-manager.' + __name__)
-LOGGER.addHandler(logging.StreamHandler())
-LOGGER.setLevel(logging.DEBUG)
+
+# the uploaded Intel HEX file, and the compact binary decoded from it
+BINARY_FORMATS = ('hex', 'bin')
+
+
+def remove_blob(tenant, blob):
+    """ Removes the objects stored under the given blob name """
+    remove_blobs(tenant, [blob])
+
+
+def remove_blobs(tenant, blobs):
+    """ Removes the objects stored under the given blob names with batched delete requests """
+    keys = {}
+    for blob in blobs:
+        for binary_format in BINARY_FORMATS:
+            bucket, key = object_location(tenant, blob + '.' + binary_format)
+            keys.setdefault(bucket, []).append(key)
+    for bucket, bucket_keys in keys.items():
+        for key, message in storage.delete(bucket, bucket_keys):
+            LOGGER.error("failed to remove %s: %s", key, message)
+    for blob in blobs:
+        BINARY_CACHE.invalidate(tenant, blob)
+
+
+def attach_binary(orm_image, upload):
+    """
+        Points the image to the stored binary holding the upload contents and confirms it.
+        Contents already stored for the tenant are shared, the upload being dropped; new ones are
+        completed and recorded.
+
+        :raises HTTPRequestError: (409) if contents known when the upload started are gone
+    """
+    binary = acquire_binary(upload.sha256)
+    if binary is None:
+        if not upload.store:
+            raise HTTPRequestError(409, "Binary was removed meanwhile, upload it again")
+        upload.commit()
+        binary = Binary(sha256=upload.sha256, blob=upload.blob, size=upload.size,
+                        segments=upload.segments, encoding=upload.encoding)
+        if upload.encoding is not None:
+            binary.compressed_size = upload.stored_size
+            binary.compression_ratio = round(upload.size / max(upload.stored_size, 1), 2)
+        db.session.add(binary)
+    else:
+        upload.abort()
+    binary.describe(orm_image)
+    orm_image.confirmed = True
+
+
+def commit_attached(tenant, upload):
+    """ Commits attach_binary, dropping the objects just stored if another upload won the race """
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        remove_blob(tenant, upload.blob)
+        raise HTTPRequestError(409, "The same binary is being uploaded concurrently, retry")
+
+
+def confirm_stored(tenant, orm_image, blob):
+    """
+        Validates a binary that reached the store without going through the service, as <blob>.hex,
+        and attaches it to the image (see process_stored). Invalid files are removed.
+    """
+    stat_binary(storage, tenant, blob + '.hex')
+    upload = process_stored(storage, tenant, blob)
+    try:
+        attach_binary(orm_image, upload)
+    except HTTPRequestError:
+        upload.abort()
+        remove_blob(tenant, blob)
+        raise
+    commit_attached(tenant, upload)
+    if orm_image.blob != blob:
+        # same contents as a binary stored already
+        remove_blob(tenant, blob)
+
+
+def release_image_binary(orm_image):
+    """ Drops the reference the image holds on its binary, see detach_binary """
+    if orm_image.confirmed:
+        return release_binary(orm_image)
+    # objects put through a presigned URL that was never confirmed
+    return orm_image.blob
+
+
+def detach_binary(orm_image):
+    """ Drops the image binary, returning the blob whose objects are to be removed once committed """
+    blob = release_image_binary(orm_image)
+    for name in Binary.DESCRIPTION:
+        setattr(orm_image, name, None)
+    orm_image.confirmed = False
+    return blob
+
+
+def strong_etag(*parts):
+    return hashlib.md5('|'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def http_timestamp(local):
+    """ A Last-Modified date out of a timestamp stored in local time: werkzeug takes naive datetimes as UTC """
+    return local.astimezone(timezone.utc).replace(tzinfo=None, microsecond=0) if local else None
+
+
+def image_validators(orm_image):
+    """ Returns the (ETag, Last-Modified) pair of the image metadata """
+    modified = orm_image.updated or orm_image.created
+    return strong_etag(orm_image.id, modified.isoformat() if modified else ''), http_timestamp(modified)
+
+
+def collection_validators(tenant):
+    """ Returns the (ETag, Last-Modified) pair of the image listing asked by the request """
+    version, updated = get_collection_version()
+    etag = strong_etag(tenant, version, updated.isoformat() if updated else '',
+                       sorted(request.args.items(multi=True)))
+    return etag, http_timestamp(updated)
+
+
+def set_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def not_modified(etag, last_modified):
+    return set_validators(Response(status=304), etag, last_modified)
 
 
 @image.route('/image', methods=['GET'])
 def get_all():
     try:
-        init_tenant_context(request, db, minioClient)
-        images = get_all_images_filter(request.args.to_dict())
-        json_images = [image_schema.dump(i) for i in images]
-        return make_response(jsonify(json_images), 200)
+        tenant = init_tenant_context(request, db, storage)
+        cursor, page_size = get_cursor_pagination(request, CONFIG.max_page_size)
+        filters = request.args.to_dict()
+        filters.pop('cursor', None)
+        filters.pop('page_size', None)
+
+        # the collection version is checked before any image is read
+        etag, last_modified = collection_validators(tenant)
+        if is_not_modified(request, etag, last_modified):
+            return not_modified(etag, last_modified)
+
+        rows, next_cursor = get_images_page(filters, cursor, page_size,
+                                            columns=image_row_encoder.columns(Image))
+        response = set_validators(make_response(jsonify(image_row_encoder.dump_many(rows)), 200),
+                                  etag, last_modified)
+        if next_cursor:
+            filters.update(cursor=next_cursor, page_size=page_size)
+            response.headers['X-Next-Cursor'] = next_cursor
+            response.headers['Link'] = '</image?%s>; rel="next"' % urlencode(filters)
+        return response
     except HTTPRequestError as e:
         if isinstance(e.message, dict):
             return make_response(jsonify(e.message), e.error_code)
@@ -42,13 +198,107 @@ def get_all():
             return format_response(e.error_code, e.message)
 
 
+def binary_images(names):
+    """ Maps the blobs of the given object names to the (sorted) ids of the confirmed images using them """
+    blobs = set(name.rpartition('.')[0] for name in names if name.rpartition('.')[2] in BINARY_FORMATS)
+    if not blobs:
+        return {}
+    images = {}
+    for image_id, blob in db.session.query(Image.id, Image.blob) \
+            .filter(Image.confirmed.is_(True), Image.blob.in_(blobs)):
+        images.setdefault(blob, []).append(image_id)
+    # uploaded before deduplication, named after the image
+    for image_id, in db.session.query(Image.id) \
+            .filter(Image.confirmed.is_(True), Image.blob.is_(None), Image.id.in_(blobs)):
+        images.setdefault(image_id, []).append(image_id)
+    return {blob: sorted(image_ids) for blob, image_ids in images.items()}
+
+
+def encode_binaries(objects, skip, images):
+    """
+        Yields the JSON array describing the given objects piece by piece, names cut by skip chars.
+        Objects are listed once per image using them (see binary_images), under the image id.
+    """
+    yield '['
+    separator = ''
+    for obj in objects:
+        name = obj.object_name[skip:]
+        blob, _, binary_format = name.rpartition('.')
+        for image_id in images.get(blob, ()):
+            entry = {
+                'name': image_id + '.' + binary_format,
+                'object': name,
+                'size': obj.size,
+                'etag': obj.etag,
+                'last_modified': obj.last_modified.isoformat() if obj.last_modified else None
+            }
+            yield separator + json.dumps(entry)
+            separator = ','
+    yield ']'
+
+
 @image.route('/image/binary/', methods=['GET'])
 def get_all_binaries():
     try:
-        tenant = init_tenant_context(request, db, minioClient)
-        images = minioClient.list_objects(tenant)
-        image_list = [i.object_name for i in images]
-        return make_response(jsonify(image_list), 200)
+        tenant = init_tenant_context(request, db, storage)
+        cursor, page_size = get_cursor_pagination(request, CONFIG.max_page_size)
+        prefix = request.args.get('prefix', '')
+        objects, next_cursor = list_objects_page(storage, tenant, prefix, cursor, page_size)
+        skip = len(tenant_prefix(tenant))
+        images = binary_images([obj.object_name[skip:] for obj in objects])
+
+        response = Response(encode_binaries(objects, skip, images), 200, mimetype='application/json')
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+            query = urlencode({'prefix': prefix, 'cursor': next_cursor, 'page_size': page_size})
+            response.headers['Link'] = '</image/binary/?%s>; rel="next"' % query
+        return response
+    except HTTPRequestError as e:
+        if isinstance(e.message, dict):
+            return make_response(jsonify(e.message), e.error_code)
+        else:
+            return format_response(e.error_code, e.message)
+
+
+@image.route('/image/binary/cache', methods=['GET'])
+def get_binary_cache_stats():
+    return make_response(jsonify(BINARY_CACHE.stats()), 200)
+
+
+@image.route('/image/metadata/cache', methods=['GET'])
+def get_metadata_cache_stats():
+    return make_response(jsonify(METADATA_CACHE.stats()), 200)
+
+
+@image.route('/image/changes', methods=['GET'])
+def get_image_changes():
+    """
+        Lists the changes made to the tenant images after the given sequence number (?since=),
+        waiting up to ?wait= seconds for one if there is none yet. Clients accepting
+        text/event-stream get them as server-sent events instead, as they are committed.
+    """
+    try:
+        init_tenant_context(request, db, storage)
+        _, page_size = get_cursor_pagination(request, CONFIG.max_page_size)
+        try:
+            since = int(request.headers.get('Last-Event-ID', request.args.get('since', 0)))
+            wait = float(request.args.get('wait', 0))
+        except ValueError:
+            raise HTTPRequestError(400, "since must be an integer and wait a number of seconds")
+        if since < 0 or wait < 0:
+            raise HTTPRequestError(400, "since and wait must not be negative")
+
+        if request.accept_mimetypes.best_match(['application/json', 'text/event-stream']) == 'text/event-stream':
+            events = stream_with_context(stream_changes(since, page_size, CONFIG.change_stream_timeout))
+            return Response(events, mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+        changes = wait_for_changes(since, page_size, min(wait, CONFIG.max_change_wait))
+        result = {
+            'changes': change_schema.dump(changes, many=True),
+            'last': changes[-1].seq if changes else since
+        }
+        return make_response(jsonify(result), 200)
     except HTTPRequestError as e:
         if isinstance(e.message, dict):
             return make_response(jsonify(e.message), e.error_code)
@@ -59,10 +309,14 @@ def get_all_binaries():
 @image.route('/image/<imageid>', methods=['GET'])
 def get_image(imageid):
     try:
-        init_tenant_context(request, db, minioClient)
-        orm_image = assert_image_exists(imageid)
+        init_tenant_context(request, db, storage)
+        orm_image = get_image_snapshot(imageid)
+        etag, last_modified = image_validators(orm_image)
+        if is_not_modified(request, etag, last_modified):
+            return not_modified(etag, last_modified)
+
         result = image_schema.dump(orm_image)
-        return make_response(jsonify(result), 200)
+        return set_validators(make_response(jsonify(result), 200), etag, last_modified)
     except HTTPRequestError as e:
         if isinstance(e.message, dict):
             return make_response(jsonify(e.message), e.error_code)
@@ -73,14 +327,67 @@ def get_image(imageid):
 @image.route('/image/<imageid>/binary', methods=['GET'])
 def get_image_binary(imageid):
     try:
-        tenant = init_tenant_context(request, db, minioClient)
-        orm_image = assert_image_exists(imageid)
-        filename = imageid + '.hex'
+        tenant = init_tenant_context(request, db, storage)
+        orm_image = get_image_snapshot(imageid)
+        binary_format = request.args.get('format', 'hex')
+        if binary_format not in BINARY_FORMATS:
+            raise HTTPRequestError(400, "Unknown binary format: %s" % binary_format)
         if not orm_image.confirmed:
             raise HTTPRequestError(404, "Image does not have an binary file")
-        minioClient.fget_object(tenant, filename, os.path.join('/tmp/', filename))
-        return send_from_directory(directory='/tmp/', filename=filename)
+        if binary_format == 'bin' and orm_image.segments is None:
+            raise HTTPRequestError(404, "Image does not have a compact binary")
+        filename = orm_image.binary_object(binary_format)
+        if CONFIG.binary_delivery != 'stream':
+            return presigned_download(tenant, filename, orm_image.encoding)
+        if binary_format == 'hex':
+            sha256, size = orm_image.sha256, orm_image.size
+        else:
+            sha256, size = None, sum(segment['size'] for segment in orm_image.segments)
+        return stream_binary(request, storage, tenant, orm_image.blob_name(), filename,
+                             sha256=sha256, encoding=orm_image.encoding, size=size)
+
+    except HTTPRequestError as e:
+        if isinstance(e.message, dict):
+            return make_response(jsonify(e.message), e.error_code)
+        else:
+            return format_response(e.error_code, e.message)
+
 
+@image.route('/image/<imageid>/delta', methods=['GET'])
+def get_image_delta(imageid):
+    """ Serves the patch turning the binary of image ?from=<id> into this one, once it is built """
+    try:
+        tenant = init_tenant_context(request, db, storage)
+        binary_format = request.args.get('format', 'hex')
+        if binary_format not in BINARY_FORMATS:
+            raise HTTPRequestError(400, "Unknown binary format: %s" % binary_format)
+        if 'from' not in request.args:
+            raise HTTPRequestError(400, "Missing source image: ?from=<image id>")
+        if request.args['from'] == imageid:
+            raise HTTPRequestError(400, "Source and target images must differ")
+        target = get_image_snapshot(imageid)
+        source = get_image_snapshot(request.args['from'])
+        for orm_image in (source, target):
+            if not orm_image.confirmed:
+                raise HTTPRequestError(404, "Image does not have an binary file: %s" % orm_image.id)
+            if binary_format == 'bin' and orm_image.segments is None:
+                raise HTTPRequestError(404, "Image does not have a compact binary: %s" % orm_image.id)
+            if (orm_image.size or 0) > CONFIG.delta_max_size:
+                raise HTTPRequestError(400, "Image too large for a delta: %s" % orm_image.id)
+
+        name = patch_name(source, target, binary_format)
+        try:
+            stat = storage.stat(*object_location(tenant, name))
+        except ObjectNotFound:
+            DELTA_BUILDER.request(storage, tenant, name,
+                                  (source.binary_object(binary_format), source.encoding),
+                                  (target.binary_object(binary_format), target.encoding))
+            response = format_response(202, "Delta is being computed, retry later")
+            response.headers['Retry-After'] = str(CONFIG.delta_retry_after)
+            return response
+
+        return stream_binary(request, storage, tenant, target.blob_name(), name,
+                             encoding=object_header(stat, 'Content-Encoding'), size=decoded_size(stat), stat=stat)
     except HTTPRequestError as e:
         if isinstance(e.message, dict):
             return make_response(jsonify(e.message), e.error_code)
@@ -91,14 +398,19 @@ def get_image_binary(imageid):
 @image.route('/image/<imageid>', methods=['DELETE'])
 def delete_image(imageid):
     try:
-        tenant = init_tenant_context(request, db, minioClient)
+        tenant = init_tenant_context(request, db, storage)
         orm_image = assert_image_exists(imageid)
         data = image_schema.dump(orm_image)
 
-        if orm_image.confirmed:
-            minioClient.remove_object(tenant, imageid + '.hex')
+        sessions = UploadSession.query.filter_by(image_id=imageid).all()
+        blob = detach_binary(orm_image)
+        for session in sessions:
+            abort_upload(storage, tenant, session)
+            db.session.delete(session)
         db.session.delete(orm_image)
         db.session.commit()
+        if blob is not None:
+            remove_blob(tenant, blob)
 
         result ={'result': 'ok', 'removed_image': data}
         return make_response(jsonify(result), 200)
@@ -112,11 +424,12 @@ def delete_image(imageid):
 @image.route('/image/<imageid>/binary', methods=['DELETE'])
 def delete_image_binary(imageid):
     try:
-        tenant = init_tenant_context(request, db, minioClient)
+        tenant = init_tenant_context(request, db, storage)
         orm_image = assert_image_exists(imageid)
-        minioClient.remove_object(tenant, imageid + '.hex')
-        orm_image.confirmed = False
+        blob = detach_binary(orm_image)
         db.session.commit()
+        if blob is not None:
+            remove_blob(tenant, blob)
 
         return make_response(jsonify({'result': 'ok'}), 200)
     except HTTPRequestError as e:
@@ -130,7 +443,8 @@ def delete_image_binary(imageid):
 def create_image():
     """ Creates and configures the given image (in json) """
     try:
-        tenant = init_tenant_context(request, db, minioClient)
+        # binds the tenant, which the tenant column of the new row defaults to
+        init_tenant_context(request, db, storage)
         image_data, json_payload = parse_json_payload(request, image_schema)
         imageid = str(uuid.uuid4())
         image_data['id'] = imageid
@@ -160,34 +474,135 @@ def create_image():
             return format_response(e.error_code, e.message)
 
 
+def batch_status(results, succeeded):
+    """ 207 Multi-Status unless every entry of the batch got the same outcome """
+    if all(result['status'] == succeeded for result in results):
+        return succeeded
+    if all(result['status'] != succeeded for result in results):
+        return results[0]['status']
+    return 207
+
+
+@image.route('/image/batch', methods=['POST'])
+def create_images():
+    """ Creates every image of the given list (in json) in a single transaction """
+    try:
+        init_tenant_context(request, db, storage)
+        entries, errors = parse_json_batch(request, image_batch_schema, CONFIG.max_batch_size)
+
+        results = [None] * (len(entries) + len(errors))
+        for index, messages in errors.items():
+            results[index] = {'status': 400, 'message': 'failed to parse input', 'errors': messages}
+
+        created = datetime.now()
+        for index, image_data in entries:
+            imageid = str(uuid.uuid4())
+            image_data.update(id=imageid, created=created)
+            results[index] = {
+                "status": 201,
+                "id": imageid,
+                "label": image_data['label'],
+                "published_at": created,
+                "url": '/image/' + imageid
+            }
+
+        if entries:
+            db.session.bulk_insert_mappings(Image, [image_data for _, image_data in entries])
+            # bulk inserts bypass the flush events
+            touch_collection(db.session)
+            for _, image_data in entries:
+                record_change(db.session, image_data['id'], 'created')
+            try:
+                db.session.commit()
+            except IntegrityError as error:
+                db.session.rollback()
+                handle_consistency_exception(error)
+
+        return make_response(jsonify(results), batch_status(results, 201))
+
+    except HTTPRequestError as e:
+        if isinstance(e.message, dict):
+            return make_response(jsonify(e.message), e.error_code)
+        else:
+            return format_response(e.error_code, e.message)
+
+
+@image.route('/image/batch', methods=['DELETE'])
+def delete_images():
+    """ Removes every image of the given list of ids (in json), along with their binaries """
+    try:
+        tenant = init_tenant_context(request, db, storage)
+        imageids = parse_json_list(request, CONFIG.max_batch_size)
+        if not all(isinstance(imageid, str) for imageid in imageids):
+            raise HTTPRequestError(400, "Payload must be a JSON array of image ids")
+
+        orm_images = {orm_image.id: orm_image for orm_image in Image.query.filter(Image.id.in_(imageids))}
+        removed = {imageid: image_schema.dump(orm_image) for imageid, orm_image in orm_images.items()}
+        blobs = set()
+        for orm_image in orm_images.values():
+            blobs.add(release_image_binary(orm_image))
+        blobs.discard(None)
+
+        if orm_images:
+            sessions = UploadSession.query.filter(UploadSession.image_id.in_(orm_images)).all()
+            for session in sessions:
+                abort_upload(storage, tenant, session)
+            if sessions:
+                UploadSession.query.filter(UploadSession.id.in_([session.id for session in sessions])) \
+                    .delete(synchronize_session=False)
+            # bulk deletes bypass the flush events, and flush the change feed entries before deleting
+            touch_collection(db.session)
+            for imageid in orm_images:
+                record_change(db.session, imageid, 'deleted')
+            Image.query.filter(Image.id.in_(orm_images)).delete(synchronize_session=False)
+            db.session.commit()
+            if blobs:
+                remove_blobs(tenant, blobs)
+
+        results = []
+        for imageid in imageids:
+            if imageid in removed:
+                results.append({'id': imageid, 'status': 200, 'removed_image': removed[imageid]})
+            else:
+                results.append({'id': imageid, 'status': 404, 'message': "No such image: %s" % imageid})
+        return make_response(jsonify(results), batch_status(results, 200))
+
+    except HTTPRequestError as e:
+        db.session.rollback()
+        if isinstance(e.message, dict):
+            return make_response(jsonify(e.message), e.error_code)
+        else:
+            return format_response(e.error_code, e.message)
+
+
 @image.route('/image/<imageid>/binary', methods=['POST'])
 def upload_image(imageid):
+    upload = None
     try:
-        tenant = init_tenant_context(request, db, minioClient)
+        tenant = init_tenant_context(request, db, storage)
         orm_image = assert_image_exists(imageid)
         if orm_image.confirmed:
             raise HTTPRequestError(400, "Binary already exists")
 
-        orm_image.confirmed = True
-        file_data = parse_form_payload(request)
-
-        for f in file_data:
-            print(f)
-
-        extension = file_data.filename.rsplit('.', 1)[1].lower()
-        filename = imageid + '.' + extension
-        file_data.seek(0)
-        file_data.save(os.path.join('/tmp/', filename))
+        # contents announced in a Digest header and stored already are only hashed, not written
+        digest = requested_digest(request)
+        known = digest is not None and find_binary(digest) is not None
+        upload = BinaryUpload(storage, tenant, str(uuid.uuid4()), upload_encoding(), store=not known)
         try:
-            minioClient.fput_object(tenant, filename, os.path.join('/tmp/', filename))
-            orm_image.confirmed = True
-            db.session.commit()
-        except ResponseError as err:
+            # parts are sent to the store as the form is parsed
+            file_data = parse_form_payload(request, upload.stream_factory)
+            UPLOADED_BYTES.inc(upload.size)
+            if file_data.stream is not upload:
+                raise HTTPRequestError(400, "Invalid File")
+            if digest is not None and upload.sha256 != digest:
+                raise HTTPRequestError(400, "File does not match its Digest header")
+
+            attach_binary(orm_image, upload)
+            commit_attached(tenant, upload)
+        except StorageError as err:
             LOGGER.error(err.message)
             # TODO: Don't know how this error message is formatted, parse if necessary
             raise HTTPRequestError(400, err.message)
-        except IntegrityError as error:
-            handle_consistency_exception(error)
 
         else:
             result = {'message': 'image uploaded', 'image': imageid}
@@ -196,6 +611,195 @@ def upload_image(imageid):
 
     except HTTPRequestError as e:
         db.session.rollback()
+        if upload is not None:
+            upload.abort()
+        if isinstance(e.message, dict):
+            return make_response(jsonify(e.message), e.error_code)
+        else:
+            return format_response(e.error_code, e.message)
+
+
+@image.route('/image/<imageid>/binary/url', methods=['POST'])
+def presign_image_upload(imageid):
+    """ Hands out a presigned URL the binary can be PUT to, to be confirmed once uploaded """
+    try:
+        tenant = init_tenant_context(request, db, storage)
+        orm_image = assert_image_exists(imageid)
+        if orm_image.confirmed:
+            raise HTTPRequestError(400, "Binary already exists")
+        if orm_image.blob is None:
+            orm_image.blob = str(uuid.uuid4())
+            db.session.commit()
+
+        result = {
+            'url': presigned_put(tenant, orm_image.binary_object('hex')),
+            'method': 'PUT',
+            'expires_in': CONFIG.presign_expiry,
+            'confirm': '/image/' + imageid + '/binary/confirm'
+        }
+        return make_response(jsonify(result), 200)
+    except HTTPRequestError as e:
+        if isinstance(e.message, dict):
+            return make_response(jsonify(e.message), e.error_code)
+        else:
+            return format_response(e.error_code, e.message)
+
+
+@image.route('/image/<imageid>/binary/confirm', methods=['POST'])
+def confirm_image_upload(imageid):
+    """ Validates a binary uploaded through a presigned URL (see BinaryUpload) and marks it as available """
+    try:
+        tenant = init_tenant_context(request, db, storage)
+        orm_image = assert_image_exists(imageid)
+        if orm_image.confirmed:
+            raise HTTPRequestError(400, "Binary already exists")
+
+        if orm_image.blob is None:
+            raise HTTPRequestError(404, "Image does not have an binary file")
+        confirm_stored(tenant, orm_image, orm_image.blob)
+
+        return make_response(jsonify({'message': 'image uploaded', 'image': imageid}), 200)
+    except HTTPRequestError as e:
+        db.session.rollback()
+        if isinstance(e.message, dict):
+            return make_response(jsonify(e.message), e.error_code)
+        else:
+            return format_response(e.error_code, e.message)
+
+
+def session_status(imageid, session, parts):
+    return {
+        'session': session.id,
+        'url': '/image/%s/binary/sessions/%s' % (imageid, session.id),
+        'chunks': [{'number': number, 'size': part.size, 'etag': part.etag}
+                   for number, part in sorted(parts.items())],
+        'updated': session.updated.isoformat(),
+        'expires_in': CONFIG.upload_session_ttl
+    }
+
+
+@image.route('/image/<imageid>/binary/sessions', methods=['POST'])
+def create_upload_session(imageid):
+    """ Starts a resumable upload of the image binary """
+    try:
+        tenant = init_tenant_context(request, db, storage)
+        orm_image = assert_image_exists(imageid)
+        if orm_image.confirmed:
+            raise HTTPRequestError(400, "Binary already exists")
+        purge_stale_sessions(storage, tenant, limit=10)
+
+        blob = str(uuid.uuid4())
+        try:
+            upload_id = start_upload(storage, tenant, blob)
+        except StorageError as err:
+            LOGGER.error(err.message)
+            raise HTTPRequestError(400, err.message)
+        session = UploadSession(id=str(uuid.uuid4()), image_id=imageid, blob=blob, upload_id=upload_id)
+        db.session.add(session)
+        db.session.commit()
+
+        result = session_status(imageid, session, {})
+        return make_response(jsonify(result), 201, {'location': result['url']})
+    except HTTPRequestError as e:
+        if isinstance(e.message, dict):
+            return make_response(jsonify(e.message), e.error_code)
+        else:
+            return format_response(e.error_code, e.message)
+
+
+@image.route('/image/<imageid>/binary/sessions/<sessionid>', methods=['GET'])
+def get_upload_session(imageid, sessionid):
+    """ Tells which chunks of a resumable upload were received """
+    try:
+        tenant = init_tenant_context(request, db, storage)
+        session = assert_session_exists(imageid, sessionid)
+        try:
+            parts = received_chunks(storage, tenant, session)
+        except StorageError as err:
+            LOGGER.error(err.message)
+            raise HTTPRequestError(400, err.message)
+        return make_response(jsonify(session_status(imageid, session, parts)), 200)
+    except HTTPRequestError as e:
+        if isinstance(e.message, dict):
+            return make_response(jsonify(e.message), e.error_code)
+        else:
+            return format_response(e.error_code, e.message)
+
+
+@image.route('/image/<imageid>/binary/sessions/<sessionid>/<int:number>', methods=['PUT'])
+def put_upload_chunk(imageid, sessionid, number):
+    """ Receives (or replaces) a chunk of a resumable upload, the request body being the chunk """
+    try:
+        tenant = init_tenant_context(request, db, storage)
+        session = assert_session_exists(imageid, sessionid)
+        if request.content_length is None or request.content_length > CONFIG.max_chunk_size:
+            raise HTTPRequestError(413, "Chunks must have a Content-Length of at most %d bytes"
+                                   % CONFIG.max_chunk_size)
+        data = request.get_data(cache=False)
+        try:
+            etag = put_chunk(storage, tenant, session, number, data)
+        except StorageError as err:
+            LOGGER.error(err.message)
+            raise HTTPRequestError(400, err.message)
+        UPLOADED_BYTES.inc(len(data))
+        session.updated = datetime.now()
+        db.session.commit()
+
+        result = {'session': session.id, 'number': number, 'size': len(data), 'etag': etag}
+        return make_response(jsonify(result), 200)
+    except HTTPRequestError as e:
+        if isinstance(e.message, dict):
+            return make_response(jsonify(e.message), e.error_code)
+        else:
+            return format_response(e.error_code, e.message)
+
+
+@image.route('/image/<imageid>/binary/sessions/<sessionid>/commit', methods=['POST'])
+def commit_upload_session(imageid, sessionid):
+    """ Assembles the chunks of a resumable upload into the image binary, confirming the image """
+    try:
+        tenant = init_tenant_context(request, db, storage)
+        orm_image = assert_image_exists(imageid)
+        session = assert_session_exists(imageid, sessionid)
+        if orm_image.confirmed:
+            raise HTTPRequestError(400, "Binary already exists")
+
+        try:
+            # the session is kept for the client to retry if the store fails here
+            complete_upload(storage, tenant, session)
+            db.session.delete(session)
+            try:
+                confirm_stored(tenant, orm_image, session.blob)
+            except (HTTPRequestError, StorageError):
+                # the multipart upload is over either way
+                db.session.rollback()
+                db.session.delete(session)
+                db.session.commit()
+                raise
+        except StorageError as err:
+            LOGGER.error(err.message)
+            raise HTTPRequestError(400, err.message)
+
+        return make_response(jsonify({'message': 'image uploaded', 'image': imageid}), 200)
+    except HTTPRequestError as e:
+        db.session.rollback()
+        if isinstance(e.message, dict):
+            return make_response(jsonify(e.message), e.error_code)
+        else:
+            return format_response(e.error_code, e.message)
+
+
+@image.route('/image/<imageid>/binary/sessions/<sessionid>', methods=['DELETE'])
+def delete_upload_session(imageid, sessionid):
+    """ Gives up a resumable upload, dropping the chunks received """
+    try:
+        tenant = init_tenant_context(request, db, storage)
+        session = assert_session_exists(imageid, sessionid)
+        abort_upload(storage, tenant, session)
+        db.session.delete(session)
+        db.session.commit()
+        return make_response(jsonify({'result': 'ok'}), 200)
+    except HTTPRequestError as e:
         if isinstance(e.message, dict):
             return make_response(jsonify(e.message), e.error_code)
         else:
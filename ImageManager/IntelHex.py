@@ -0,0 +1,119 @@
+"""
+    Incremental Intel HEX decoder.
+    Records are validated (start code, length, checksum, type) as the file is streamed in, and the
+    data they carry is returned in file order, so an upload can be turned into a compact binary
+    on the fly. Where each run of bytes belongs in the device memory is kept in a segment map.
+"""
+
+from bisect import bisect_right
+
+DATA, END_OF_FILE, EXTENDED_SEGMENT_ADDRESS, START_SEGMENT_ADDRESS, \
+    EXTENDED_LINEAR_ADDRESS, START_LINEAR_ADDRESS = range(6)
+
+# ':' + 2 hex digits for each of count, address (2), type, up to 255 data bytes and checksum
+MAX_RECORD_LENGTH = 1 + 2 * (1 + 2 + 1 + 255 + 1)
+
+
+class IntelHexError(Exception):
+    """ The file is not valid Intel HEX """
+
+
+class IntelHexParser(object):
+    """
+        Feed it the file in chunks of any size, then call close().
+        ``segments`` holds [address, offset, size] triples: ``size`` bytes found at ``offset`` of the
+        decoded data are to be placed at ``address``. Overlapping records are rejected.
+    """
+
+    def __init__(self):
+        self.segments = []
+        self.size = 0
+        self.line = 0
+        self._base = 0
+        self._eof = False
+        self._pending = b''
+        # start address -> end address of every segment, starts kept sorted to look for overlaps
+        self._starts = []
+        self._ends = {}
+
+    def feed(self, data):
+        """ Parses every complete line in data, returning the bytes carried by its data records """
+        lines = (self._pending + data).split(b'\n')
+        self._pending = lines.pop()
+        if len(self._pending.strip()) > MAX_RECORD_LENGTH:
+            raise IntelHexError("line %d: record too long" % (self.line + 1))
+        decoded = bytearray()
+        for line in lines:
+            decoded += self._record(line.strip())
+        return bytes(decoded)
+
+    def close(self):
+        """ Parses the last line and checks the file is complete, returning its segment map """
+        last, self._pending = self._pending.strip(), b''
+        if last:
+            self._record(last)
+        if not self._eof:
+            raise IntelHexError("missing end of file record")
+        return [{'address': address, 'offset': offset, 'size': size}
+                for address, offset, size in self.segments]
+
+    def _record(self, line):
+        self.line += 1
+        if not line:
+            return b''
+        if self._eof:
+            raise IntelHexError("line %d: record after end of file" % self.line)
+        if line[:1] != b':':
+            raise IntelHexError("line %d: missing start code" % self.line)
+        try:
+            record = bytes.fromhex(line[1:].decode('ascii'))
+        except ValueError:
+            raise IntelHexError("line %d: invalid hexadecimal digits" % self.line)
+        if len(record) < 5 or len(record) != record[0] + 5:
+            raise IntelHexError("line %d: invalid record length" % self.line)
+        if sum(record) & 0xFF:
+            raise IntelHexError("line %d: checksum mismatch" % self.line)
+
+        count, kind, payload = record[0], record[3], record[4:-1]
+        if kind == DATA:
+            self._claim(self._base + ((record[1] << 8) | record[2]), count)
+            return payload
+        if kind == END_OF_FILE:
+            self._eof = True
+        elif kind in (EXTENDED_SEGMENT_ADDRESS, EXTENDED_LINEAR_ADDRESS):
+            if count != 2:
+                raise IntelHexError("line %d: invalid address record" % self.line)
+            shift = 4 if kind == EXTENDED_SEGMENT_ADDRESS else 16
+            self._base = int.from_bytes(payload, 'big') << shift
+        elif kind in (START_SEGMENT_ADDRESS, START_LINEAR_ADDRESS):
+            if count != 4:
+                raise IntelHexError("line %d: invalid start address record" % self.line)
+        else:
+            raise IntelHexError("line %d: unknown record type %02X" % (self.line, kind))
+        return b''
+
+    def _claim(self, address, count):
+        """ Places count bytes at address, extending the current segment when contiguous """
+        if not count:
+            return
+        end = address + count
+        current = self.segments[-1] if self.segments else None
+        if current is not None and current[0] + current[2] == address:
+            following = bisect_right(self._starts, current[0])
+            if following < len(self._starts) and self._starts[following] < end:
+                self._overlap(address)
+            current[2] += count
+            self._ends[current[0]] = end
+        else:
+            following = bisect_right(self._starts, address)
+            if following and self._ends[self._starts[following - 1]] > address:
+                self._overlap(address)
+            if following < len(self._starts) and self._starts[following] < end:
+                self._overlap(address)
+            self._starts.insert(following, address)
+            self._ends[address] = end
+            self.segments.append([address, self.size, count])
+        self.size += count
+
+    def _overlap(self, address):
+        raise IntelHexError("line %d: data at 0x%08X overlaps a previous record" % (self.line, address))
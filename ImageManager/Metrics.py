@@ -0,0 +1,167 @@
+"""
+    Prometheus instrumentation: request latency per route, requests in flight, SQL statement and
+    object store request durations, time spent in the main request phases, bytes transferred and
+    cache lookups, exposed at /metrics.
+
+    gunicorn runs several worker processes, each with its own counters. When the
+    ``prometheus_multiproc_dir`` environment variable names a directory (see docker/entrypoint.sh),
+    workers write their samples there and /metrics adds up those of every worker, whichever
+    answers the scrape.
+"""
+
+import os
+import time
+from functools import wraps
+from flask import Response, g, request
+from minio import Minio
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, \
+    REGISTRY, generate_latest, multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .app import app
+
+# up to a minute: long-polls and large transfers land in the last buckets
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+REQUEST_LATENCY = Histogram('image_manager_request_duration_seconds',
+                            "Time to answer a request (until its body starts streaming)",
+                            ['method', 'endpoint', 'status'], buckets=LATENCY_BUCKETS)
+REQUESTS_IN_PROGRESS = Gauge('image_manager_requests_in_progress', "Requests being answered",
+                             ['method', 'endpoint'], multiprocess_mode='livesum')
+QUERY_LATENCY = Histogram('image_manager_db_query_duration_seconds', "Time spent running SQL statements",
+                          ['statement'], buckets=LATENCY_BUCKETS)
+STORAGE_LATENCY = Histogram('image_manager_s3_request_duration_seconds',
+                            "Time to get the response headers of object store requests",
+                            ['operation'], buckets=LATENCY_BUCKETS)
+SECTION_LATENCY = Histogram('image_manager_section_duration_seconds',
+                            "Time spent in the main phases of requests", ['section'], buckets=LATENCY_BUCKETS)
+UPLOADED_BYTES = Counter('image_manager_uploaded_bytes_total', "Binary bytes received")
+DOWNLOADED_BYTES = Counter('image_manager_downloaded_bytes_total', "Binary bytes sent")
+CACHE_LOOKUPS = Counter('image_manager_cache_lookups_total', "Cache lookups", ['cache', 'result'])
+
+STATEMENTS = ('select', 'insert', 'update', 'delete')
+
+
+def multiprocess_mode():
+    return 'prometheus_multiproc_dir' in os.environ
+
+
+def timed(section):
+    """ Decorator recording the duration of the calls of the function as the given section """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with SECTION_LATENCY.labels(section).time():
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_bytes(chunks, counter):
+    """ Passes chunks through, counting their bytes """
+    try:
+        for chunk in chunks:
+            counter.inc(len(chunk))
+            yield chunk
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def route_labels():
+    # route templates rather than paths, so image ids do not blow up the number of series
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    return request.method, endpoint
+
+
+@app.before_request
+def start_timer():
+    g.metrics_labels = route_labels()
+    g.metrics_start = time.monotonic()
+    REQUESTS_IN_PROGRESS.labels(*g.metrics_labels).inc()
+
+
+@app.after_request
+def record_request(response):
+    if 'metrics_labels' in g:
+        REQUEST_LATENCY.labels(*g.metrics_labels, response.status_code).observe(time.monotonic() - g.metrics_start)
+        g.metrics_start = None
+    return response
+
+
+@app.teardown_request
+def finish_request(exception=None):
+    if 'metrics_labels' not in g:
+        return
+    if g.metrics_start is not None:
+        # the request failed before a response was made
+        REQUEST_LATENCY.labels(*g.metrics_labels, 500).observe(time.monotonic() - g.metrics_start)
+    REQUESTS_IN_PROGRESS.labels(*g.metrics_labels).dec()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_query_start', []).append(time.monotonic())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['metrics_query_start'].pop()
+    kind = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else ''
+    QUERY_LATENCY.labels(kind if kind in STATEMENTS else 'other').observe(time.monotonic() - start)
+
+
+@event.listens_for(Engine, 'handle_error')
+def forget_query(context):
+    starts = context.connection.info.get('metrics_query_start') if context.connection is not None else None
+    if starts:
+        starts.pop()
+
+
+def storage_operation(method, object_name, query):
+    """ Names the object store operation behind a request """
+    query = query or {}
+    if 'uploadId' in query:
+        return {'PUT': 'upload_part', 'POST': 'complete_multipart_upload', 'GET': 'list_parts',
+                'DELETE': 'abort_multipart_upload'}.get(method, method.lower())
+    if 'uploads' in query:
+        return 'create_multipart_upload' if method == 'POST' else 'list_multipart_uploads'
+    if 'delete' in query:
+        return 'remove_objects'
+    if object_name is None:
+        return {'GET': 'list_objects', 'PUT': 'make_bucket', 'HEAD': 'bucket_exists'}.get(method, method.lower())
+    return {'GET': 'get_object', 'PUT': 'put_object', 'HEAD': 'stat_object',
+            'DELETE': 'remove_object'}.get(method, method.lower())
+
+
+class TimedMinio(Minio):
+    """
+        Minio client timing every request it sends to the object store. Most of them go through
+        _url_open, the few the client sends itself are timed one by one.
+    """
+
+    def _url_open(self, method, bucket_name=None, object_name=None, query=None, *args, **kwargs):
+        operation = storage_operation(method, object_name, query)
+        with STORAGE_LATENCY.labels(operation).time():
+            return super(TimedMinio, self)._url_open(method, bucket_name, object_name, query, *args, **kwargs)
+
+    def make_bucket(self, bucket_name, *args, **kwargs):
+        with STORAGE_LATENCY.labels('make_bucket').time():
+            return super(TimedMinio, self).make_bucket(bucket_name, *args, **kwargs)
+
+    def _get_bucket_location(self, bucket_name):
+        # sent once per bucket, the region is cached afterwards
+        with STORAGE_LATENCY.labels('get_bucket_location').time():
+            return super(TimedMinio, self)._get_bucket_location(bucket_name)
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if multiprocess_mode():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
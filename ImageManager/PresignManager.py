@@ -0,0 +1,59 @@
+"""
+    Presigned object store URLs, so binaries can travel between devices and the object store
+    without going through the service. The service still checks tenancy and image state before
+    handing a URL out; URLs expire after CONFIG.presign_expiry seconds. Only the minio storage
+    backend has them.
+"""
+
+from datetime import timedelta
+from flask import jsonify, make_response, redirect
+from minio import Minio
+
+from .conf import CONFIG
+from .StorageManager import object_location
+from .utils import HTTPRequestError
+
+
+def public_client():
+    """ Client signing URLs for the endpoint devices reach, which may differ from the internal one """
+    endpoint = CONFIG.s3public_url
+    secure = endpoint.startswith('https://')
+    endpoint = endpoint.split('://', 1)[-1].rstrip('/')
+    return Minio(endpoint, CONFIG.s3user, CONFIG.s3pass, secure=secure, region=CONFIG.s3region)
+
+
+presignClient = public_client()
+
+
+def presign_expiry():
+    return timedelta(seconds=CONFIG.presign_expiry)
+
+
+def assert_presigned_urls():
+    if CONFIG.storage_backend != 'minio':
+        raise HTTPRequestError(501, "Presigned URLs are not available with the %s storage backend"
+                               % CONFIG.storage_backend)
+
+
+def presigned_get(tenant, object_name):
+    assert_presigned_urls()
+    return presignClient.presigned_get_object(*object_location(tenant, object_name), expires=presign_expiry())
+
+
+def presigned_put(tenant, object_name):
+    assert_presigned_urls()
+    return presignClient.presigned_put_object(*object_location(tenant, object_name), expires=presign_expiry())
+
+
+def presigned_download(tenant, object_name, encoding=None):
+    """
+        Answers a binary download according to CONFIG.binary_delivery, either a 302 or a JSON body.
+        The object store sends compressed objects as they are, with their Content-Encoding.
+    """
+    url = presigned_get(tenant, object_name)
+    if CONFIG.binary_delivery == 'redirect':
+        return redirect(url, 302)
+    result = {'url': url, 'method': 'GET', 'expires_in': CONFIG.presign_expiry}
+    if encoding is not None:
+        result['encoding'] = encoding
+    return make_response(jsonify(result), 200)
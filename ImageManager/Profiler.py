@@ -0,0 +1,274 @@
+"""
+    On-demand profiling of live requests.
+
+    The profiler is off unless PROFILER_TOKEN is set, and even then costs a header lookup per
+    request until it is asked for something. Requests carrying the token in the X-Profiler-Token
+    header are profiled; a PUT to /profiler also samples a share of the requests to one route for a
+    while. Every worker adds the profiles it took to a pstats dump of its own in PROFILE_DIR, and
+    GET /profiler/stats merges those of all workers.
+
+    cProfile records everything the process runs while it is enabled: with gevent workers the
+    greenlets serving other requests are counted too, so each worker profiles one request at a
+    time and timings are best read as an upper bound.
+"""
+
+import cProfile
+import hmac
+import io
+import json
+import logging
+import marshal
+import os
+import pstats
+import random
+import threading
+import time
+from flask import Response, g, jsonify, make_response, request
+
+from .app import app
+from .conf import CONFIG
+from .utils import HTTPRequestError, format_response
+
+LOGGER = logging.getLogger('image-manager.' + __name__)
+
+TOKEN_HEADER = 'X-Profiler-Token'
+
+# how often workers look for new settings
+REFRESH_INTERVAL = 1
+
+MAX_DURATION = 3600
+
+
+class Profiler(object):
+    """
+        Profiler settings, shared by the workers through a file, and the profiles this process took
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.settings = {}
+        self.refreshed = 0
+        self.stats = None
+        self.generation = None
+        self.running = threading.Lock()
+
+    @property
+    def control_path(self):
+        return os.path.join(self.directory, 'control.json')
+
+    @property
+    def dump_path(self):
+        return os.path.join(self.directory, '{}.prof'.format(os.getpid()))
+
+    def dumps(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self.directory, name) for name in names if name.endswith('.prof')]
+
+    def read_settings(self):
+        try:
+            with open(self.control_path) as control:
+                return json.load(control)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def write_settings(self, settings):
+        os.makedirs(self.directory, exist_ok=True)
+        settings['generation'] = self.read_settings().get('generation', 0) + 1
+        temp_path = '{}.{}'.format(self.control_path, os.getpid())
+        with open(temp_path, 'w') as control:
+            json.dump(settings, control)
+        os.replace(temp_path, self.control_path)
+        for path in self.dumps():
+            os.remove(path)
+        self.refreshed = 0
+        return settings
+
+    def refresh(self):
+        now = time.monotonic()
+        if now - self.refreshed < REFRESH_INTERVAL:
+            return
+        self.refreshed = now
+        self.settings = self.read_settings()
+        if self.settings.get('generation') != self.generation:
+            # results were discarded or a new run started: drop what this process gathered so far
+            self.generation = self.settings.get('generation')
+            self.stats = None
+
+    def active(self):
+        return self.settings.get('until', 0) > time.time()
+
+    def samples(self, method, endpoint):
+        settings = self.settings
+        return (self.active() and settings['endpoint'] == endpoint and settings['method'] == method
+                and random.random() < settings['sample_rate'])
+
+    def start(self):
+        if not self.running.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile):
+        profile.disable()
+        try:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            os.makedirs(self.directory, exist_ok=True)
+            temp_path = self.dump_path + '.tmp'
+            self.stats.dump_stats(temp_path)
+            os.replace(temp_path, self.dump_path)
+        except OSError as error:
+            LOGGER.warning("failed to save profile: %s", error)
+        finally:
+            self.running.release()
+
+    def merged_stats(self):
+        stats = None
+        for path in self.dumps():
+            try:
+                if stats is None:
+                    stats = pstats.Stats(path)
+                else:
+                    stats.add(path)
+            except (OSError, EOFError, ValueError, TypeError):
+                # a worker exited while writing it
+                LOGGER.warning("ignoring unreadable profile %s", path)
+        return stats
+
+    def status(self):
+        settings = dict(self.read_settings())
+        settings.pop('generation', None)
+        settings['active'] = settings.get('until', 0) > time.time()
+        stats = self.merged_stats()
+        settings['profiled_calls'] = stats.total_calls if stats is not None else 0
+        return settings
+
+
+PROFILER = Profiler(CONFIG.profile_dir)
+
+
+def has_token():
+    token = request.headers.get(TOKEN_HEADER)
+    return token is not None and hmac.compare_digest(token.encode(), CONFIG.profiler_token.encode())
+
+
+def assert_token():
+    if not CONFIG.profiler_token:
+        raise HTTPRequestError(404, "Profiler is disabled")
+    if not has_token():
+        raise HTTPRequestError(401, "Missing or invalid {} header".format(TOKEN_HEADER))
+
+
+@app.before_request
+def start_profile():
+    if not CONFIG.profiler_token:
+        return
+    endpoint = request.url_rule.rule if request.url_rule is not None else None
+    if endpoint is None or endpoint.startswith('/profiler'):
+        return
+    PROFILER.refresh()
+    if has_token() or PROFILER.samples(request.method, endpoint):
+        g.profile = PROFILER.start()
+
+
+@app.teardown_request
+def stop_profile(exception=None):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        PROFILER.stop(profile)
+
+
+def parse_settings(payload):
+    if not isinstance(payload, dict):
+        raise HTTPRequestError(400, "Payload must be a JSON object")
+    endpoint = payload.get('endpoint')
+    method = str(payload.get('method', 'GET')).upper()
+    rules = [rule for rule in app.url_map.iter_rules() if rule.rule == endpoint]
+    if not rules:
+        raise HTTPRequestError(400, "endpoint must be a route, such as /image/<imageid>")
+    if not any(method in rule.methods for rule in rules):
+        raise HTTPRequestError(400, "{} does not answer {} requests".format(endpoint, method))
+    try:
+        sample_rate = float(payload.get('sample_rate', 0.1))
+        duration = float(payload.get('duration', 60))
+    except (TypeError, ValueError):
+        raise HTTPRequestError(400, "sample_rate and duration must be numbers")
+    if not 0 < sample_rate <= 1:
+        raise HTTPRequestError(400, "sample_rate must be greater than 0 and at most 1")
+    if not 0 < duration <= MAX_DURATION:
+        raise HTTPRequestError(400, "duration must be between 0 and {} seconds".format(MAX_DURATION))
+    return {'endpoint': endpoint, 'method': method, 'sample_rate': sample_rate, 'until': time.time() + duration}
+
+
+@app.route('/profiler', methods=['GET'])
+def get_profiler():
+    try:
+        assert_token()
+        return make_response(jsonify(PROFILER.status()), 200)
+    except HTTPRequestError as e:
+        return format_response(e.error_code, e.message)
+
+
+@app.route('/profiler', methods=['PUT'])
+def set_profiler():
+    """ Starts sampling requests to a route, discarding the results of previous runs """
+    try:
+        assert_token()
+        payload = request.get_json(force=True, silent=True)
+        settings = PROFILER.write_settings(parse_settings(payload))
+        LOGGER.info("profiling %s %s (%.0f%% of requests)", settings['method'], settings['endpoint'],
+                    settings['sample_rate'] * 100)
+        return make_response(jsonify(PROFILER.status()), 200)
+    except HTTPRequestError as e:
+        return format_response(e.error_code, e.message)
+
+
+@app.route('/profiler', methods=['DELETE'])
+def delete_profiler():
+    """ Stops sampling and discards the profiles taken so far """
+    try:
+        assert_token()
+        PROFILER.write_settings({})
+        return format_response(200)
+    except HTTPRequestError as e:
+        return format_response(e.error_code, e.message)
+
+
+@app.route('/profiler/stats', methods=['GET'])
+def get_profiler_stats():
+    """
+        Profiles of every worker, merged: a text summary (?format=text, sorted by ?sort= and limited
+        to ?limit= functions) or a file for pstats, snakeviz and the like (?format=pstats)
+    """
+    try:
+        assert_token()
+        output = request.args.get('format', 'text')
+        sort = request.args.get('sort', 'cumulative')
+        if output not in ('text', 'pstats'):
+            raise HTTPRequestError(400, "format must be text or pstats")
+        if sort not in pstats.Stats.sort_arg_dict_default:
+            raise HTTPRequestError(400, "sort must be one of {}".format(
+                ', '.join(sorted(pstats.Stats.sort_arg_dict_default))))
+        try:
+            limit = int(request.args.get('limit', 50))
+        except ValueError:
+            raise HTTPRequestError(400, "limit must be an integer")
+
+        stats = PROFILER.merged_stats()
+        if stats is None:
+            raise HTTPRequestError(404, "No request was profiled yet")
+        if output == 'pstats':
+            return Response(marshal.dumps(stats.stats), mimetype='application/octet-stream',
+                            headers={'Content-Disposition': 'attachment; filename=image-manager.prof'})
+        summary = io.StringIO()
+        stats.stream = summary
+        stats.sort_stats(sort).print_stats(limit)
+        return Response(summary.getvalue(), mimetype='text/plain')
+    except HTTPRequestError as e:
+        return format_response(e.error_code, e.message)
@@ -0,0 +1,403 @@
+"""
+    Reconciles the images of each tenant with the objects stored for them. Rows and objects are
+    written one after the other, never in a single transaction, so a crash or a failed request
+    between the two leaves objects no row refers to, or confirmed images whose binary is gone.
+    For each tenant the reconciler:
+
+    - drops upload sessions idle for longer than UPLOAD_SESSION_TTL, and aborts the multipart
+      uploads older than that no session accounts for (streamed uploads that were cut short);
+    - unconfirms the images whose stored binary is missing, dropping the binary so that the same
+      contents are stored again when next uploaded;
+    - removes the objects no image, binary or upload session refers to, and the patches (see
+      DeltaManager) between images that are gone.
+
+    It then removes the temporary files left behind by workers that died and by the storage
+    backend, and the binaries spooled to /tmp by versions preceding streamed uploads. Objects are only removed once older than RECONCILE_GRACE seconds, as uploads write
+    them before the row pointing to them is committed. Images are scanned in batches (keyset on
+    their id), objects are listed a page at a time, and requests to the database and the store are
+    spaced out to RECONCILE_RATE per second so that foreground requests are not slowed down.
+
+    Run it with the same environment as the service, once:
+        python3 -m ImageManager.Reconciler --tenant admin --dry-run
+    or every RECONCILE_INTERVAL seconds from the service itself. On Postgres an advisory lock
+    makes sure a single worker of all replicas runs it at a time.
+"""
+
+import argparse
+import logging
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import and_, or_, select, text, union
+from sqlalchemy.exc import SQLAlchemyError
+
+from .app import app
+from .conf import CONFIG
+from .CacheManager import BINARY_CACHE
+from .DatabaseModels import db, storage, Binary, Image, ImageChange, UploadSession
+from .DeltaManager import patch_images
+from .ImageManager import BINARY_FORMATS
+from .ResumableUpload import purge_stale_sessions
+from .StorageBackend import ObjectNotFound, StorageError
+from .StorageManager import list_objects_page, object_location, tenant_bucket, tenant_prefix
+from .TenancyManager import list_tenant_schemas, switch_tenant
+
+LOGGER = logging.getLogger('image-manager.' + __name__)
+
+# Postgres advisory lock held while reconciling
+LOCK_KEY = 0x494d5243
+
+# versions preceding streamed uploads spooled every binary uploaded or downloaded here, as <imageid>.hex
+LEGACY_SPOOL_DIR = '/tmp'
+LEGACY_SPOOL_FILE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\.hex$')
+
+
+class RateLimiter(object):
+    """ Spaces out calls to wait() to at most rate per second, a rate of 0 meaning no limit """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next = 0
+
+    def wait(self, cost=1):
+        now = time.monotonic()
+        if self.next > now:
+            time.sleep(self.next - now)
+        self.next = max(now, self.next) + self.interval * cost
+
+
+def list_tenants():
+    """ Tenants provisioned in schema mode, or that own (or owned) rows of the shared tables """
+    if not db.shared_tables:
+        return list_tenant_schemas(db)
+    tables = [model.__table__ for model in (Image, Binary, UploadSession, ImageChange)]
+    query = union(*(select([table.c.tenant]) for table in tables))
+    return sorted(row[0] for row in db.engine.execute(query) if row[0])
+
+
+class Reconciler(object):
+    """ A reconciliation run, the defaults of its settings coming from CONFIG """
+
+    def __init__(self, rate=None, batch=None, grace=None, dry_run=False):
+        self.limiter = RateLimiter(CONFIG.reconcile_rate if rate is None else rate)
+        self.batch = batch or CONFIG.reconcile_batch
+        self.grace = timedelta(seconds=CONFIG.reconcile_grace if grace is None else grace)
+        self.dry_run = dry_run
+
+    def run(self, tenants=None):
+        suffix = " (dry run)" if self.dry_run else ""
+        for tenant in tenants or list_tenants():
+            try:
+                if not self.has_bucket(tenant):
+                    # every binary would look missing
+                    LOGGER.warning("%s: bucket %s not found, skipping", tenant, tenant_bucket(tenant))
+                    continue
+                switch_tenant(tenant, db)
+                sessions = self.purge_sessions(tenant)
+                uploads = self.abort_uploads(tenant)
+                unconfirmed = self.check_images(tenant)
+                orphans = self.remove_orphans(tenant)
+                patches = self.remove_patches(tenant)
+            except (StorageError, SQLAlchemyError) as err:
+                db.session.rollback()
+                LOGGER.error("%s: reconciliation failed: %s", tenant, getattr(err, 'message', err))
+                continue
+            finally:
+                db.bind_tenant(None)
+            LOGGER.info("%s: %d stale upload sessions and %d abandoned uploads removed, %d images unconfirmed, "
+                        "%d orphaned objects and %d orphaned patches removed%s",
+                        tenant, sessions, uploads, unconfirmed, orphans, patches, suffix)
+        spooled = self.remove_spooled()
+        LOGGER.info("%d binaries spooled by previous versions removed%s", spooled, suffix)
+        if not self.dry_run:
+            files = storage.remove_temporary(datetime.now(timezone.utc) - self.grace)
+            directories = BINARY_CACHE.remove_stale()
+            LOGGER.info("%d temporary files and %d cache directories of dead workers removed", files, directories)
+
+    def remove_spooled(self, directory=LEGACY_SPOOL_DIR):
+        """ Removes the binaries spooled by previous versions (never cleaned up by them), returning how many """
+        deadline = time.time() - self.grace.total_seconds()
+        try:
+            with os.scandir(directory) as scan:
+                entries = [entry for entry in scan if LEGACY_SPOOL_FILE.match(entry.name)]
+        except FileNotFoundError:
+            return 0
+        removed = 0
+        for entry in entries:
+            try:
+                if not entry.is_file(follow_symlinks=False) or entry.stat().st_mtime >= deadline:
+                    continue
+                if self.dry_run:
+                    LOGGER.info("would remove %s", entry.path)
+                else:
+                    # spooled binaries may be large, and on the same disk as the database
+                    self.limiter.wait()
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+        return removed
+
+    def has_bucket(self, tenant):
+        bucket, prefix = object_location(tenant, '')
+        self.limiter.wait()
+        try:
+            next(storage.list(bucket, prefix), None)
+        except ObjectNotFound:
+            return False
+        return True
+
+    def purge_sessions(self, tenant):
+        if self.dry_run:
+            self.limiter.wait()
+            deadline = datetime.now() - timedelta(seconds=CONFIG.upload_session_ttl)
+            stale = UploadSession.query.filter(UploadSession.updated < deadline).count()
+            db.session.rollback()
+            return stale
+        purged = 0
+        while True:
+            self.limiter.wait()
+            removed = purge_stale_sessions(storage, tenant, limit=self.batch)
+            # each session aborted its upload too
+            self.limiter.wait(removed)
+            purged += removed
+            if removed < self.batch:
+                return purged
+
+    def abort_uploads(self, tenant):
+        """ Aborts the multipart uploads of the tenant started before the session TTL that no session accounts for """
+        bucket, prefix = object_location(tenant, '')
+        deadline = datetime.now(timezone.utc) - timedelta(seconds=CONFIG.upload_session_ttl)
+        self.limiter.wait()
+        try:
+            stale = [upload for upload in storage.incomplete_uploads(bucket, prefix) if upload.initiated < deadline]
+        except ObjectNotFound:
+            return 0
+        aborted = 0
+        for start in range(0, len(stale), self.batch):
+            uploads = stale[start:start + self.batch]
+            self.limiter.wait()
+            known = set(row[0] for row in db.session.query(UploadSession.upload_id)
+                        .filter(UploadSession.upload_id.in_([upload.upload_id for upload in uploads])))
+            db.session.rollback()
+            for upload in uploads:
+                if upload.upload_id in known:
+                    continue
+                if not self.dry_run:
+                    self.limiter.wait()
+                    storage.abort_multipart(bucket, upload.object_name, upload.upload_id)
+                aborted += 1
+        return aborted
+
+    def check_images(self, tenant):
+        """ Unconfirms the images whose binary is missing from the store, returning how many """
+        unconfirmed = 0
+        last = ''
+        while True:
+            self.limiter.wait()
+            rows = db.session.query(Image.id, Image.blob, Image.segments) \
+                .filter(Image.confirmed.is_(True), Image.id > last) \
+                .order_by(Image.id).limit(self.batch).all()
+            # no transaction is kept open while the store is asked
+            db.session.rollback()
+            if not rows:
+                return unconfirmed
+            last = rows[-1].id
+            formats = {}
+            for image_id, blob, segments in rows:
+                # the compact binary is only stored for images having a segment map
+                formats.setdefault(blob or image_id, set()).update(BINARY_FORMATS if segments is not None else ['hex'])
+            for blob, blob_formats in sorted(formats.items()):
+                if not self.is_stored(tenant, blob, blob_formats):
+                    unconfirmed += self.drop_binary(tenant, blob)
+
+    def is_stored(self, tenant, blob, binary_formats):
+        for binary_format in sorted(binary_formats):
+            self.limiter.wait()
+            try:
+                storage.stat(*object_location(tenant, blob + '.' + binary_format))
+            except ObjectNotFound:
+                return False
+        return True
+
+    def drop_binary(self, tenant, blob):
+        """ Detaches a binary whose objects are missing from the images using it, returning how many there were """
+        self.limiter.wait()
+        images = Image.query.filter(Image.confirmed.is_(True),
+                                    or_(Image.blob == blob, and_(Image.blob.is_(None), Image.id == blob))).all()
+        if self.dry_run:
+            db.session.rollback()
+            return len(images)
+        for binary in Binary.query.filter_by(blob=blob).all():
+            db.session.delete(binary)
+        for orm_image in images:
+            for name in Binary.DESCRIPTION:
+                setattr(orm_image, name, None)
+            orm_image.confirmed = False
+        db.session.commit()
+        LOGGER.warning("%s: binary %s is missing, %d images unconfirmed", tenant, blob, len(images))
+        return len(images)
+
+    def stale_pages(self, tenant, prefix):
+        """ Yields the objects of the tenant found with the given name prefix, by page, leaving out the recent ones """
+        deadline = datetime.now(timezone.utc) - self.grace
+        cursor = None
+        while True:
+            self.limiter.wait()
+            try:
+                objects, cursor = list_objects_page(storage, tenant, prefix, cursor, self.batch)
+            except ObjectNotFound:
+                return
+            yield [obj for obj in objects if obj.last_modified is not None and obj.last_modified < deadline]
+            if cursor is None:
+                return
+
+    def remove_orphans(self, tenant):
+        """ Removes the binaries no image, binary or upload session refers to, returning how many objects were removed """
+        removed = 0
+        for objects in self.stale_pages(tenant, ''):
+            keys = {}
+            for obj in objects:
+                blob, _, binary_format = obj.object_name[len(tenant_prefix(tenant)):].rpartition('.')
+                if binary_format in BINARY_FORMATS:
+                    keys.setdefault(blob, []).append(obj.object_name)
+            if keys:
+                referenced = self.referenced_blobs(list(keys))
+                removed += self.remove(tenant, [key for blob, blob_keys in keys.items()
+                                                if blob not in referenced for key in blob_keys])
+        return removed
+
+    def referenced_blobs(self, blobs):
+        queries = [db.session.query(Image.blob).filter(Image.blob.in_(blobs)),
+                   db.session.query(Image.id).filter(Image.blob.is_(None), Image.id.in_(blobs)),
+                   db.session.query(Binary.blob).filter(Binary.blob.in_(blobs)),
+                   db.session.query(UploadSession.blob).filter(UploadSession.blob.in_(blobs))]
+        self.limiter.wait(len(queries))
+        referenced = set(row[0] for query in queries for row in query)
+        db.session.rollback()
+        return referenced
+
+    def remove_patches(self, tenant):
+        """ Removes the patches whose source or target image is gone, returning how many """
+        removed = 0
+        for objects in self.stale_pages(tenant, 'delta/'):
+            patches = {}
+            for obj in objects:
+                images = patch_images(obj.object_name[len(tenant_prefix(tenant)):])
+                if images is not None:
+                    patches[obj.object_name] = images
+            if patches:
+                names = set(name for images in patches.values() for name in images)
+                self.limiter.wait()
+                known = set()
+                for image_id, sha256 in db.session.query(Image.id, Image.sha256) \
+                        .filter(or_(Image.id.in_(names), Image.sha256.in_(names))):
+                    known.update((image_id, sha256))
+                db.session.rollback()
+                removed += self.remove(tenant, [key for key, images in patches.items()
+                                                if not known.issuperset(images)])
+        return removed
+
+    def remove(self, tenant, keys):
+        if not keys:
+            return 0
+        if self.dry_run:
+            for key in keys:
+                LOGGER.info("%s: would remove %s", tenant, key)
+            return len(keys)
+        self.limiter.wait()
+        failures = storage.delete(tenant_bucket(tenant), keys)
+        for key, message in failures:
+            LOGGER.error("%s: failed to remove %s: %s", tenant, key, message)
+        return len(keys) - len(failures)
+
+
+@contextmanager
+def reconcile_lock():
+    """ Tells whether this process may reconcile, holding a Postgres advisory lock (shared by every replica) meanwhile """
+    if db.engine.dialect.name != 'postgresql':
+        yield True
+        return
+    connection = db.engine.connect()
+    try:
+        acquired = connection.execute(text("SELECT pg_try_advisory_lock(:key)"), key=LOCK_KEY).scalar()
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                connection.execute(text("SELECT pg_advisory_unlock(:key)"), key=LOCK_KEY)
+    finally:
+        connection.close()
+
+
+def reconcile(tenants=None, rate=None, batch=None, grace=None, dry_run=False):
+    """ Reconciles the given tenants (all of them by default), unless another run is in progress """
+    with reconcile_lock() as acquired:
+        if not acquired:
+            LOGGER.info("another reconciliation is running, skipping")
+            return False
+        Reconciler(rate, batch, grace, dry_run).run(tenants)
+        return True
+
+
+class PeriodicReconciler(object):
+    """ Reconciles every ``interval`` seconds from a background thread, started on the first request of each worker """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.interval <= 0 or self._pid == os.getpid():
+            return
+        with self._lock:
+            # gunicorn forks its workers after import, each one starts its own thread
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        runner = threading.Thread(target=self._run)
+        runner.daemon = True
+        runner.start()
+
+    def _run(self):
+        while True:
+            # spread out so that workers started together do not all contend for the lock
+            time.sleep(self.interval * random.uniform(0.5, 1.5))
+            try:
+                reconcile()
+            except Exception as err:
+                LOGGER.error("reconciliation failed: %s", err)
+            finally:
+                db.session.remove()
+
+
+PERIODIC_RECONCILER = PeriodicReconciler(CONFIG.reconcile_interval)
+
+
+@app.before_request
+def start_reconciler():
+    PERIODIC_RECONCILER.start()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reconciles the images of each tenant with the objects stored for them")
+    parser.add_argument('-t', '--tenant', action='append', help="tenant to reconcile (default: all of them)")
+    parser.add_argument('-r', '--rate', type=float,
+                        help="requests per second sent to the database and the store, 0 for no limit "
+                             "(default: RECONCILE_RATE)")
+    parser.add_argument('-b', '--batch', type=int, help="rows or objects handled per request (default: RECONCILE_BATCH)")
+    parser.add_argument('-g', '--grace', type=int,
+                        help="seconds unreferenced objects are left alone for (default: RECONCILE_GRACE)")
+    parser.add_argument('-n', '--dry-run', action='store_true', help="only report what would be changed")
+    parser.add_argument('-i', '--interval', type=float, help="run again every INTERVAL seconds instead of once")
+    args = parser.parse_args()
+    while True:
+        reconcile(args.tenant, args.rate, args.batch, args.grace, args.dry_run)
+        if not args.interval:
+            break
+        time.sleep(args.interval)
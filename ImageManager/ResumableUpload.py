@@ -0,0 +1,83 @@
+"""
+    Resumable uploads: a binary is sent as numbered chunks, in any order and possibly in parallel,
+    each one becoming a part of a multipart upload in the object store. Failed chunks are simply
+    sent again, the store being asked which ones it already holds. Sessions idle for longer than
+    CONFIG.upload_session_ttl are garbage collected.
+"""
+
+import logging
+from datetime import datetime, timedelta
+
+from .conf import CONFIG
+from .DatabaseModels import db, UploadSession
+from .StorageBackend import MIN_PART_SIZE
+from .StorageManager import object_location
+from .utils import HTTPRequestError
+
+LOGGER = logging.getLogger('image-manager.' + __name__)
+
+# part numbers allowed by the object store
+MAX_CHUNKS = 10000
+
+
+def start_upload(storage, tenant, blob):
+    """ Starts the multipart upload of <blob>.hex, returning its id """
+    return storage.start_multipart(*object_location(tenant, blob + '.hex'))
+
+
+def put_chunk(storage, tenant, session, number, data):
+    """ Stores a chunk as part ``number`` of the session upload, replacing any previous one """
+    if not 1 <= number <= MAX_CHUNKS:
+        raise HTTPRequestError(400, "Chunk numbers go from 1 to %d" % MAX_CHUNKS)
+    if not data:
+        raise HTTPRequestError(400, "Empty chunk")
+    bucket, key = object_location(tenant, session.blob + '.hex')
+    return storage.put_part(bucket, key, session.upload_id, number, data)
+
+
+def received_chunks(storage, tenant, session):
+    """ The parts the store holds for the session, by number """
+    bucket, key = object_location(tenant, session.blob + '.hex')
+    return {part.part_number: part for part in storage.list_parts(bucket, key, session.upload_id)}
+
+
+def complete_upload(storage, tenant, session):
+    """
+        Assembles the received chunks into <blob>.hex
+
+        :raises HTTPRequestError: (400) if chunks are missing or too small
+    """
+    parts = received_chunks(storage, tenant, session)
+    if not parts:
+        raise HTTPRequestError(400, "No chunk received")
+    missing = sorted(set(range(1, max(parts) + 1)) - set(parts))
+    if missing:
+        raise HTTPRequestError(400, {'message': 'Missing chunks', 'missing': missing, 'status': 400})
+    small = [number for number, part in parts.items() if part.size < MIN_PART_SIZE and number != max(parts)]
+    if small:
+        raise HTTPRequestError(400, {'message': 'Chunks other than the last must hold at least %d bytes'
+                                                % MIN_PART_SIZE, 'chunks': small, 'status': 400})
+    bucket, key = object_location(tenant, session.blob + '.hex')
+    storage.complete_multipart(bucket, key, session.upload_id, parts)
+
+
+def abort_upload(storage, tenant, session):
+    bucket, key = object_location(tenant, session.blob + '.hex')
+    try:
+        storage.abort_multipart(bucket, key, session.upload_id)
+    except Exception as err:
+        LOGGER.error("failed to abort upload session %s: %s", session.id, err)
+
+
+def purge_stale_sessions(storage, tenant, limit=None):
+    """ Drops the upload sessions of the tenant idle for longer than CONFIG.upload_session_ttl """
+    deadline = datetime.now() - timedelta(seconds=CONFIG.upload_session_ttl)
+    query = UploadSession.query.filter(UploadSession.updated < deadline).order_by(UploadSession.updated)
+    stale = query.limit(limit).all() if limit else query.all()
+    for session in stale:
+        abort_upload(storage, tenant, session)
+        db.session.delete(session)
+    if stale:
+        db.session.commit()
+        LOGGER.info("removed %d stale upload sessions of %s", len(stale), tenant)
+    return len(stale)
@@ -2,12 +2,13 @@
 import json
 from marshmallow import Schema, fields, post_dump
 from marshmallow import ValidationError
+from marshmallow.utils import isoformat
+from werkzeug.formparser import parse_form_data
 from .utils import HTTPRequestError
+from .Metrics import timed
 import logging
 
 LOGGER = logging.getLogger('image-manager.' + __name__)
-LOGGER.addHandler(logging.StreamHandler())
-LOGGER.setLevel(logging.DEBUG)
 
 
 class ImageSchema(Schema):
@@ -18,14 +19,73 @@ class ImageSchema(Schema):
 
     fw_version = fields.String(required=True)
     confirmed = fields.Bool(required=False)
+    sha256 = fields.String(dump_only=True)
+    size = fields.Integer(dump_only=True)
+    segments = fields.List(fields.Dict(), dump_only=True)
+    encoding = fields.String(dump_only=True)
+    compressed_size = fields.Integer(dump_only=True)
+    compression_ratio = fields.Float(dump_only=True)
 
     @post_dump
     def remove_null_values(self, data):
         return {key: value for key, value in data.items() if value is not None}
 
+    @timed('serialization')
+    def dump(self, obj, *args, **kwargs):
+        return super(ImageSchema, self).dump(obj, *args, **kwargs)
+
 
 image_schema = ImageSchema()
 
+
+class ChangeSchema(Schema):
+    seq = fields.Integer(dump_only=True)
+    image_id = fields.String(dump_only=True)
+    action = fields.String(dump_only=True)
+    created = fields.DateTime(dump_only=True)
+
+
+change_schema = ChangeSchema()
+image_batch_schema = ImageSchema(many=True)
+
+
+class RowEncoder(object):
+    """
+        Precompiled equivalent of a schema dump (nulls removed) for plain column tuples.
+        Rows must hold the schema fields in declaration order, see ``columns``.
+    """
+
+    CONVERTERS = (
+        (fields.DateTime, isoformat),
+        (fields.Boolean, bool),
+        (fields.Integer, int),
+        (fields.Float, float),
+        (fields.String, str),
+        (fields.List, list),
+    )
+
+    def __init__(self, schema):
+        self.names = tuple(schema.fields)
+        self.converters = tuple(self._converter(schema.fields[name]) for name in self.names)
+
+    def _converter(self, field):
+        for field_class, converter in self.CONVERTERS:
+            if isinstance(field, field_class):
+                return converter
+        raise TypeError("No row converter for field %s" % field)
+
+    def columns(self, model):
+        return [getattr(model, name) for name in self.names]
+
+    @timed('serialization')
+    def dump_many(self, rows):
+        names, converters = self.names, self.converters
+        return [{name: convert(value) for name, convert, value in zip(names, converters, row) if value is not None}
+                for row in rows]
+
+
+image_row_encoder = RowEncoder(image_schema)
+
 ALLOWED_EXTENSIONS = set(['hex'])
 
 
@@ -34,20 +94,29 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def parse_form_payload(request):
+def parse_form_payload(request, stream_factory=None):
+    """
+        Validates the uploaded image form. If a stream_factory is given, the body is parsed with it
+        instead of being spooled by the request object (see werkzeug's parse_form_data).
+    """
     # Validate http header info
     content_type = request.headers.get('Content-Type')
     if (content_type is None) or ("multipart/form-data" not in content_type):
         raise HTTPRequestError(400, "Payload must be valid multipart/form-data, not: {}".format(
             request.headers.get('Content-Type')))
 
-    if not request.files:
+    if stream_factory is None:
+        files = request.files
+    else:
+        _, _, files = parse_form_data(request.environ, stream_factory=stream_factory)
+
+    if not files:
         raise HTTPRequestError(400, "Payload must contain a file")
 
     # Validate incoming file
-    if 'image' not in request.files:
+    if 'image' not in files:
         raise HTTPRequestError(400, "File form does not have an image field")
-    file_data = request.files['image']
+    file_data = files['image']
     if file_data.filename == '':
         raise HTTPRequestError(400, "Filename empty")
 
@@ -58,19 +127,50 @@ def parse_form_payload(request):
     return file_data
 
 
-def parse_json_payload(request, schema):
+def load_json(request):
     try:
         content_type = request.headers.get('Content-Type')
         if (content_type is None) or (content_type != "application/json"):
             raise HTTPRequestError(400, "Payload must be valid JSON, and Content-Type set accordingly")
-        json_payload = json.loads(request.data.decode('utf-8'))
+        return json.loads(request.data.decode('utf-8'))
     except ValueError:
         raise HTTPRequestError(400, "Payload must be valid JSON, and Content-Type set accordingly")
 
+
+def parse_json_list(request, max_items):
+    """ Returns the JSON array sent as payload, of at most max_items entries """
+    json_payload = load_json(request)
+    if not isinstance(json_payload, list) or not json_payload:
+        raise HTTPRequestError(400, "Payload must be a non empty JSON array")
+    if len(json_payload) > max_items:
+        raise HTTPRequestError(400, "At most %d entries per batch are allowed" % max_items)
+    return json_payload
+
+
+def parse_json_batch(request, schema, max_items):
+    """
+        Validates a JSON array of entries against a many=True schema.
+        Returns the (index, data) pairs of valid entries along with the errors of the others, by index.
+    """
+    json_payload = parse_json_list(request, max_items)
+    # entries that are not objects would be reported by the schema as a whole, without their index
+    errors = {index: {'_schema': ['Invalid input type.']}
+              for index, entry in enumerate(json_payload) if not isinstance(entry, dict)}
+    objects = [index for index in range(len(json_payload)) if index not in errors]
+    if objects:
+        entry_errors = schema.validate([json_payload[index] for index in objects])
+        errors.update((objects[position], messages) for position, messages in entry_errors.items())
+    valid = [index for index in objects if index not in errors]
+    data = schema.load([json_payload[index] for index in valid]) if valid else []
+    return list(zip(valid, data)), errors
+
+
+def parse_json_payload(request, schema):
+    json_payload = load_json(request)
+
     try:
-        print(json_payload)
         data = schema.load(json_payload)
-        print(data)
+        LOGGER.debug("%s payload: %s", schema.__class__.__name__, data)
     except ValidationError as error:
         results = {'message': 'failed to parse input', 'errors': error.messages}
         raise HTTPRequestError(400, results)
@@ -0,0 +1,468 @@
+"""
+    Storage backends: where binaries are kept, addressed as (bucket, key) pairs (see StorageManager
+    for the location of tenant objects). STORAGE_BACKEND picks one:
+
+    'minio': any S3 compatible object store, the default.
+    'filesystem': files below STORAGE_DIR, on a local disk or an NFS mount shared by the workers,
+    for deployments without object storage. Downloads are then handed to the WSGI server as files
+    (wsgi.file_wrapper), which sends them with sendfile instead of copying them through Python.
+"""
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import uuid
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from minio.error import BucketAlreadyExists, BucketAlreadyOwnedByYou, KnownResponseError, NoSuchBucket, NoSuchKey, \
+    ResponseError
+
+from .conf import CONFIG
+from .Metrics import TimedMinio
+
+# smallest part of a multipart upload but the last (an S3 limit, which every backend enforces)
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+ObjectInfo = namedtuple('ObjectInfo', ['object_name', 'size', 'etag', 'last_modified', 'metadata'])
+PartInfo = namedtuple('PartInfo', ['part_number', 'etag', 'size'])
+UploadInfo = namedtuple('UploadInfo', ['object_name', 'upload_id', 'initiated'])
+
+
+class StorageError(Exception):
+    """ The store failed to carry an operation out """
+
+    def __init__(self, message):
+        super(StorageError, self).__init__(message)
+        self.message = message
+
+
+class ObjectNotFound(StorageError):
+    """ The object (or its bucket) does not exist """
+
+
+def iter_file(data, start=0, stop=None, chunk_size=None):
+    """ Yields the [start, stop) interval of an open file, closing it when done """
+    chunk_size = chunk_size or CONFIG.download_chunk_size
+    try:
+        data.seek(start)
+        remaining = stop - start if stop is not None else None
+        while remaining is None or remaining > 0:
+            chunk = data.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+    finally:
+        data.close()
+
+
+class StorageBackend(ABC):
+    """
+        Operations the service needs from a store. Keys may contain slashes; listings come in key
+        order and, unless recursive, leave out keys holding a slash after the prefix. Backends
+        storing local files implement open() as well.
+    """
+
+    # whether objects are local files, which open() returns
+    local = False
+
+    @abstractmethod
+    def make_bucket(self, bucket):
+        """ Creates the bucket unless it exists already """
+
+    @abstractmethod
+    def remove_bucket(self, bucket):
+        """ Removes an empty bucket """
+
+    @abstractmethod
+    def put(self, bucket, key, data, content_type='application/octet-stream', metadata=None):
+        """ Stores data (bytes) as an object, returning its etag """
+
+    def get(self, bucket, key):
+        """ The whole object, as bytes """
+        return b''.join(self.stream(bucket, key))
+
+    @abstractmethod
+    def stream(self, bucket, key, offset=0, length=None, chunk_size=None):
+        """
+            Iterator over the chunks of the [offset, offset + length) interval of the object.
+            The object is looked up right away, and the iterator must be read to its end or closed.
+        """
+
+    @abstractmethod
+    def stat(self, bucket, key):
+        """ ObjectInfo of the object, last_modified being an aware datetime """
+
+    @abstractmethod
+    def list(self, bucket, prefix='', start_after='', recursive=False):
+        """ Lazy iterator over the ObjectInfo of the objects whose key starts with prefix, after start_after """
+
+    @abstractmethod
+    def delete(self, bucket, keys):
+        """ Removes the objects, missing ones included, returning the (key, message) pairs of failures """
+
+    @abstractmethod
+    def copy(self, bucket, key, source_bucket, source_key):
+        """ Copies the source object, with its content type and metadata, to key """
+
+    @abstractmethod
+    def start_multipart(self, bucket, key, content_type='application/octet-stream', metadata=None):
+        """ Starts a multipart upload, returning its id """
+
+    @abstractmethod
+    def put_part(self, bucket, key, upload_id, number, data):
+        """ Stores (or replaces) part number of the upload, returning its etag """
+
+    @abstractmethod
+    def list_parts(self, bucket, key, upload_id):
+        """ PartInfo of the parts received so far """
+
+    @abstractmethod
+    def complete_multipart(self, bucket, key, upload_id, parts):
+        """ Assembles the given parts (PartInfo, by number) into the object, returning its etag """
+
+    @abstractmethod
+    def abort_multipart(self, bucket, key, upload_id):
+        """ Drops the upload and the parts received so far """
+
+    @abstractmethod
+    def incomplete_uploads(self, bucket, prefix=''):
+        """ Lazy iterator over the UploadInfo of the multipart uploads in progress, initiated being an aware datetime """
+
+    def remove_temporary(self, older_than):
+        """ Removes files the backend left behind (partial writes) before the given aware datetime, returning how many """
+        return 0
+
+    def open(self, bucket, key):
+        """ The object as an open file, for backends storing local files """
+        raise NotImplementedError
+
+
+@contextmanager
+def minio_errors():
+    try:
+        yield
+    except (NoSuchKey, NoSuchBucket) as err:
+        raise ObjectNotFound(err.message)
+    except (ResponseError, KnownResponseError) as err:
+        raise StorageError(err.message)
+
+
+class MinioBackend(StorageBackend):
+    """ Objects kept in an S3 compatible object store, through a minio client """
+
+    def __init__(self, client):
+        self.client = client
+
+    def make_bucket(self, bucket):
+        with minio_errors():
+            try:
+                self.client.make_bucket(bucket)
+            except (BucketAlreadyOwnedByYou, BucketAlreadyExists):
+                pass
+
+    def remove_bucket(self, bucket):
+        with minio_errors():
+            self.client.remove_bucket(bucket)
+
+    def put(self, bucket, key, data, content_type='application/octet-stream', metadata=None):
+        with minio_errors():
+            return self.client.put_object(bucket, key, io.BytesIO(data), len(data),
+                                          content_type=content_type, metadata=metadata)
+
+    def stream(self, bucket, key, offset=0, length=None, chunk_size=None):
+        with minio_errors():
+            if offset or length is not None:
+                response = self.client.get_partial_object(bucket, key, offset, length or 0)
+            else:
+                response = self.client.get_object(bucket, key)
+        return self._read(response, chunk_size)
+
+    @staticmethod
+    def _read(response, chunk_size):
+        # hands the connection back to the pool once done
+        try:
+            for chunk in response.stream(chunk_size or CONFIG.download_chunk_size):
+                yield chunk
+        finally:
+            response.close()
+            response.release_conn()
+
+    def stat(self, bucket, key):
+        with minio_errors():
+            stat = self.client.stat_object(bucket, key)
+        last_modified = datetime(*stat.last_modified[:6], tzinfo=timezone.utc) if stat.last_modified else None
+        return ObjectInfo(key, stat.size, stat.etag, last_modified, stat.metadata)
+
+    def list(self, bucket, prefix='', start_after='', recursive=False):
+        with minio_errors():
+            for obj in self.client.list_objects_v2(bucket, prefix=prefix, recursive=recursive,
+                                                   start_after=start_after):
+                if not obj.is_dir:
+                    yield ObjectInfo(obj.object_name, obj.size, obj.etag, obj.last_modified, {})
+
+    def delete(self, bucket, keys):
+        with minio_errors():
+            # errors are only reported (lazily) for objects that could not be removed
+            return [(error.object_name, error.error_message) for error in self.client.remove_objects(bucket, keys)]
+
+    def copy(self, bucket, key, source_bucket, source_key):
+        with minio_errors():
+            self.client.copy_object(bucket, key, '/%s/%s' % (source_bucket, source_key))
+
+    def start_multipart(self, bucket, key, content_type='application/octet-stream', metadata=None):
+        with minio_errors():
+            return self.client._new_multipart_upload(bucket, key, dict(metadata or {}, **{'Content-Type': content_type}))
+
+    def put_part(self, bucket, key, upload_id, number, data):
+        with minio_errors():
+            return self.client._do_put_object(bucket, key, data, len(data), upload_id, number)
+
+    def list_parts(self, bucket, key, upload_id):
+        with minio_errors():
+            return [PartInfo(part.part_number, part.etag, part.size)
+                    for part in self.client._list_object_parts(bucket, key, upload_id)]
+
+    def complete_multipart(self, bucket, key, upload_id, parts):
+        with minio_errors():
+            return self.client._complete_multipart_upload(bucket, key, upload_id, parts).etag
+
+    def abort_multipart(self, bucket, key, upload_id):
+        with minio_errors():
+            self.client._remove_incomplete_upload(bucket, key, upload_id)
+
+    def incomplete_uploads(self, bucket, prefix=''):
+        with minio_errors():
+            for upload in self.client._list_incomplete_uploads(bucket, prefix, recursive=True,
+                                                               is_aggregate_size=False):
+                yield UploadInfo(upload.object_name, upload.upload_id, upload.initiated)
+
+
+class FilesystemBackend(StorageBackend):
+    """
+        Objects kept as files, root/<bucket>/<key>, their etag and metadata as JSON documents in
+        root/.meta/<bucket>/<key>. Objects are written to root/.tmp and moved in place once complete,
+        so readers never see partial files; multipart uploads keep their parts in root/.uploads.
+    """
+
+    local = True
+
+    def __init__(self, root):
+        self.root = root
+        for directory in ('.meta', '.tmp', '.uploads'):
+            os.makedirs(os.path.join(root, directory), exist_ok=True)
+
+    def _path(self, bucket, key='', area=None):
+        names = key.split('/') if key else []
+        if not bucket or '/' in bucket or bucket.startswith('.') or any(n in ('', '.', '..') for n in names):
+            raise StorageError("Invalid object name: %s/%s" % (bucket, key))
+        return os.path.join(self.root, *([area] if area else []) + [bucket] + names)
+
+    def _upload_path(self, upload_id, name=''):
+        if not upload_id or not all(c in '0123456789abcdef' for c in upload_id):
+            raise ObjectNotFound("No such upload: %s" % upload_id)
+        return os.path.join(self.root, '.uploads', upload_id, name)
+
+    def _temp_path(self):
+        return os.path.join(self.root, '.tmp', uuid.uuid4().hex)
+
+    def _write(self, path, chunks):
+        """ Writes the chunks to path atomically, returning the MD5 of the contents """
+        digest = hashlib.md5()
+        temp_path = self._temp_path()
+        try:
+            with open(temp_path, 'wb') as output:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    output.write(chunk)
+                output.flush()
+                os.fsync(output.fileno())
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return digest.hexdigest()
+
+    def _store(self, bucket, key, chunks, content_type, metadata):
+        if not os.path.isdir(self._path(bucket)):
+            raise ObjectNotFound("No such bucket: %s" % bucket)
+        etag = self._write(self._path(bucket, key), chunks)
+        description = {'etag': etag, 'content_type': content_type, 'metadata': metadata or {}}
+        self._write(self._path(bucket, key, '.meta'), [json.dumps(description).encode()])
+        return etag
+
+    def _describe(self, bucket, key):
+        try:
+            with open(self._path(bucket, key, '.meta')) as description:
+                return json.load(description)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def make_bucket(self, bucket):
+        os.makedirs(self._path(bucket), exist_ok=True)
+
+    def remove_bucket(self, bucket):
+        try:
+            os.rmdir(self._path(bucket))
+        except FileNotFoundError:
+            raise ObjectNotFound("No such bucket: %s" % bucket)
+        except OSError as err:
+            raise StorageError("Cannot remove %s: %s" % (bucket, err))
+        shutil.rmtree(self._path(bucket, area='.meta'), ignore_errors=True)
+
+    def put(self, bucket, key, data, content_type='application/octet-stream', metadata=None):
+        return self._store(bucket, key, [data], content_type, metadata)
+
+    def open(self, bucket, key):
+        try:
+            return open(self._path(bucket, key), 'rb')
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            raise ObjectNotFound("No such object: %s/%s" % (bucket, key))
+
+    def stream(self, bucket, key, offset=0, length=None, chunk_size=None):
+        stop = offset + length if length is not None else None
+        return iter_file(self.open(bucket, key), offset, stop, chunk_size)
+
+    def stat(self, bucket, key):
+        try:
+            stat = os.stat(self._path(bucket, key))
+        except (FileNotFoundError, NotADirectoryError):
+            raise ObjectNotFound("No such object: %s/%s" % (bucket, key))
+        description = self._describe(bucket, key)
+        metadata = dict(description.get('metadata', {}))
+        metadata['Content-Type'] = description.get('content_type', 'application/octet-stream')
+        # files put in place by hand have no description: their size and mtime stand for an etag
+        etag = description.get('etag') or '%x-%x' % (stat.st_mtime_ns, stat.st_size)
+        return ObjectInfo(key, stat.st_size, etag, datetime.fromtimestamp(stat.st_mtime, timezone.utc), metadata)
+
+    def list(self, bucket, prefix='', start_after='', recursive=False):
+        base = self._path(bucket)
+        if not os.path.isdir(base):
+            raise ObjectNotFound("No such bucket: %s" % bucket)
+        directory = prefix.rpartition('/')[0]
+        top = os.path.join(base, *directory.split('/')) if directory else base
+        keys = []
+        for path, subdirectories, files in os.walk(top):
+            relative = os.path.relpath(path, base).replace(os.sep, '/')
+            relative = '' if relative == '.' else relative + '/'
+            keys += [relative + name for name in files]
+            if not recursive:
+                break
+        for key in sorted(k for k in keys if k.startswith(prefix) and k > start_after):
+            try:
+                yield self.stat(bucket, key)
+            except ObjectNotFound:
+                # removed while listing
+                continue
+
+    def delete(self, bucket, keys):
+        errors = []
+        for key in keys:
+            for area in (None, '.meta'):
+                try:
+                    os.remove(self._path(bucket, key, area))
+                except FileNotFoundError:
+                    pass
+                except (OSError, StorageError) as err:
+                    errors.append((key, str(err)))
+                    break
+        return errors
+
+    def copy(self, bucket, key, source_bucket, source_key):
+        description = self._describe(source_bucket, source_key)
+        self._store(bucket, key, self.stream(source_bucket, source_key),
+                    description.get('content_type', 'application/octet-stream'), description.get('metadata'))
+
+    def start_multipart(self, bucket, key, content_type='application/octet-stream', metadata=None):
+        self._path(bucket, key)
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self._upload_path(upload_id))
+        description = {'bucket': bucket, 'key': key, 'content_type': content_type, 'metadata': metadata or {}}
+        self._write(self._upload_path(upload_id, 'upload.json'), [json.dumps(description).encode()])
+        return upload_id
+
+    def _upload(self, upload_id):
+        try:
+            with open(self._upload_path(upload_id, 'upload.json')) as description:
+                return json.load(description)
+        except FileNotFoundError:
+            raise ObjectNotFound("No such upload: %s" % upload_id)
+
+    def put_part(self, bucket, key, upload_id, number, data):
+        self._upload(upload_id)
+        etag = hashlib.md5(data).hexdigest()
+        # the etag file goes first: parts on disk always have one
+        self._write(self._upload_path(upload_id, '%d.etag' % number), [etag.encode()])
+        self._write(self._upload_path(upload_id, str(number)), [data])
+        return etag
+
+    def list_parts(self, bucket, key, upload_id):
+        self._upload(upload_id)
+        parts = []
+        for name in sorted(os.listdir(self._upload_path(upload_id)), key=lambda n: (len(n), n)):
+            if name.isdigit():
+                try:
+                    with open(self._upload_path(upload_id, name + '.etag')) as etag:
+                        parts.append(PartInfo(int(name), etag.read(),
+                                              os.path.getsize(self._upload_path(upload_id, name))))
+                except FileNotFoundError:
+                    continue
+        return parts
+
+    def complete_multipart(self, bucket, key, upload_id, parts):
+        upload = self._upload(upload_id)
+        received = {part.part_number: part for part in self.list_parts(bucket, key, upload_id)}
+        for number, part in parts.items():
+            if number not in received or received[number].etag != part.etag:
+                raise StorageError("Invalid part %d of upload %s" % (number, upload_id))
+
+        def chunks():
+            for number in sorted(parts):
+                yield from iter_file(open(self._upload_path(upload_id, str(number)), 'rb'))
+
+        etag = self._store(bucket, key, chunks(), upload['content_type'], upload['metadata'])
+        shutil.rmtree(self._upload_path(upload_id), ignore_errors=True)
+        return etag
+
+    def abort_multipart(self, bucket, key, upload_id):
+        shutil.rmtree(self._upload_path(upload_id), ignore_errors=True)
+
+    def incomplete_uploads(self, bucket, prefix=''):
+        self._path(bucket)
+        for upload_id in sorted(os.listdir(os.path.join(self.root, '.uploads'))):
+            try:
+                upload = self._upload(upload_id)
+                initiated = os.stat(self._upload_path(upload_id, 'upload.json')).st_mtime
+            except (ObjectNotFound, FileNotFoundError, ValueError):
+                # completed or aborted meanwhile, or not started through start_multipart
+                continue
+            if upload.get('bucket') == bucket and upload.get('key', '').startswith(prefix):
+                yield UploadInfo(upload['key'], upload_id, datetime.fromtimestamp(initiated, timezone.utc))
+
+    def remove_temporary(self, older_than):
+        removed = 0
+        directory = os.path.join(self.root, '.tmp')
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                if datetime.fromtimestamp(os.stat(path).st_mtime, timezone.utc) < older_than:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                # renamed into place meanwhile
+                continue
+        return removed
+
+
+def create_backend():
+    """ The backend selected by CONFIG.storage_backend """
+    if CONFIG.storage_backend == 'filesystem':
+        return FilesystemBackend(CONFIG.storage_dir)
+    return MinioBackend(TimedMinio(CONFIG.s3url, CONFIG.s3user, CONFIG.s3pass, secure=False))
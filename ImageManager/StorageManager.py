@@ -0,0 +1,57 @@
+"""
+    Where tenant objects live in the object store.
+    With schema-per-tenant storage every tenant owns a bucket named after it; in shared mode all
+    tenants share a single bucket and their objects are kept under a "<tenant>/" key prefix.
+"""
+
+import base64
+import binascii
+from itertools import islice
+
+from .conf import CONFIG
+from .utils import HTTPRequestError
+
+
+def shared_tenancy():
+    return CONFIG.tenancy_mode == 'shared'
+
+
+def tenant_bucket(tenant):
+    return CONFIG.shared_bucket if shared_tenancy() else tenant
+
+
+def tenant_prefix(tenant):
+    return tenant + '/' if shared_tenancy() else ''
+
+
+def object_location(tenant, object_name):
+    """ Returns the (bucket, key) pair holding the given tenant object """
+    return tenant_bucket(tenant), tenant_prefix(tenant) + object_name
+
+
+def encode_object_cursor(object_name):
+    """ Opaque pagination cursor pointing right after the given (tenant relative) object name """
+    return base64.urlsafe_b64encode(object_name.encode()).decode()
+
+
+def decode_object_cursor(cursor):
+    try:
+        return base64.b64decode(cursor.encode(), altchars=b'-_', validate=True).decode()
+    except (ValueError, binascii.Error):
+        raise HTTPRequestError(400, 'Invalid pagination cursor')
+
+
+def list_objects_page(storage, tenant, prefix='', cursor=None, page_size=1000):
+    """
+        Lists the tenant objects whose name starts with prefix, in name order, after the cursor.
+        The object store sends listings in pages of its own (of up to 1000 keys), which are only
+        requested as the page is read. Returns the page (ObjectInfo, objects in "directories" left
+        out) and the cursor of the next one (None on the last page).
+    """
+    bucket, key_prefix = object_location(tenant, prefix)
+    start_after = object_location(tenant, decode_object_cursor(cursor))[1] if cursor else ''
+    objects = list(islice(storage.list(bucket, prefix=key_prefix, start_after=start_after), page_size + 1))
+    if len(objects) > page_size:
+        last = objects[page_size - 1].object_name[len(tenant_prefix(tenant)):]
+        return objects[:page_size], encode_object_cursor(last)
+    return objects, None
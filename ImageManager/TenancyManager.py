@@ -1,8 +1,53 @@
 import base64
 import json
+import threading
+import time
+from functools import lru_cache
+import sqlalchemy
 from sqlalchemy.sql import exists, select, text
-from minio.error import (ResponseError, BucketAlreadyOwnedByYou, BucketAlreadyExists)
 from .utils import HTTPRequestError
+from .conf import CONFIG
+from .StorageManager import tenant_bucket
+from .Metrics import timed
+
+
+class TenantRegistry(object):
+    """
+        Per-process record of tenants whose Postgres schema and storage bucket are known to exist.
+
+        Entries expire after ``ttl`` seconds so that tenants removed behind our back are
+        eventually provisioned again; ``invalidate`` drops them immediately.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._ready = {}
+        self._lock = threading.Lock()
+
+    def is_ready(self, tenant):
+        with self._lock:
+            expires = self._ready.get(tenant)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self._ready[tenant]
+                return False
+            return True
+
+    def mark_ready(self, tenant):
+        with self._lock:
+            self._ready[tenant] = time.monotonic() + self.ttl
+
+    def invalidate(self, tenant=None):
+        """ Forgets the given tenant, or every tenant if none is given """
+        with self._lock:
+            if tenant is None:
+                self._ready.clear()
+            else:
+                self._ready.pop(tenant, None)
+
+
+TENANT_REGISTRY = TenantRegistry(CONFIG.tenant_cache_ttl)
 
 
 def decode_base64(data):
@@ -17,6 +62,8 @@ def decode_base64(data):
         data += '=' * (4 - missing_padding)
     return base64.decodebytes(data.encode()).decode()
 
+
+@lru_cache(maxsize=CONFIG.token_cache_size)
 def get_allowed_service(token):
     """
         Parses the authorization token, returning the service to be used when
@@ -41,44 +88,98 @@ def create_tenant(tenant, db):
     db.session.execute("create schema \"%s\";" % tenant)
 
 
+def list_tenant_schemas(db):
+    """ Schemas holding an images table, that is, tenants provisioned in schema mode """
+    query = text("SELECT table_schema FROM information_schema.tables "
+                 "WHERE table_name = 'images' AND table_schema NOT IN ('public', 'information_schema')")
+    return sorted(row[0] for row in db.engine.execute(query))
+
+
 def switch_tenant(tenant, db):
-    db.session.execute("SET search_path TO %s" % tenant)
+    """
+        Makes every following query of this context run inside the tenant schema, or restricted to
+        the tenant rows in shared tenancy mode (no round trip involved)
+    """
+    db.bind_tenant(tenant)
+
+
+def upgrade_tenant(tenant, db):
+    """
+        Brings an existing tenant schema (or the shared tables) up to date with the models: creates
+        missing tables, and adds the columns and indexes introduced after the schema was created
+        (create_all leaves existing tables alone)
+    """
+    schema = None if db.shared_tables else tenant
+    connection = db.session.connection()
+    db.Model.metadata.create_all(bind=connection)
+    inspector = sqlalchemy.inspect(connection)
+    for table in db.Model.metadata.sorted_tables:
+        qualified = table.name if schema is None else '"%s".%s' % (schema, table.name)
+        existing = set(c['name'] for c in inspector.get_columns(table.name, schema=schema))
+        for column in table.columns:
+            if column.name not in existing:
+                db.session.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    qualified, column.name, column.type.compile(dialect=connection.dialect)))
+        indexes = set(i['name'] for i in inspector.get_indexes(table.name, schema=schema))
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(bind=connection)
     db.session.commit()
 
 
-def init_tenant(tenant, db, minioClient):
-    # Check if Postgres schema exists
-    query = exists(select([text("schema_name")])
-                   .select_from(text("information_schema.schemata"))
-                   .where(text("schema_name = '%s'" % tenant)))
-    tenant_exists = db.session.query(query).scalar()
+def upgrade_tenants(db):
+    """
+        Runs upgrade_tenant over the shared tables, or over every tenant schema. Meant to run once
+        when the service is deployed (see TenancyMigration), never on the request path.
+    """
+    if db.shared_tables:
+        upgrade_tenant(None, db)
+        return
+    for tenant in list_tenant_schemas(db):
+        switch_tenant(tenant, db)
+        upgrade_tenant(tenant, db)
+    db.bind_tenant(None)
+
+
+def invalidate_tenant(tenant=None):
+    """ Forces the next request of the given tenant (or of all tenants) to re-check its schema and bucket """
+    TENANT_REGISTRY.invalidate(tenant)
+
+
+def init_tenant(tenant, db, storage):
+    switch_tenant(tenant, db)
+    if TENANT_REGISTRY.is_ready(tenant):
+        return
+
+    if db.shared_tables:
+        tenant_exists = True
+    else:
+        # Check if Postgres schema exists
+        query = exists(select([text("schema_name")])
+                       .select_from(text("information_schema.schemata"))
+                       .where(text("schema_name = '%s'" % tenant)))
+        tenant_exists = db.session.query(query).scalar()
 
     if not tenant_exists:
         create_tenant(tenant, db)
-        switch_tenant(tenant, db)
-        db.create_all()
+        # the session connection is bound to the tenant schema, see switch_tenant
+        db.Model.metadata.create_all(bind=db.session.connection())
+        db.session.commit()
         # install_triggers(db)
-    else:
-        switch_tenant(tenant, db)
 
-    # Check if Minio Bucket exists
-    try:
-        # TODO Set bucket location
-        minioClient.make_bucket(tenant)
-    except BucketAlreadyOwnedByYou as err:
-        pass
-    except BucketAlreadyExists as err:
-        pass
-    except ResponseError as err:
-        raise
+    # TODO Set bucket location
+    storage.make_bucket(tenant_bucket(tenant))
+
+    TENANT_REGISTRY.mark_ready(tenant)
 
 
-def init_tenant_context(request, db, minioClient):
+@timed('tenant_init')
+def init_tenant_context(request, db, storage):
     try:
         token = request.headers['authorization']
     except KeyError:
         raise HTTPRequestError(401, "No authorization token has been supplied")
 
     tenant = get_allowed_service(token)
-    init_tenant(tenant, db, minioClient)
+    init_tenant(tenant, db, storage)
     return tenant
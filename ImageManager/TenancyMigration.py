@@ -0,0 +1,116 @@
+"""
+    Moves images kept with schema-per-tenant storage into the shared tables and bucket.
+
+    Must run with the same environment as the service and TENANCY_MODE=shared, e.g.:
+        TENANCY_MODE=shared python3 -m ImageManager.TenancyMigration --tenant admin --dry-run
+
+    Rows are copied in batches (keyset on their primary key) and rows already present in the shared
+    tables are skipped, so an interrupted migration can simply be run again. Source schemas and buckets are
+    left untouched unless --remove-source is given.
+
+    With --upgrade, existing tenant schemas (or the shared tables) are only brought up to date with the
+    models instead, which docker/entrypoint.sh does before starting the service:
+        python3 -m ImageManager.TenancyMigration --upgrade
+"""
+
+import argparse
+import logging
+import sqlalchemy
+from sqlalchemy import select
+
+from .conf import CONFIG
+from .DatabaseModels import db, storage
+from .StorageBackend import ObjectNotFound
+from .TenancyManager import list_tenant_schemas, upgrade_tenant, upgrade_tenants
+
+LOGGER = logging.getLogger('image-manager.' + __name__)
+
+
+def migrate_rows(table, tenant, batch, dry_run):
+    if not table.info.get('migrate', True):
+        # per tenant bookkeeping (collection versions, change feed) starts over in the shared tables
+        return 0, 0
+    source = db.tenant_engine(tenant, db.engine)
+    inspector = sqlalchemy.inspect(db.engine)
+    if table.name not in inspector.get_table_names(schema=tenant):
+        return 0, 0
+    existing = set(c['name'] for c in inspector.get_columns(table.name, schema=tenant))
+    columns = [c for c in table.columns if c.name in existing]
+    key = [c for c in table.primary_key.columns if c.name != 'tenant'][0]
+
+    copied = skipped = 0
+    last = ''
+    while True:
+        rows = source.execute(select(columns).where(key > last)
+                              .order_by(key).limit(batch)).fetchall()
+        if not rows:
+            break
+        last = rows[-1][key.name]
+
+        ids = [row[key.name] for row in rows]
+        present = set(r[0] for r in db.engine.execute(
+            select([key]).where(key.in_(ids)).where(table.c.tenant == tenant)))
+        records = [dict(row, tenant=tenant) for row in rows if row[key.name] not in present]
+        skipped += len(rows) - len(records)
+        copied += len(records)
+        if records and not dry_run:
+            db.engine.execute(table.insert(), records)
+    return copied, skipped
+
+
+def migrate_objects(tenant, dry_run):
+    copied = 0
+    try:
+        objects = list(storage.list(tenant, recursive=True))
+    except ObjectNotFound:
+        return 0, []
+    for obj in objects:
+        if not dry_run:
+            storage.copy(CONFIG.shared_bucket, tenant + '/' + obj.object_name, tenant, obj.object_name)
+        copied += 1
+    return copied, [obj.object_name for obj in objects]
+
+
+def remove_source(tenant, object_names):
+    if object_names:
+        for key, message in storage.delete(tenant, object_names):
+            LOGGER.error("failed to remove %s/%s: %s", tenant, key, message)
+    storage.remove_bucket(tenant)
+    db.engine.execute('DROP SCHEMA "%s" CASCADE' % tenant)
+
+
+def migrate(tenants=None, batch=500, dry_run=False, remove=False):
+    if not db.shared_tables:
+        raise SystemExit("Set TENANCY_MODE=shared to migrate into the shared tables")
+
+    if not dry_run:
+        upgrade_tenant(None, db)
+        storage.make_bucket(CONFIG.shared_bucket)
+
+    for tenant in tenants or list_tenant_schemas(db):
+        for table in db.Model.metadata.sorted_tables:
+            rows, skipped = migrate_rows(table, tenant, batch, dry_run)
+            LOGGER.info("%s: %d %s copied, %d already migrated%s",
+                        tenant, rows, table.name, skipped, " (dry run)" if dry_run else "")
+        objects, names = migrate_objects(tenant, dry_run)
+        LOGGER.info("%s: %d objects copied%s", tenant, objects, " (dry run)" if dry_run else "")
+        if remove and not dry_run:
+            remove_source(tenant, names)
+            LOGGER.info("%s: source schema and bucket removed", tenant)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Migrates schema-per-tenant images into shared tenancy storage")
+    parser.add_argument('-t', '--tenant', action='append', help="tenant to migrate (default: all of them)")
+    parser.add_argument('-b', '--batch', default=500, type=int, help="rows copied per statement")
+    parser.add_argument('-n', '--dry-run', action='store_true', help="only report what would be copied")
+    parser.add_argument('--remove-source', action='store_true',
+                        help="drop the tenant schema and bucket once copied")
+    parser.add_argument('--upgrade', action='store_true',
+                        help="only add the tables, columns and indexes missing from existing tenants")
+    args = parser.parse_args()
+    if args.upgrade:
+        upgrade_tenants(db)
+        LOGGER.info("tenant schemas up to date")
+    else:
+        migrate(args.tenant, args.batch, args.dry_run, args.remove_source)
@@ -0,0 +1,245 @@
+"""
+    Single pass upload pipeline for image binaries.
+    The request body is read once: every chunk handed over by the multipart parser is hashed, counted,
+    decoded as Intel HEX and pushed to the object store, holding at most one multipart part (per
+    object) in memory and never touching disk. Next to the original file, the data it encodes is
+    stored as a compact ``<blob>.bin`` whose layout is described by the parser segment map.
+    Both objects may be compressed on the way (see Compression).
+
+    Objects are only completed on commit: uploads whose contents turn out to be stored already are
+    aborted instead, leaving nothing behind (see Binary).
+"""
+
+import base64
+import binascii
+import hashlib
+import logging
+
+from .conf import CONFIG
+from .Compression import EncodingWriter
+from .IntelHex import IntelHexParser, IntelHexError
+from .SerializationModels import allowed_file
+from .StorageBackend import MIN_PART_SIZE, PartInfo
+from .StorageManager import object_location
+from .utils import HTTPRequestError
+
+LOGGER = logging.getLogger('image-manager.' + __name__)
+
+
+class ObjectWriter(object):
+    """
+        Writes a stream of unknown length to the store.
+        Objects smaller than a part are sent with a single put, larger ones as a multipart upload.
+    """
+
+    def __init__(self, storage, bucket, object_name, part_size=None,
+                 content_type='application/octet-stream', metadata=None):
+        self.storage = storage
+        self.bucket = bucket
+        self.object_name = object_name
+        self.part_size = max(part_size or CONFIG.upload_part_size, MIN_PART_SIZE)
+        self.content_type = content_type
+        self.metadata = metadata or {}
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = {}
+
+    def write(self, data):
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._put_part(part)
+
+    def _put_part(self, part):
+        if self._upload_id is None:
+            self._upload_id = self.storage.start_multipart(self.bucket, self.object_name, self.content_type,
+                                                           self.metadata)
+        number = len(self._parts) + 1
+        etag = self.storage.put_part(self.bucket, self.object_name, self._upload_id, number, part)
+        self._parts[number] = PartInfo(number, etag, len(part))
+
+    def close(self):
+        """ Flushes whatever is buffered and finishes the object, returning its etag """
+        if self._upload_id is None:
+            etag = self.storage.put(self.bucket, self.object_name, bytes(self._buffer),
+                                    content_type=self.content_type, metadata=self.metadata)
+        else:
+            if self._buffer:
+                self._put_part(bytes(self._buffer))
+            etag = self.storage.complete_multipart(self.bucket, self.object_name, self._upload_id, self._parts)
+            self._upload_id = None
+        self._buffer = bytearray()
+        return etag
+
+    def abort(self):
+        """ Drops buffered data and any parts already sent """
+        self._buffer = bytearray()
+        if self._upload_id is not None:
+            try:
+                self.storage.abort_multipart(self.bucket, self.object_name, self._upload_id)
+            except Exception as err:
+                LOGGER.error("failed to abort upload of %s: %s", self.object_name, err)
+            self._upload_id = None
+
+
+def requested_digest(request):
+    """
+        The SHA-256 (hex) announced by the client in a ``Digest: SHA-256=<base64>`` header, if any
+
+        :raises HTTPRequestError: (400) if the digest is malformed
+    """
+    for digest in request.headers.get('Digest', '').split(','):
+        algorithm, _, value = digest.strip().partition('=')
+        if algorithm.lower() == 'sha-256':
+            try:
+                decoded = base64.b64decode(value, validate=True)
+            except binascii.Error:
+                decoded = b''
+            if len(decoded) != hashlib.sha256().digest_size:
+                raise HTTPRequestError(400, "Invalid SHA-256 Digest header")
+            return decoded.hex()
+    return None
+
+
+class NullSink(object):
+    """ Swallows file parts we are not interested in """
+
+    def write(self, data):
+        pass
+
+    def seek(self, offset, whence=0):
+        pass
+
+    def read(self, size=-1):
+        return b''
+
+    def close(self):
+        pass
+
+
+class BinaryUpload(object):
+    """
+        File-like target for werkzeug's multipart parser (see ``stream_factory``).
+        The first acceptable file in the form is hashed (SHA-256), measured, checked to be valid
+        Intel HEX and written to ``<blob>.<extension>`` as it arrives, its decoded data to
+        ``<blob>.bin``; both are compressed with ``encoding`` if one is given. Invalid files are
+        detected as soon as the faulty record arrives; nothing else is written from then on and
+        commit() fails.
+
+        Uploads created with ``store=False`` (contents known to be stored already) are only hashed.
+    """
+
+    def __init__(self, storage, tenant, blob, encoding=None, store=True):
+        self.storage = storage
+        self.tenant = tenant
+        self.blob = blob
+        self.encoding = encoding
+        self.store = store
+        self.filename = None
+        self.object_name = None
+        self.size = 0
+        self.segments = None
+        self.error = None
+        self._hash = hashlib.sha256()
+        self._parser = IntelHexParser()
+        self._writer = None
+        self._bin_writer = None
+
+    def stream_factory(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.filename is not None or not filename or not allowed_file(filename):
+            return NullSink()
+        self.filename = filename
+        self.object_name = self.blob + '.' + filename.rsplit('.', 1)[1].lower()
+        if self.store:
+            self._writer = self._open(self.object_name)
+            self._bin_writer = self._open(self.blob + '.bin')
+        return self
+
+    def _open(self, object_name):
+        bucket, key = object_location(self.tenant, object_name)
+        if self.encoding is None:
+            return ObjectWriter(self.storage, bucket, key)
+        writer = ObjectWriter(self.storage, bucket, key, metadata={'Content-Encoding': self.encoding})
+        return EncodingWriter(writer, self.encoding)
+
+    def write(self, data):
+        if self.error is not None:
+            return
+        if self.store:
+            try:
+                decoded = self._parser.feed(data)
+            except IntelHexError as err:
+                self.error = str(err)
+                return
+            if self._writer is not None:
+                self._writer.write(data)
+            self._bin_writer.write(decoded)
+        self._hash.update(data)
+        self.size += len(data)
+
+    def seek(self, offset, whence=0):
+        # the parser rewinds the container once the part is over; nothing to rewind here
+        pass
+
+    def read(self, size=-1):
+        return b''
+
+    def close(self):
+        pass
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+    @property
+    def bin_size(self):
+        return self._parser.size
+
+    @property
+    def stored_size(self):
+        """ Bytes the original file takes in the store """
+        return self._writer.size if self.encoding is not None else self.size
+
+    def commit(self):
+        """
+            Finishes the objects in the store, returning the etag of the original file
+
+            :raises HTTPRequestError: (400) if the file is not valid Intel HEX
+        """
+        if self.error is None:
+            try:
+                self.segments = self._parser.close()
+            except IntelHexError as err:
+                self.error = str(err)
+        if self.error is not None:
+            raise HTTPRequestError(400, "Invalid Intel HEX file: " + self.error)
+        self._bin_writer.close()
+        if self._writer is not None:
+            return self._writer.close()
+
+    def abort(self):
+        for writer in (self._writer, self._bin_writer):
+            if writer is not None:
+                writer.abort()
+
+
+def process_stored(storage, tenant, blob):
+    """
+        Runs a file that reached the store without going through the service (presigned uploads,
+        stored as ``<blob>.hex``) through the same pipeline, reading it back once. The file itself is
+        left as it is, so the compact binary is not compressed either. Returns the upload, still to
+        be committed.
+    """
+    upload = BinaryUpload(storage, tenant, blob)
+    upload.object_name = blob + '.hex'
+    upload._bin_writer = upload._open(blob + '.bin')
+    chunks = storage.stream(*object_location(tenant, upload.object_name))
+    try:
+        for chunk in chunks:
+            upload.write(chunk)
+            if upload.error is not None:
+                break
+    finally:
+        chunks.close()
+    return upload
@@ -1,6 +1,8 @@
 """ Service configuration module """
 
+import logging
 import os
+from jsonlogging import JSONFormatter
 
 
 class Config(object):
@@ -13,18 +15,144 @@ class Config(object):
                  dbpass=None,
                  dbdriver="postgresql+psycopg2",
                  create_db=True,
+                 tenancy_mode='schema',
+                 shared_bucket='images',
+                 db_pool_size=10,
+                 db_max_overflow=10,
+                 db_pool_timeout=30,
+                 db_pool_recycle=1800,
+                 db_pool_pre_ping=True,
                  s3url='minio:9000',
                  s3user='9HEODSF6WQN5EZ39DM7Z',
-                 s3pass='fT5nAgHR9pkj0yYsBdc4p+PPq6ArjshcPdz0HA6W'):
+                 s3pass='fT5nAgHR9pkj0yYsBdc4p+PPq6ArjshcPdz0HA6W',
+                 s3public_url=None,
+                 s3region='us-east-1',
+                 storage_backend='minio',
+                 storage_dir='/var/lib/image-manager',
+                 binary_delivery='stream',
+                 presign_expiry=300,
+                 tenant_cache_ttl=300,
+                 token_cache_size=1024,
+                 download_chunk_size=64 * 1024,
+                 upload_part_size=5 * 1024 * 1024,
+                 compression='gzip',
+                 compression_level=6,
+                 delta_workers=2,
+                 delta_max_size=64 * 1024 * 1024,
+                 delta_retry_after=5,
+                 max_chunk_size=64 * 1024 * 1024,
+                 upload_session_ttl=24 * 60 * 60,
+                 binary_cache_dir='/tmp/image-manager',
+                 binary_cache_size=256 * 1024 * 1024,
+                 max_page_size=1000,
+                 max_batch_size=1000,
+                 change_poll_interval=1,
+                 max_change_wait=60,
+                 change_stream_timeout=300,
+                 metadata_cache_size=10000,
+                 metadata_cache_ttl=10,
+                 metadata_cache_channel='',
+                 log_level='INFO',
+                 profiler_token='',
+                 profile_dir='/tmp/image-manager-profiles',
+                 reconcile_interval=0,
+                 reconcile_rate=20,
+                 reconcile_batch=500,
+                 reconcile_grace=60 * 60):
         self.dbname = os.environ.get('DBNAME', db)
         self.dbhost = os.environ.get('DBHOST', dbhost)
         self.dbuser = os.environ.get('DBUSER', dbuser)
         self.dbpass = os.environ.get('DBPASS', dbpass)
         self.dbdriver = os.environ.get('DBDRIVER', dbdriver)
         self.create_db = os.environ.get('CREATE_DB', create_db)
+        # 'schema': one Postgres schema and one bucket per tenant
+        # 'shared': a single images table (scoped by its tenant column) and a single bucket
+        self.tenancy_mode = os.environ.get('TENANCY_MODE', tenancy_mode)
+        if self.tenancy_mode not in ('schema', 'shared'):
+            raise ValueError("TENANCY_MODE must be either 'schema' or 'shared'")
+        self.shared_bucket = os.environ.get('SHARED_BUCKET', shared_bucket)
+        self.db_pool_size = int(os.environ.get('DB_POOL_SIZE', db_pool_size))
+        self.db_max_overflow = int(os.environ.get('DB_MAX_OVERFLOW', db_max_overflow))
+        self.db_pool_timeout = int(os.environ.get('DB_POOL_TIMEOUT', db_pool_timeout))
+        self.db_pool_recycle = int(os.environ.get('DB_POOL_RECYCLE', db_pool_recycle))
+        self.db_pool_pre_ping = str(os.environ.get('DB_POOL_PRE_PING', db_pool_pre_ping)).lower() in ('true', '1')
         self.s3url = os.environ.get('S3URL', s3url)
         self.s3user = os.environ.get('S3ACCESSKEY', s3user)
         self.s3pass = os.environ.get('S3SECRETKEY', s3pass)
+        # object store endpoint as seen by devices (e.g. https://files.example.com), defaults to s3url
+        self.s3public_url = os.environ.get('S3PUBLICURL', s3public_url) or self.s3url
+        # presigned URLs are signed for this region, without asking the object store for it
+        self.s3region = os.environ.get('S3REGION', s3region)
+        # where binaries are kept (see StorageBackend): 'minio' (S3 compatible object store) or
+        # 'filesystem' (files below storage_dir, local or NFS, sent with sendfile)
+        self.storage_backend = os.environ.get('STORAGE_BACKEND', storage_backend)
+        if self.storage_backend not in ('minio', 'filesystem'):
+            raise ValueError("STORAGE_BACKEND must be either 'minio' or 'filesystem'")
+        self.storage_dir = os.environ.get('STORAGE_DIR', storage_dir)
+        # 'stream': binaries go through the service
+        # 'redirect': downloads answer 302 to a presigned object store URL
+        # 'url': downloads answer a JSON body holding the presigned URL
+        self.binary_delivery = os.environ.get('BINARY_DELIVERY', binary_delivery)
+        if self.binary_delivery not in ('stream', 'redirect', 'url'):
+            raise ValueError("BINARY_DELIVERY must be one of 'stream', 'redirect' or 'url'")
+        if self.binary_delivery != 'stream' and self.storage_backend != 'minio':
+            raise ValueError("BINARY_DELIVERY=%s needs presigned URLs, which only the minio storage backend has"
+                             % self.binary_delivery)
+        # seconds a presigned URL stays valid
+        self.presign_expiry = int(os.environ.get('PRESIGN_EXPIRY', presign_expiry))
+        # seconds a provisioned tenant (schema + bucket) is trusted before being probed again
+        self.tenant_cache_ttl = int(os.environ.get('TENANT_CACHE_TTL', tenant_cache_ttl))
+        self.token_cache_size = int(os.environ.get('TOKEN_CACHE_SIZE', token_cache_size))
+        self.download_chunk_size = int(os.environ.get('DOWNLOAD_CHUNK_SIZE', download_chunk_size))
+        # bytes held in memory per upload before a multipart part is sent (minimum 5MiB)
+        self.upload_part_size = int(os.environ.get('UPLOAD_PART_SIZE', upload_part_size))
+        # encoding binaries are stored with: 'gzip', 'zstd' (needs the zstandard module) or 'none'
+        self.compression = os.environ.get('COMPRESSION', compression)
+        if self.compression not in ('gzip', 'zstd', 'none'):
+            raise ValueError("COMPRESSION must be one of 'gzip', 'zstd' or 'none'")
+        self.compression_level = int(os.environ.get('COMPRESSION_LEVEL', compression_level))
+        # processes computing binary deltas (per worker), and the largest binary they are computed for
+        self.delta_workers = int(os.environ.get('DELTA_WORKERS', delta_workers))
+        self.delta_max_size = int(os.environ.get('DELTA_MAX_SIZE', delta_max_size))
+        # seconds clients are told to wait (Retry-After) while a delta is being computed
+        self.delta_retry_after = int(os.environ.get('DELTA_RETRY_AFTER', delta_retry_after))
+        # largest chunk of a resumable upload, and seconds an idle upload session is kept
+        self.max_chunk_size = int(os.environ.get('MAX_CHUNK_SIZE', max_chunk_size))
+        self.upload_session_ttl = int(os.environ.get('UPLOAD_SESSION_TTL', upload_session_ttl))
+        # local copies of hot binaries, bounded to binary_cache_size bytes per worker (0 disables it)
+        self.binary_cache_dir = os.environ.get('BINARY_CACHE_DIR', binary_cache_dir)
+        self.binary_cache_size = int(os.environ.get('BINARY_CACHE_SIZE', binary_cache_size))
+        # image metadata snapshots kept per worker (0 disables the cache) and seconds they are trusted;
+        # with a Postgres channel name, workers tell each other about changes through LISTEN/NOTIFY
+        self.metadata_cache_size = int(os.environ.get('METADATA_CACHE_SIZE', metadata_cache_size))
+        self.metadata_cache_ttl = float(os.environ.get('METADATA_CACHE_TTL', metadata_cache_ttl))
+        self.metadata_cache_channel = os.environ.get('METADATA_CACHE_CHANNEL', metadata_cache_channel)
+        # largest page (and default page size) of image listings
+        self.max_page_size = int(os.environ.get('MAX_PAGE_SIZE', max_page_size))
+        # most images created or removed by a single batch request
+        self.max_batch_size = int(os.environ.get('MAX_BATCH_SIZE', max_batch_size))
+        # seconds between two looks at the change feed while waiting for changes made by other
+        # workers, longest long-poll wait, and lifetime of an event stream before clients reconnect
+        self.change_poll_interval = float(os.environ.get('CHANGE_POLL_INTERVAL', change_poll_interval))
+        self.max_change_wait = float(os.environ.get('MAX_CHANGE_WAIT', max_change_wait))
+        self.change_stream_timeout = float(os.environ.get('CHANGE_STREAM_TIMEOUT', change_stream_timeout))
+        # level of the service loggers (DEBUG, INFO, WARNING, ERROR)
+        self.log_level = os.environ.get('LOG_LEVEL', log_level).upper()
+        if not isinstance(logging.getLevelName(self.log_level), int):
+            raise ValueError("LOG_LEVEL must be one of DEBUG, INFO, WARNING or ERROR")
+        # secret enabling the profiler (see Profiler), which is off when empty, and where workers
+        # share its settings and results
+        self.profiler_token = os.environ.get('PROFILER_TOKEN', profiler_token)
+        self.profile_dir = os.environ.get('PROFILE_DIR', profile_dir)
+        # seconds between two runs of the reconciler (see Reconciler) from the service, 0 to only
+        # run it by hand; requests per second it sends to the database and the store, rows or
+        # objects it handles per request, and seconds unreferenced objects are left alone for
+        self.reconcile_interval = float(os.environ.get('RECONCILE_INTERVAL', reconcile_interval))
+        self.reconcile_rate = float(os.environ.get('RECONCILE_RATE', reconcile_rate))
+        self.reconcile_batch = int(os.environ.get('RECONCILE_BATCH', reconcile_batch))
+        if not 0 < self.reconcile_batch <= 1000:
+            raise ValueError("RECONCILE_BATCH must be between 1 and 1000")
+        self.reconcile_grace = int(os.environ.get('RECONCILE_GRACE', reconcile_grace))
 
     def get_db_url(self):
         """ From the config, return a valid postgresql url """
@@ -36,3 +164,12 @@ class Config(object):
 
 
 CONFIG = Config()
+
+
+# the loggers of every module ('image-manager.<module>') write through this one, a JSON object per line
+LOGGER = logging.getLogger('image-manager')
+LOG_HANDLER = logging.StreamHandler()
+LOG_HANDLER.setFormatter(JSONFormatter())
+LOGGER.addHandler(LOG_HANDLER)
+LOGGER.setLevel(CONFIG.log_level)
+LOGGER.propagate = False
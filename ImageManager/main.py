@@ -3,6 +3,12 @@ from .app import app
 # initialize modules
 from . import ImageManager
 from . import ErrorManager
+from . import Metrics
+from . import Profiler
+from . import Reconciler
+from .DatabaseModels import db
+from .TenancyManager import upgrade_tenants
 
 if __name__ == '__main__':
+    upgrade_tenants(db)
     app.run(host='0.0.0.0', threaded=True)
@@ -47,3 +47,17 @@ def get_pagination(request):
 
     except TypeError:
         raise HTTPRequestError(400, "page_size and page_num must be integers")
+
+
+def get_cursor_pagination(request, max_page_size):
+    """ Returns the (cursor, page_size) pair of a keyset paginated listing """
+    try:
+        per_page = int(request.args.get('page_size', max_page_size))
+    except ValueError:
+        raise HTTPRequestError(400, "page_size must be an integer")
+
+    if per_page < 1:
+        raise HTTPRequestError(400, "At least one entry per page is mandatory")
+    if per_page > max_page_size:
+        raise HTTPRequestError(400, "At most %d entries per page are allowed" % max_page_size)
+    return request.args.get('cursor'), per_page
@@ -0,0 +1,354 @@
+"""
+    Load test of the main endpoints: lists, gets, uploads, downloads and deletes images at several
+    concurrency levels, catalog sizes and image sizes, and reports throughput, p50/p99 latency and
+    peak RSS as JSON, so runs can be compared.
+
+    The service runs in-process behind a threaded HTTP server, on SQLite (or the database given
+    with --database, e.g. a local Postgres) and an in-memory S3 stand-in (see object_store), or
+    the filesystem storage backend with --storage filesystem, so no docker-compose stack is needed:
+        python3 -m benchmarks.load --catalog 100,10000 --image-size 16384,1048576 \\
+            --concurrency 1,8 --requests 200 --output after.json --baseline before.json
+
+    Clients, service and object store share one interpreter (and its GIL), and peak RSS covers
+    all three: figures are meant for comparing runs on the same machine, not for sizing.
+"""
+
+import argparse
+import base64
+import http.client
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from benchmarks.object_store import start_object_store
+
+ENDPOINTS = ('list', 'get', 'upload', 'download', 'delete')
+
+TENANT = 'bench'
+
+# the service reads tokens without checking their signature
+TOKEN = 'e30.%s.' % base64.b64encode(json.dumps({'service': TENANT}).encode()).decode().rstrip('=')
+
+BATCH_SIZE = 1000
+
+HEX_RECORD_SIZE = 32
+
+
+def int_list(value):
+    return sorted(int(item) for item in value.split(','))
+
+
+def hex_record(record_type, address, data):
+    record = bytes([len(data), address >> 8, address & 0xFF, record_type]) + data
+    return ':' + (record + bytes([-sum(record) & 0xFF])).hex().upper()
+
+
+def intel_hex(size):
+    """ Records of an Intel HEX file holding size random bytes, extended address records included """
+    data = os.urandom(size)
+    records = []
+    for offset in range(0, size, HEX_RECORD_SIZE):
+        if offset & 0xFFFF == 0:
+            records.append(hex_record(4, 0, (offset >> 16).to_bytes(2, 'big')))
+        records.append(hex_record(0, offset & 0xFFFF, data[offset:offset + HEX_RECORD_SIZE]))
+    records.append(hex_record(1, 0, b''))
+    return records
+
+
+class Client(object):
+    """ Requests to the service, one connection each (the development server does not keep them alive) """
+
+    def __init__(self, address):
+        self.host, self.port = address
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {}, Authorization='Bearer ' + TOKEN)
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=300)
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            data = response.read()
+            return response.status, data
+        finally:
+            connection.close()
+
+    def json(self, method, path, payload):
+        status, data = self.request(method, path, json.dumps(payload), {'Content-Type': 'application/json'})
+        if status >= 300:
+            raise SystemExit('%s %s failed (%d): %s' % (method, path, status, data[:200]))
+        return json.loads(data.decode())
+
+    def create_images(self, count):
+        ids = []
+        while len(ids) < count:
+            batch = [{'label': 'bench-%d' % i, 'fw_version': '1.0.%d' % i}
+                     for i in range(min(BATCH_SIZE, count - len(ids)))]
+            ids += [result['id'] for result in self.json('POST', '/image/batch', batch)]
+        return ids
+
+    def delete_images(self, ids):
+        for start in range(0, len(ids), BATCH_SIZE):
+            self.json('DELETE', '/image/batch', ids[start:start + BATCH_SIZE])
+
+
+class Uploads(object):
+    """ multipart/form-data bodies of distinct Intel HEX files of the same size """
+
+    boundary = uuid.uuid4().hex
+
+    def __init__(self, size):
+        self.records = intel_hex(size)
+        self.leading = min(size, HEX_RECORD_SIZE)
+        self.content_type = 'multipart/form-data; boundary=' + self.boundary
+
+    def body(self):
+        # new leading bytes give every upload a digest of its own, without encoding the file again
+        records = list(self.records)
+        records[1] = hex_record(0, 0, os.urandom(self.leading))
+        return ('--{0}\r\nContent-Disposition: form-data; name="image"; filename="bench.hex"\r\n'
+                'Content-Type: application/octet-stream\r\n\r\n{1}\n\r\n--{0}--\r\n').format(
+                    self.boundary, '\n'.join(records)).encode()
+
+
+def percentile(ordered, fraction):
+    """ Nearest-rank percentile of sorted values """
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def peak_rss():
+    # kilobytes on Linux, bytes on macOS
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+
+def run(concurrency, items, call):
+    """ Calls call(item) for every item from concurrency threads, returning the scenario figures """
+    latencies = []
+    errors = []
+    transferred = [0]
+    lock = threading.Lock()
+
+    def timed(item):
+        prepared = call(item)
+        started = time.perf_counter()
+        status, data = prepared()
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            transferred[0] += len(data)
+            if status >= 300:
+                errors.append(status)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, items))
+    duration = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'duration_s': round(duration, 3),
+        'throughput_rps': round(len(latencies) / duration, 2),
+        'response_bytes': transferred[0],
+        'latency_ms': {
+            'mean': round(1000 * sum(latencies) / len(latencies), 3),
+            'p50': round(1000 * percentile(latencies, 0.50), 3),
+            'p99': round(1000 * percentile(latencies, 0.99), 3),
+            'max': round(1000 * latencies[-1], 3),
+        },
+        'peak_rss_kb': peak_rss(),
+    }
+
+
+class Benchmark(object):
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+        self.catalog = []
+        self.results = []
+
+    def record(self, endpoint, concurrency, image_size, figures):
+        result = dict(endpoint=endpoint, concurrency=concurrency, catalog=len(self.catalog),
+                      image_size=image_size, **figures)
+        self.results.append(result)
+        print('{endpoint:>8} c={concurrency:<3} catalog={catalog:<7} size={size:<9} {throughput_rps:>9} req/s  '
+              'p50 {p50:>9} ms  p99 {p99:>9} ms  errors {errors}'.format(
+                  size=image_size or '-', p50=result['latency_ms']['p50'], p99=result['latency_ms']['p99'],
+                  **result), file=sys.stderr)
+
+    def wanted(self, endpoint):
+        return endpoint in self.args.endpoints
+
+    def pick(self, ids, count):
+        return [ids[i % len(ids)] for i in range(count)]
+
+    def run_catalog(self, size):
+        self.catalog += self.client.create_images(size - len(self.catalog))
+        requests = self.args.requests
+        for concurrency in self.args.concurrency:
+            if self.wanted('list'):
+                path = '/image?page_size=%d' % self.args.page_size
+                self.record('list', concurrency, None, run(
+                    concurrency, range(requests), lambda _: lambda: self.client.request('GET', path)))
+            if self.wanted('get'):
+                self.record('get', concurrency, None, run(
+                    concurrency, self.pick(self.catalog, requests),
+                    lambda imageid: lambda: self.client.request('GET', '/image/' + imageid)))
+        for image_size in self.args.image_size:
+            self.run_image_size(image_size)
+
+    def run_image_size(self, image_size):
+        requests = self.args.requests
+        uploads = Uploads(image_size)
+
+        def upload(imageid):
+            body = uploads.body()
+            return lambda: self.client.request('POST', '/image/%s/binary' % imageid, body,
+                                               {'Content-Type': uploads.content_type})
+
+        # binaries to download, uploaded beforehand
+        pool = self.client.create_images(min(self.args.pool, requests))
+        for imageid in pool:
+            status, data = upload(imageid)()
+            if status != 200:
+                raise SystemExit('upload failed (%d): %s' % (status, data[:200]))
+
+        for concurrency in self.args.concurrency:
+            uploaded = []
+            if self.wanted('upload'):
+                uploaded = self.client.create_images(requests)
+                self.record('upload', concurrency, image_size, run(concurrency, uploaded, upload))
+            if self.wanted('download'):
+                headers = {'Accept-Encoding': self.args.accept_encoding} if self.args.accept_encoding else {}
+                self.record('download', concurrency, image_size, run(
+                    concurrency, self.pick(pool, requests),
+                    lambda imageid: lambda: self.client.request('GET', '/image/%s/binary' % imageid, headers=headers)))
+            if self.wanted('delete'):
+                # images of the upload scenario, which keeps the catalog size steady
+                removed = uploaded or self.client.create_images(requests)
+                self.record('delete', concurrency, image_size, run(
+                    concurrency, removed, lambda imageid: lambda: self.client.request('DELETE', '/image/' + imageid)))
+            elif uploaded:
+                self.client.delete_images(uploaded)
+        self.client.delete_images(pool)
+
+
+def start_service(database, storage, work_dir):
+    """ Serves the application from a daemon thread, returning its address """
+    # the configuration is read from the environment when the service modules are imported
+    os.environ['STORAGE_BACKEND'] = storage
+    if storage == 'filesystem':
+        os.environ['STORAGE_DIR'] = os.path.join(work_dir, 'objects')
+    else:
+        os.environ['S3URL'] = start_object_store().address
+    os.environ.setdefault('BINARY_CACHE_DIR', os.path.join(work_dir, 'cache'))
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    if database.startswith('sqlite'):
+        # SQLite has no schemas
+        os.environ['TENANCY_MODE'] = 'shared'
+
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    from ImageManager.app import app
+    from ImageManager.DatabaseModels import db
+    import ImageManager.main  # noqa: F401 registers the routes
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_request(self, *args):
+            pass
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = database
+    with app.app_context():
+        db.create_all()
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """ Adds the relative throughput and p99 changes against the matching results of a previous run """
+    with open(baseline_path) as baseline_file:
+        baseline = {(r['endpoint'], r['concurrency'], r['catalog'], r['image_size']): r
+                    for r in json.load(baseline_file)['results']}
+    for result in results:
+        before = baseline.get((result['endpoint'], result['concurrency'], result['catalog'], result['image_size']))
+        if before is not None:
+            result['baseline'] = {
+                'throughput_rps': before['throughput_rps'],
+                'p99_ms': before['latency_ms']['p99'],
+                'throughput_change': round(result['throughput_rps'] / before['throughput_rps'] - 1, 4),
+                'p99_change': round(result['latency_ms']['p99'] / before['latency_ms']['p99'] - 1, 4),
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--catalog', default='100,10000', type=int_list, help="images in the catalog")
+    parser.add_argument('--image-size', default='16384,1048576', type=int_list, help="binary sizes, in bytes")
+    parser.add_argument('-c', '--concurrency', default='1,8', type=int_list)
+    parser.add_argument('-n', '--requests', default=200, type=int, help="requests per scenario")
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS), type=lambda v: v.split(','))
+    parser.add_argument('--page-size', default=100, type=int, help="images per listing page")
+    parser.add_argument('--pool', default=16, type=int, help="distinct binaries downloaded")
+    parser.add_argument('--accept-encoding', default='gzip',
+                        help="Accept-Encoding of downloads (empty to have binaries decoded by the service)")
+    parser.add_argument('--database', help="SQLAlchemy URL, a temporary SQLite database by default")
+    parser.add_argument('--storage', default='minio', choices=('minio', 'filesystem'),
+                        help="storage backend, minio being served by an in-memory stand-in")
+    parser.add_argument('-o', '--output', help="file the JSON report is written to, stdout by default")
+    parser.add_argument('--baseline', help="JSON report of a previous run to compare with")
+    args = parser.parse_args()
+    unknown = set(args.endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error('unknown endpoints: ' + ', '.join(sorted(unknown)))
+
+    started = datetime.utcnow().isoformat() + 'Z'
+    with tempfile.TemporaryDirectory(prefix='image-manager-bench-') as work_dir:
+        database = args.database or 'sqlite:///' + os.path.join(work_dir, 'images.db')
+        client = Client(start_service(database, args.storage, work_dir))
+        # provisions the tenant
+        client.request('GET', '/image')
+
+        benchmark = Benchmark(client, args)
+        for size in args.catalog:
+            benchmark.run_catalog(size)
+
+    report = {
+        'started': started,
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': dict(vars(args), database=args.database or 'sqlite'),
+        'results': benchmark.results,
+    }
+    if args.baseline:
+        compare(report['results'], args.baseline)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
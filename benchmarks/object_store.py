@@ -0,0 +1,323 @@
+"""
+    In-process stand-in for Minio: an HTTP server answering the subset of the S3 API the service
+    uses (buckets, objects with ranges and metadata, listings, multipart uploads and their listing,
+    copies and multi-object deletes), holding objects in memory. Signatures are not checked.
+
+    Lets the benchmarks drive the real Minio client without a Minio server:
+        server = start_object_store()
+        os.environ['S3URL'] = server.address
+"""
+
+import hashlib
+import threading
+import time
+import uuid
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+NAMESPACE = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+MAX_KEYS = 1000
+
+
+def iso8601(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(timestamp))
+
+
+def document(root, *elements):
+    # S3 sends errors without a namespace, and minio only reads their fields when it is missing
+    namespace = '' if root == 'Error' else ' xmlns="%s"' % NAMESPACE
+    return '<?xml version="1.0" encoding="UTF-8"?><{0}{1}>{2}</{0}>'.format(
+        root, namespace, ''.join(elements)).encode()
+
+
+def element(name, value):
+    return '<{0}>{1}</{0}>'.format(name, escape(str(value)))
+
+
+class StoredObject(object):
+    def __init__(self, data, content_type='application/octet-stream', metadata=None):
+        self.data = data
+        self.etag = hashlib.md5(data).hexdigest()
+        self.content_type = content_type
+        self.metadata = metadata or {}
+        self.last_modified = time.time()
+
+
+class ObjectStore(object):
+    """ Buckets, objects and multipart uploads in progress, kept in memory """
+
+    def __init__(self):
+        self.buckets = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, name):
+        return self.buckets.get(name)
+
+    def size(self):
+        """ Bytes held, uploads in progress included """
+        with self.lock:
+            stored = sum(len(o.data) for bucket in self.buckets.values() for o in bucket.values())
+            parts = sum(len(p) for upload in self.uploads.values() for p in upload['parts'].values())
+        return stored + parts
+
+
+class ObjectStoreHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def store(self):
+        return self.server.store
+
+    def log_message(self, *args):
+        pass
+
+    def parse(self):
+        url = urlsplit(self.path)
+        path = unquote(url.path).lstrip('/')
+        bucket, _, key = path.partition('/')
+        query = {name: values[0] for name, values in parse_qs(url.query, keep_blank_values=True).items()}
+        return bucket, key, query
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def respond(self, status, body=b'', headers=None, content_type='application/xml'):
+        self.send_response(status)
+        headers = headers or {}
+        headers.setdefault('Content-Type', content_type)
+        headers.setdefault('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def error(self, status, code, message='', **fields):
+        self.respond(status, document('Error', element('Code', code), element('Message', message or code),
+                                      *(element(k, v) for k, v in fields.items())))
+
+    def object_headers(self, obj):
+        headers = {'ETag': '"%s"' % obj.etag, 'Last-Modified': formatdate(obj.last_modified, usegmt=True),
+                   'Content-Type': obj.content_type, 'Accept-Ranges': 'bytes'}
+        headers.update(('x-amz-meta-' + name, value) for name, value in obj.metadata.items())
+        return headers
+
+    def do_HEAD(self):
+        bucket_name, key, _ = self.parse()
+        bucket = self.store.bucket(bucket_name)
+        if bucket is None or (key and key not in bucket):
+            return self.respond(404)
+        if not key:
+            return self.respond(200)
+        obj = bucket[key]
+        headers = self.object_headers(obj)
+        headers['Content-Length'] = str(len(obj.data))
+        self.respond(200, headers=headers)
+
+    def do_GET(self):
+        bucket_name, key, query = self.parse()
+        bucket = self.store.bucket(bucket_name)
+        if bucket is None:
+            return self.error(404, 'NoSuchBucket', BucketName=bucket_name)
+        if not key:
+            if 'location' in query:
+                return self.respond(200, document('LocationConstraint'))
+            if 'uploads' in query:
+                return self.list_uploads(bucket_name, query)
+            return self.list_objects(bucket_name, bucket, query)
+        if 'uploadId' in query:
+            return self.list_parts(bucket_name, key, query['uploadId'])
+        obj = bucket.get(key)
+        if obj is None:
+            return self.error(404, 'NoSuchKey', Key=key)
+        headers = self.object_headers(obj)
+        data = obj.data
+        requested = self.headers.get('Range', '')
+        if requested.startswith('bytes='):
+            first, _, last = requested[len('bytes='):].partition('-')
+            first = int(first)
+            last = min(int(last) if last else len(data) - 1, len(data) - 1)
+            if first >= len(data):
+                return self.error(416, 'InvalidRange')
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (first, last, len(data))
+            return self.respond(206, data[first:last + 1], headers)
+        self.respond(200, data, headers)
+
+    def list_objects(self, bucket_name, bucket, query):
+        prefix = query.get('prefix', '')
+        delimiter = query.get('delimiter', '')
+        max_keys = min(int(query.get('max-keys', MAX_KEYS)), MAX_KEYS)
+        version2 = query.get('list-type') == '2'
+        if version2:
+            after = query.get('continuation-token') or query.get('start-after', '')
+        else:
+            after = query.get('marker', '')
+        with self.store.lock:
+            names = sorted(name for name in bucket if name.startswith(prefix) and name > after)
+        contents, prefixes, last = [], [], None
+        for name in names:
+            if len(contents) + len(prefixes) == max_keys:
+                break
+            last = name
+            if delimiter and delimiter in name[len(prefix):]:
+                common = name[:name.index(delimiter, len(prefix)) + len(delimiter)]
+                if common not in prefixes:
+                    prefixes.append(common)
+                continue
+            obj = bucket.get(name)
+            if obj is not None:
+                contents.append('<Contents>%s%s%s%s</Contents>' % (
+                    element('Key', name), element('LastModified', iso8601(obj.last_modified)),
+                    element('ETag', '"%s"' % obj.etag), element('Size', len(obj.data))))
+        truncated = last is not None and last != names[-1]
+        fields = [element('Name', bucket_name), element('Prefix', prefix), element('IsTruncated', str(truncated).lower())]
+        if truncated:
+            fields.append(element('NextContinuationToken' if version2 else 'NextMarker', last))
+        fields += contents
+        fields += ['<CommonPrefixes>%s</CommonPrefixes>' % element('Prefix', p) for p in prefixes]
+        self.respond(200, document('ListBucketResult', *fields))
+
+    def list_uploads(self, bucket_name, query):
+        prefix = query.get('prefix', '')
+        with self.store.lock:
+            uploads = sorted((upload['key'], upload_id, upload['initiated'])
+                             for upload_id, upload in self.store.uploads.items()
+                             if upload['bucket'] == bucket_name and upload['key'].startswith(prefix))
+        entries = ['<Upload>%s%s%s</Upload>' % (element('Key', key), element('UploadId', upload_id),
+                                                element('Initiated', iso8601(initiated)))
+                   for key, upload_id, initiated in uploads]
+        self.respond(200, document('ListMultipartUploadsResult', element('Bucket', bucket_name),
+                                   element('IsTruncated', 'false'), *entries))
+
+    def list_parts(self, bucket_name, key, upload_id):
+        upload = self.store.uploads.get(upload_id)
+        if upload is None:
+            return self.error(404, 'NoSuchUpload')
+        parts = ['<Part>%s%s%s%s</Part>' % (
+            element('PartNumber', number), element('LastModified', iso8601(time.time())),
+            element('ETag', '"%s"' % hashlib.md5(data).hexdigest()), element('Size', len(data)))
+            for number, data in sorted(upload['parts'].items())]
+        self.respond(200, document('ListPartsResult', element('Bucket', bucket_name), element('Key', key),
+                                   element('UploadId', upload_id), element('IsTruncated', 'false'), *parts))
+
+    def do_PUT(self):
+        bucket_name, key, query = self.parse()
+        body = self.read_body()
+        if not key:
+            if bucket_name in self.store.buckets:
+                return self.error(409, 'BucketAlreadyOwnedByYou', BucketName=bucket_name)
+            self.store.buckets[bucket_name] = {}
+            return self.respond(200)
+        bucket = self.store.bucket(bucket_name)
+        if bucket is None:
+            return self.error(404, 'NoSuchBucket', BucketName=bucket_name)
+        if 'uploadId' in query:
+            upload = self.store.uploads.get(query['uploadId'])
+            if upload is None:
+                return self.error(404, 'NoSuchUpload')
+            with self.store.lock:
+                upload['parts'][int(query['partNumber'])] = body
+            return self.respond(200, headers={'ETag': '"%s"' % hashlib.md5(body).hexdigest()})
+        source = self.headers.get('x-amz-copy-source')
+        if source is not None:
+            source_bucket, _, source_key = unquote(source).lstrip('/').partition('/')
+            original = self.store.buckets.get(source_bucket, {}).get(source_key)
+            if original is None:
+                return self.error(404, 'NoSuchKey', Key=source_key)
+            obj = StoredObject(original.data, original.content_type, original.metadata)
+            if self.headers.get('x-amz-metadata-directive') == 'REPLACE':
+                obj.metadata = self.metadata()
+            with self.store.lock:
+                bucket[key] = obj
+            return self.respond(200, document('CopyObjectResult', element('ETag', '"%s"' % obj.etag),
+                                              element('LastModified', iso8601(obj.last_modified))))
+        obj = StoredObject(body, self.headers.get('Content-Type', 'application/octet-stream'), self.metadata())
+        with self.store.lock:
+            bucket[key] = obj
+        self.respond(200, headers={'ETag': '"%s"' % obj.etag})
+
+    def metadata(self):
+        return {name[len('x-amz-meta-'):].lower(): value for name, value in self.headers.items()
+                if name.lower().startswith('x-amz-meta-')}
+
+    def do_POST(self):
+        bucket_name, key, query = self.parse()
+        body = self.read_body()
+        bucket = self.store.bucket(bucket_name)
+        if bucket is None:
+            return self.error(404, 'NoSuchBucket', BucketName=bucket_name)
+        if not key and 'delete' in query:
+            keys = [e.text for e in ElementTree.fromstring(body).iter() if e.tag.rsplit('}', 1)[-1] == 'Key']
+            with self.store.lock:
+                for key in keys:
+                    bucket.pop(key, None)
+            deleted = ['<Deleted>%s</Deleted>' % element('Key', key) for key in keys]
+            return self.respond(200, document('DeleteResult', *deleted))
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            self.store.uploads[upload_id] = {'parts': {}, 'content_type': self.headers.get('Content-Type'),
+                                             'metadata': self.metadata(), 'bucket': bucket_name, 'key': key,
+                                             'initiated': time.time()}
+            return self.respond(200, document('InitiateMultipartUploadResult', element('Bucket', bucket_name),
+                                              element('Key', key), element('UploadId', upload_id)))
+        if 'uploadId' in query:
+            upload = self.store.uploads.pop(query['uploadId'], None)
+            if upload is None:
+                return self.error(404, 'NoSuchUpload')
+            numbers = [int(e.text) for e in ElementTree.fromstring(body).iter()
+                       if e.tag.rsplit('}', 1)[-1] == 'PartNumber']
+            obj = StoredObject(b''.join(upload['parts'][n] for n in numbers),
+                               upload['content_type'] or 'application/octet-stream', upload['metadata'])
+            with self.store.lock:
+                bucket[key] = obj
+            return self.respond(200, document('CompleteMultipartUploadResult',
+                                              element('Location', '/%s/%s' % (bucket_name, key)),
+                                              element('Bucket', bucket_name), element('Key', key),
+                                              element('ETag', '"%s"' % obj.etag)))
+        self.error(400, 'NotImplemented')
+
+    def do_DELETE(self):
+        bucket_name, key, query = self.parse()
+        self.read_body()
+        with self.store.lock:
+            if not key:
+                self.store.buckets.pop(bucket_name, None)
+            elif 'uploadId' in query:
+                self.store.uploads.pop(query['uploadId'], None)
+            else:
+                self.store.buckets.get(bucket_name, {}).pop(key, None)
+        self.respond(204)
+
+
+class ObjectStoreServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        HTTPServer.__init__(self, address, ObjectStoreHandler)
+        self.store = ObjectStore()
+
+    @property
+    def address(self):
+        return '%s:%d' % self.server_address
+
+
+def start_object_store(address=('127.0.0.1', 0)):
+    """ Serves a new, empty object store from a daemon thread """
+    server = ObjectStoreServer(address)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,78 @@
+"""
+    Compares the two ways of serializing image listings:
+    ORM hydration plus one ImageSchema dump per row, against column tuples encoded in one batch.
+
+    Runs against an in-memory SQLite database, so no Postgres is needed:
+        python3 -m benchmarks.serialization --rows 10000 --repeat 5
+"""
+
+import argparse
+import json
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from ImageManager.app import app
+from ImageManager.DatabaseModels import db, Image, get_images_page
+from ImageManager.SerializationModels import image_schema, image_row_encoder
+
+
+def populate(rows):
+    start = datetime(2020, 1, 1)
+    db.session.bulk_insert_mappings(Image, [{
+        'id': str(uuid.uuid4()),
+        'label': 'label-%d' % (i % 10),
+        'fw_version': '1.0.%d' % i,
+        'created': start + timedelta(seconds=i),
+        'confirmed': i % 2 == 0,
+        'sha256': '0' * 64 if i % 2 == 0 else None,
+        'size': 1024 if i % 2 == 0 else None,
+    } for i in range(rows)])
+    db.session.commit()
+
+
+def orm_path(rows):
+    images, _ = get_images_page({}, page_size=rows)
+    return json.dumps([image_schema.dump(i) for i in images], sort_keys=True)
+
+
+def tuple_path(rows):
+    rows, _ = get_images_page({}, page_size=rows, columns=image_row_encoder.columns(Image))
+    return json.dumps(image_row_encoder.dump_many(rows), sort_keys=True)
+
+
+def measure(func, rows, repeat):
+    best = None
+    for _ in range(repeat):
+        db.session.expunge_all()
+        started = time.perf_counter()
+        func(rows)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return rows / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--rows', default=10000, type=int)
+    parser.add_argument('-r', '--repeat', default=5, type=int)
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    with app.app_context():
+        db.create_all()
+        populate(args.rows)
+        if orm_path(args.rows) != tuple_path(args.rows):
+            raise SystemExit('serialized listings differ')
+
+        results = {
+            'rows': args.rows,
+            'orm_rows_per_second': round(measure(orm_path, args.rows, args.repeat)),
+            'tuple_rows_per_second': round(measure(tuple_path, args.rows, args.repeat)),
+        }
+        results['speedup'] = round(results['tuple_rows_per_second'] / results['orm_rows_per_second'], 2)
+        print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    main()
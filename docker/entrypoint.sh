@@ -11,6 +11,18 @@ if [ $1 = 'start' ]; then
         exit 1
     fi
 
+    # tenants are only provisioned on the request path, existing ones are upgraded once here
+    python3 -m ImageManager.TenancyMigration --upgrade
+    if [ $? -ne 0 ]; then
+        echo "Could not upgrade tenant schemas, shutting down!"
+        exit 1
+    fi
+
+    # samples of every gunicorn worker, added up by /metrics
+    export prometheus_multiproc_dir=${prometheus_multiproc_dir:-/tmp/image-manager-metrics}
+    rm -rf ${prometheus_multiproc_dir}
+    mkdir -p ${prometheus_multiproc_dir}
+
     while [ $flag -eq 0 ]; do
         if [ $retries -eq $max_retries ]; then
             echo Executed $retries retries, aborting
@@ -18,6 +30,7 @@ if [ $1 = 'start' ]; then
         fi
 
         exec gunicorn ImageManager.main:app \
+                  --config docker/gunicorn_conf.py \
                   --bind 0.0.0.0:5000 \
                   --reload -R \
                   --access-logfile - \
@@ -0,0 +1,8 @@
+""" gunicorn settings, see docker/entrypoint.sh """
+
+from prometheus_client import multiprocess
+
+
+def child_exit(server, worker):
+    # drops the live gauges of workers that are gone from the metrics aggregated across workers
+    multiprocess.mark_process_dead(worker.pid)
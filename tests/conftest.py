@@ -0,0 +1,111 @@
+"""
+    Fixtures of the behavioral tests, run with `python3 -m pytest tests` from the repository root.
+    The service runs in-process on SQLite and the filesystem storage backend, in shared tenancy mode
+    as SQLite has no schemas. The dredd hooks next to them are run against a deployed service
+    instead (see Dockerfile).
+"""
+
+import atexit
+import base64
+import io
+import json
+import os
+import shutil
+import tempfile
+
+import pytest
+
+collect_ignore = ['test_hooks.py', 'db_fixture.py']
+
+WORK_DIR = tempfile.mkdtemp(prefix='image-manager-tests-')
+atexit.register(shutil.rmtree, WORK_DIR, True)
+
+os.environ.update(TENANCY_MODE='shared',
+                  STORAGE_BACKEND='filesystem',
+                  STORAGE_DIR=os.path.join(WORK_DIR, 'storage'),
+                  BINARY_CACHE_DIR=os.path.join(WORK_DIR, 'cache'),
+                  PROFILE_DIR=os.path.join(WORK_DIR, 'profiles'))
+
+from ImageManager.app import app  # noqa: E402
+from ImageManager import main  # noqa: E402,F401
+from ImageManager.CacheManager import METADATA_CACHE  # noqa: E402
+from ImageManager.DatabaseModels import db  # noqa: E402
+from ImageManager.TenancyManager import invalidate_tenant  # noqa: E402
+
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def read_sample(name):
+    with open(os.path.join(TESTS_DIR, name), 'rb') as sample:
+        return sample.read()
+
+
+def auth_headers(tenant='admin'):
+    payload = base64.b64encode(json.dumps({'service': tenant}).encode()).decode().rstrip('=')
+    return {'Authorization': 'Bearer header.%s.signature' % payload}
+
+
+def make_hex(data, record_size=16):
+    """ Intel HEX file holding data from address 0 """
+    lines = []
+    for offset in range(0, len(data), 0x10000):
+        record = bytes([2, 0, 0, 4]) + (offset >> 16).to_bytes(2, 'big')
+        lines.append(record)
+        for start in range(offset, min(offset + 0x10000, len(data)), record_size):
+            chunk = data[start:start + record_size]
+            lines.append(bytes([len(chunk), (start >> 8) & 0xff, start & 0xff, 0]) + chunk)
+    lines.append(bytes([0, 0, 0, 1]))
+    return b''.join(b':' + (line + bytes([-sum(line) & 0xff])).hex().upper().encode() + b'\n'
+                    for line in lines)
+
+
+class Api(object):
+    """ Test client of the service, authenticated as a tenant """
+
+    def __init__(self, client, tenant='admin'):
+        self.client = client
+        self.headers = auth_headers(tenant)
+
+    def request(self, method, url, headers=None, **kwargs):
+        return self.client.open(url, method=method, headers=dict(self.headers, **(headers or {})), **kwargs)
+
+    def post_json(self, url, payload):
+        return self.request('POST', url, data=json.dumps(payload), content_type='application/json')
+
+    def create_image(self, label='ExampleFW', fw_version='1.0.0'):
+        response = self.post_json('/image/', {'label': label, 'fw_version': fw_version})
+        assert response.status_code == 201, response.data
+        return json.loads(response.data.decode())['id']
+
+    def upload(self, imageid, contents):
+        return self.request('POST', '/image/%s/binary' % imageid, content_type='multipart/form-data',
+                            data={'image': (io.BytesIO(contents), 'image.hex')})
+
+
+@pytest.fixture
+def client():
+    db.create_all()
+    invalidate_tenant()
+    METADATA_CACHE.clear()
+    yield app.test_client()
+    db.session.remove()
+    db.drop_all()
+    # every test starts from an empty store
+    storage_dir = os.environ['STORAGE_DIR']
+    for name in os.listdir(storage_dir):
+        shutil.rmtree(os.path.join(storage_dir, name))
+        if name.startswith('.'):
+            # the backend's own directories, buckets are made again as tenants are initialized
+            os.makedirs(os.path.join(storage_dir, name))
+
+
+@pytest.fixture
+def api(client):
+    return Api(client)
+
+
+@pytest.fixture
+def other_api(client):
+    return Api(client, 'other')
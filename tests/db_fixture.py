@@ -1,6 +1,8 @@
 from ImageManager.DatabaseModels import *
 from ImageManager.SerializationModels import *
-from ImageManager.TenancyManager import init_tenant
+from ImageManager.StorageBackend import ObjectNotFound
+from ImageManager.StorageManager import object_location
+from ImageManager.TenancyManager import init_tenant, invalidate_tenant
 
 
 def run():
@@ -9,13 +11,17 @@ def run():
     db.session.execute("drop schema IF EXISTS {} cascade".format(tenant))
     db.session.commit()
 
-    if minioClient.bucket_exists(tenant):
-        objects = minioClient.list_objects(tenant)
-        for obj in objects:
-            minioClient.remove_object(tenant, obj.object_name)
-        minioClient.remove_bucket(tenant)
+    bucket, prefix = object_location(tenant, '')
+    try:
+        storage.delete(bucket, [obj.object_name for obj in storage.list(bucket, prefix, recursive=True)])
+        if not prefix:
+            # a bucket of its own, schema-per-tenant
+            storage.remove_bucket(bucket)
+    except ObjectNotFound:
+        pass
 
-    init_tenant(tenant, db, minioClient)
+    invalidate_tenant(tenant)
+    init_tenant(tenant, db, storage)
 
     # Object Template
     payload = {
@@ -29,7 +35,8 @@ def run():
     data = image_schema.load(payload)
     data['id'] = id
     data['confirmed'] = True
-    minioClient.fput_object(tenant, id + '.hex', './tests/example.hex')
+    with open('./tests/example.hex', 'rb') as example:
+        storage.put(*object_location(tenant, id + '.hex'), data=example.read())
     orm_image = Image(**data)
     db.session.add(orm_image)
     db.session.commit()
@@ -0,0 +1,49 @@
+import json
+
+from ImageManager.DatabaseModels import Image
+
+
+def results_of(response):
+    return json.loads(response.data.decode())
+
+
+def test_create_batch(api):
+    response = api.post_json('/image/batch', [{'label': 'a', 'fw_version': '1'}, {'label': 'b', 'fw_version': '2'}])
+    assert response.status_code == 201
+    results = results_of(response)
+    assert [result['status'] for result in results] == [201, 201]
+    assert Image.query.count() == 2
+
+
+def test_create_batch_reports_invalid_entries_by_index(api):
+    response = api.post_json('/image/batch', [{'label': 'a', 'fw_version': '1'}, 5, {'label': 'b'}, 'c'])
+    assert response.status_code == 207
+    results = results_of(response)
+    assert [result['status'] for result in results] == [201, 400, 400, 400]
+    assert 'fw_version' in results[2]['errors']
+    assert Image.query.count() == 1
+
+
+def test_create_batch_of_invalid_entries(api):
+    response = api.post_json('/image/batch', [5, {'label': 'b'}])
+    assert response.status_code == 400
+    assert [result['status'] for result in results_of(response)] == [400, 400]
+
+
+def test_create_batch_needs_a_list(api):
+    assert api.post_json('/image/batch', {'label': 'a', 'fw_version': '1'}).status_code == 400
+    assert api.post_json('/image/batch', []).status_code == 400
+
+
+def test_delete_batch(api):
+    imageid = api.create_image()
+    response = api.request('DELETE', '/image/batch', data=json.dumps([imageid, 'missing']),
+                           content_type='application/json')
+    assert response.status_code == 207
+    assert [result['status'] for result in results_of(response)] == [200, 404]
+    assert Image.query.count() == 0
+
+
+def test_delete_batch_needs_image_ids(api):
+    response = api.request('DELETE', '/image/batch', data=json.dumps([5]), content_type='application/json')
+    assert response.status_code == 400
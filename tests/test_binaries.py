@@ -0,0 +1,73 @@
+import json
+import os
+
+from ImageManager.DatabaseModels import Binary, storage
+from ImageManager.StorageManager import object_location
+
+from conftest import make_hex
+
+
+def listing(api, query=''):
+    response = api.request('GET', '/image/binary/' + query)
+    assert response.status_code == 200, response.data
+    return json.loads(response.data.decode())
+
+
+def test_binaries_are_listed_under_the_images_using_them(api, other_api):
+    contents = make_hex(os.urandom(1024))
+    first, second = api.create_image(fw_version='1'), api.create_image(fw_version='2')
+    api.create_image(fw_version='3')
+    for imageid in (first, second):
+        assert api.upload(imageid, contents).status_code == 200
+    other = other_api.create_image()
+    assert other_api.upload(other, contents).status_code == 200
+
+    entries = listing(api)
+    assert sorted(entry['name'] for entry in entries) == sorted(
+        [first + '.hex', first + '.bin', second + '.hex', second + '.bin'])
+    # stored once, under the blob of the first upload
+    assert len(set(entry['object'] for entry in entries)) == 2
+    assert [entry['name'] for entry in listing(other_api)] == [other + '.bin', other + '.hex']
+
+
+def test_binary_listing_pages_through_stored_objects(api):
+    for version in range(3):
+        imageid = api.create_image(fw_version=str(version))
+        assert api.upload(imageid, make_hex(os.urandom(512))).status_code == 200
+    response = api.request('GET', '/image/binary/?page_size=4')
+    assert len(json.loads(response.data.decode())) == 4
+    rest = listing(api, '?page_size=4&cursor=' + response.headers['X-Next-Cursor'])
+    assert len(rest) == 2
+
+
+def stored_objects():
+    bucket, prefix = object_location('admin', '')
+    return sorted(obj.object_name[len(prefix):] for obj in storage.list(bucket, prefix))
+
+
+def test_shared_binary_is_removed_with_its_last_reference(api):
+    contents = make_hex(os.urandom(2048))
+    images = [api.create_image(fw_version=str(version)) for version in range(4)]
+    for imageid in images:
+        assert api.upload(imageid, contents).status_code == 200
+    binary = Binary.query.one()
+    assert binary.refcount == 4
+    objects = stored_objects()
+    assert objects == [binary.blob + '.bin', binary.blob + '.hex']
+
+    assert api.request('DELETE', '/image/%s' % images[0]).status_code == 200
+    assert api.request('DELETE', '/image/%s/binary' % images[1]).status_code == 200
+    assert Binary.query.one().refcount == 2
+    assert stored_objects() == objects
+    response = api.request('GET', '/image/%s/binary' % images[2], headers={'Accept-Encoding': 'identity'})
+    assert response.data == contents
+
+    response = api.request('DELETE', '/image/batch', data=json.dumps(images[2:]), content_type='application/json')
+    assert [entry['status'] for entry in json.loads(response.data.decode())] == [200, 200]
+    assert Binary.query.count() == 0
+    assert stored_objects() == []
+
+    # stored again by the next upload
+    assert api.upload(images[1], contents).status_code == 200
+    assert Binary.query.one().refcount == 1
+    assert len(stored_objects()) == 2
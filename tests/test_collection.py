@@ -0,0 +1,55 @@
+from datetime import datetime
+import json
+
+from sqlalchemy import event
+from sqlalchemy.sql.expression import Insert
+
+from ImageManager.DatabaseModels import CollectionVersion, db
+
+from conftest import make_hex
+
+
+def test_concurrent_first_write_bumps_the_version(api):
+    table = CollectionVersion.__table__
+    raced = []
+
+    # another worker creates the collection row between our update and our insert
+    def before_execute(conn, clauseelement, multiparams, params):
+        if isinstance(clauseelement, Insert) and clauseelement.table is table and not raced:
+            raced.append(True)
+            conn.execute(table.insert().values(tenant='admin', version=1, updated=datetime.now()))
+
+    event.listen(db.engine, 'before_execute', before_execute)
+    try:
+        api.create_image()
+    finally:
+        event.remove(db.engine, 'before_execute', before_execute)
+
+    assert raced
+    assert db.session.query(CollectionVersion.version).filter_by(tenant='admin').scalar() == 2
+    assert len(json.loads(api.request('GET', '/image').data.decode())) == 1
+
+
+def test_collection_row_is_locked_before_changes_are_written(api):
+    imageid = api.create_image()
+    other = api.create_image(fw_version='2')
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        for kind, table in (('lock', 'UPDATE collection_versions'), ('change', 'INSERT INTO image_changes')):
+            if statement.startswith(table):
+                statements.append(kind)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        for request in (lambda: api.upload(imageid, make_hex(b'firmware')),
+                        lambda: api.request('DELETE', '/image/%s' % imageid),
+                        lambda: api.request('DELETE', '/image/batch', data=json.dumps([other]),
+                                            content_type='application/json'),
+                        lambda: api.post_json('/image/batch', [{'label': 'a', 'fw_version': '3'}])):
+            del statements[:]
+            assert request().status_code in (200, 201)
+            assert statements[0] == 'lock' and statements.count('lock') == 1, statements
+            assert 'change' in statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
@@ -0,0 +1,51 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from conftest import make_hex
+
+from ImageManager import DeltaManager
+from ImageManager.DeltaManager import DELTA_BUILDER
+
+
+def wait_for_builds():
+    for _ in range(100):
+        if not DELTA_BUILDER._pending:
+            return
+        time.sleep(0.05)
+    raise AssertionError("delta still being built")
+
+
+def upload_pair(api):
+    data = os.urandom(4096)
+    ids = []
+    for contents in (data, data[:1000] + b'changed' + data[1007:]):
+        imageid = api.create_image(fw_version=str(len(ids)))
+        assert api.upload(imageid, make_hex(contents)).status_code == 200
+        ids.append(imageid)
+    return ids
+
+
+def test_delta_is_built_then_served(api):
+    source, target = upload_pair(api)
+    response = api.request('GET', '/image/%s/delta?from=%s' % (target, source))
+    assert response.status_code == 202
+    assert response.headers['Retry-After']
+    wait_for_builds()
+    assert api.request('GET', '/image/%s/delta?from=%s' % (target, source)).status_code == 200
+
+
+def test_delta_held_by_another_worker_is_left_to_it(api, monkeypatch):
+    @contextmanager
+    def build_lock(tenant, name):
+        yield False
+
+    monkeypatch.setattr(DeltaManager, 'build_lock', build_lock)
+    source, target = upload_pair(api)
+    builds = DELTA_BUILDER.builds
+    response = api.request('GET', '/image/%s/delta?from=%s' % (target, source))
+    assert response.status_code == 202, json.loads(response.data.decode())
+    wait_for_builds()
+    assert DELTA_BUILDER.builds == builds
+    assert api.request('GET', '/image/%s/delta?from=%s' % (target, source)).status_code == 202
@@ -0,0 +1,108 @@
+import os
+import time
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+
+import pytest
+from werkzeug.http import http_date
+
+from conftest import make_hex
+
+IDENTITY = {'Accept-Encoding': 'identity'}
+
+
+def uploaded(api, size=5000):
+    contents = make_hex(os.urandom(size))
+    imageid = api.create_image()
+    assert api.upload(imageid, contents).status_code == 200
+    return imageid, contents
+
+
+def download(api, imageid, **headers):
+    return api.request('GET', '/image/%s/binary' % imageid, headers=dict(IDENTITY, **headers))
+
+
+def test_single_range(api):
+    imageid, contents = uploaded(api)
+    response = download(api, imageid, Range='bytes=10-19')
+    assert response.status_code == 206
+    assert response.data == contents[10:20]
+    assert response.headers['Content-Range'] == 'bytes 10-19/%d' % len(contents)
+    assert 'Digest' not in response.headers
+
+    response = download(api, imageid, Range='bytes=-5')
+    assert response.status_code == 206 and response.data == contents[-5:]
+
+
+def test_unsatisfiable_range(api):
+    imageid, contents = uploaded(api)
+    response = download(api, imageid, Range='bytes=%d-' % len(contents))
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == 'bytes */%d' % len(contents)
+
+
+def test_multiple_ranges_and_stale_if_range_get_the_whole_binary(api):
+    imageid, contents = uploaded(api)
+    response = download(api, imageid, Range='bytes=0-9,20-29')
+    assert response.status_code == 200 and response.data == contents
+    response = download(api, imageid, Range='bytes=0-9', **{'If-Range': '"stale"'})
+    assert response.status_code == 200 and response.data == contents
+
+    etag = download(api, imageid).headers['ETag']
+    response = download(api, imageid, Range='bytes=0-9', **{'If-Range': etag})
+    assert response.status_code == 206 and response.data == contents[:10]
+
+
+def test_ranges_apply_to_the_representation_sent(api):
+    imageid, contents = uploaded(api)
+    whole = api.request('GET', '/image/%s/binary' % imageid, headers={'Accept-Encoding': 'gzip'})
+    assert whole.headers['Content-Encoding'] == 'gzip'
+    assert whole.headers['ETag'] != download(api, imageid).headers['ETag']
+    response = api.request('GET', '/image/%s/binary' % imageid,
+                           headers={'Accept-Encoding': 'gzip', 'Range': 'bytes=0-9'})
+    assert response.status_code == 206 and response.data == whole.data[:10]
+
+
+def test_binary_not_modified(api):
+    imageid, contents = uploaded(api)
+    first = download(api, imageid)
+    response = download(api, imageid, **{'If-None-Match': first.headers['ETag']})
+    assert response.status_code == 304 and not response.data
+    response = download(api, imageid, **{'If-None-Match': '"other"'})
+    assert response.status_code == 200 and response.data == contents
+
+
+def test_metadata_not_modified_until_changed(api):
+    imageid = api.create_image()
+    first = api.request('GET', '/image/%s' % imageid)
+    etag = first.headers['ETag']
+    assert api.request('GET', '/image/%s' % imageid, headers={'If-None-Match': etag}).status_code == 304
+
+    listing = api.request('GET', '/image')
+    assert api.request('GET', '/image', headers={'If-None-Match': listing.headers['ETag']}).status_code == 304
+
+    assert api.upload(imageid, make_hex(b'firmware')).status_code == 200
+    assert api.request('GET', '/image/%s' % imageid, headers={'If-None-Match': etag}).status_code == 200
+    assert api.request('GET', '/image', headers={'If-None-Match': listing.headers['ETag']}).status_code == 200
+
+
+@pytest.fixture
+def local_time_behind_utc(monkeypatch):
+    monkeypatch.setenv('TZ', '<-03>3')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_last_modified_is_sent_in_utc(api, local_time_behind_utc):
+    imageid = api.create_image()
+    before = datetime.utcnow().replace(microsecond=0)
+    for url in ('/image/%s' % imageid, '/image'):
+        response = api.request('GET', url)
+        last_modified = parsedate_to_datetime(response.headers['Last-Modified']).replace(tzinfo=None)
+        assert abs((last_modified - before).total_seconds()) < 60
+        earlier = http_date(before - timedelta(hours=1))
+        assert api.request('GET', url, headers={'If-Modified-Since': earlier}).status_code == 200
+        later = http_date(before + timedelta(minutes=1))
+        assert api.request('GET', url, headers={'If-Modified-Since': later}).status_code == 304
@@ -0,0 +1,70 @@
+import json
+import os
+
+import pytest
+
+from ImageManager.DatabaseModels import Image
+from ImageManager.IntelHex import IntelHexError, IntelHexParser
+
+from conftest import make_hex, read_sample
+
+
+def parse(contents, chunk_size=7):
+    parser = IntelHexParser()
+    decoded = b''.join(parser.feed(contents[start:start + chunk_size])
+                       for start in range(0, len(contents), chunk_size))
+    return decoded, parser.close()
+
+
+def test_records_are_decoded_whatever_the_chunk_size():
+    data = os.urandom(0x10000 + 100)
+    for chunk_size in (1, 7, 4096):
+        decoded, segments = parse(make_hex(data), chunk_size)
+        assert decoded == data
+        # the extended linear address record starts a contiguous segment
+        assert segments == [{'address': 0, 'offset': 0, 'size': len(data)}]
+
+
+def test_sample_file_is_valid():
+    decoded, segments = parse(read_sample('example.hex'))
+    assert len(decoded) == sum(segment['size'] for segment in segments)
+
+
+def record(kind, address=0, payload=b'', checksum=None):
+    line = bytes([len(payload), address >> 8, address & 0xff, kind]) + payload
+    return b':%s%02X\n' % (line.hex().upper().encode(), -sum(line) & 0xff if checksum is None else checksum)
+
+
+END = record(1)
+
+
+@pytest.mark.parametrize('contents, message', [
+    (record(0, payload=b'A', checksum=0) + END, 'checksum mismatch'),
+    (record(0, payload=b'A')[1:] + END, 'missing start code'),
+    (b':01000000ZZBE\n' + END, 'invalid hexadecimal digits'),
+    (record(0, payload=b'A'), 'missing end of file record'),
+    (END + record(0, payload=b'A'), 'record after end of file'),
+    (record(0, payload=b'AB') + record(0, 1, b'C') + END, 'overlaps a previous record'),
+    (record(6, payload=b'A') + END, 'unknown record type 06'),
+    (record(4, payload=b'A') + END, 'invalid address record'),
+])
+def test_invalid_files_are_rejected(contents, message):
+    with pytest.raises(IntelHexError) as error:
+        parse(contents)
+    assert message in str(error.value)
+
+
+def test_corrupted_upload_is_rejected(api):
+    imageid = api.create_image()
+    response = api.upload(imageid, read_sample('corrupted_example.hex'))
+    assert response.status_code == 400
+    assert 'Invalid Intel HEX file' in json.loads(response.data.decode())['message']
+    assert not Image.query.get(imageid).confirmed
+
+
+def test_compact_binary_holds_the_decoded_data(api):
+    data = os.urandom(3000)
+    imageid = api.create_image()
+    assert api.upload(imageid, make_hex(data)).status_code == 200
+    response = api.request('GET', '/image/%s/binary?format=bin' % imageid, headers={'Accept-Encoding': 'identity'})
+    assert response.status_code == 200 and response.data == data
@@ -0,0 +1,16 @@
+import io
+import json
+import logging
+
+from ImageManager.conf import LOG_HANDLER
+
+
+def test_module_logs_go_through_one_json_handler(monkeypatch):
+    stream = io.StringIO()
+    monkeypatch.setattr(LOG_HANDLER, 'stream', stream)
+    logger = logging.getLogger('image-manager.ImageManager.TenancyMigration')
+    assert not logger.handlers
+    logger.warning("%d tenants migrated", 3)
+    record = json.loads(stream.getvalue())
+    assert record['message'] == "3 tenants migrated"
+    assert record['level'] == 'WARNING'
@@ -0,0 +1,31 @@
+from urllib3.response import HTTPResponse
+
+from ImageManager.Metrics import STORAGE_LATENCY, TimedMinio
+
+
+class FakeHttp(object):
+    """ Answers every request minio sends with an empty success """
+
+    def __init__(self):
+        self.requests = []
+
+    def urlopen(self, method, url, **kwargs):
+        self.requests.append((method, url))
+        return HTTPResponse(body=b'', status=200, preload_content=False)
+
+
+def sample_count(operation):
+    for metric in STORAGE_LATENCY.collect():
+        for sample in metric.samples:
+            if sample.name.endswith('_count') and sample.labels == {'operation': operation}:
+                return sample.value
+    return 0
+
+
+def test_bucket_creation_is_timed():
+    client = TimedMinio('localhost:9000', 'access', 'secret', secure=False)
+    client._http = FakeHttp()
+    count = sample_count('make_bucket')
+    client.make_bucket('tenant1')
+    assert client._http.requests[0][0] == 'PUT'
+    assert sample_count('make_bucket') == count + 1
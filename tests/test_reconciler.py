@@ -0,0 +1,37 @@
+import os
+import time
+import uuid
+
+from ImageManager.Reconciler import Reconciler
+
+
+def spool(directory, name, age):
+    path = os.path.join(str(directory), name)
+    with open(path, 'wb') as spooled:
+        spooled.write(b':00000001FF\n')
+    os.utime(path, (time.time() - age, time.time() - age))
+    return path
+
+
+def test_removes_binaries_spooled_by_previous_versions(tmp_path):
+    old = spool(tmp_path, str(uuid.uuid4()) + '.hex', 7200)
+    recent = spool(tmp_path, str(uuid.uuid4()) + '.hex', 10)
+    unrelated = spool(tmp_path, 'firmware.hex', 7200)
+
+    assert Reconciler(rate=0, grace=3600, dry_run=True).remove_spooled(str(tmp_path)) == 1
+    assert os.path.exists(old)
+
+    assert Reconciler(rate=0, grace=3600).remove_spooled(str(tmp_path)) == 1
+    assert not os.path.exists(old)
+    assert os.path.exists(recent)
+    assert os.path.exists(unrelated)
+
+
+def test_spool_removal_is_rate_limited(tmp_path, monkeypatch):
+    for _ in range(3):
+        spool(tmp_path, str(uuid.uuid4()) + '.hex', 7200)
+    reconciler = Reconciler(rate=1000, grace=3600)
+    waits = []
+    monkeypatch.setattr(reconciler.limiter, 'wait', lambda cost=1: waits.append(cost))
+    assert reconciler.remove_spooled(str(tmp_path)) == 3
+    assert waits == [1, 1, 1]
@@ -0,0 +1,112 @@
+import json
+import os
+
+import pytest
+
+from ImageManager import ResumableUpload
+from ImageManager.conf import CONFIG
+from ImageManager.DatabaseModels import Image, UploadSession, storage
+from ImageManager.StorageBackend import StorageError
+
+from conftest import make_hex
+
+CHUNK = 1024
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(ResumableUpload, 'MIN_PART_SIZE', CHUNK)
+
+
+def start(api, imageid):
+    response = api.request('POST', '/image/%s/binary/sessions' % imageid)
+    assert response.status_code == 201
+    return json.loads(response.data.decode())['url']
+
+
+def put(api, url, number, data):
+    return api.request('PUT', '%s/%d' % (url, number), data=data, content_type='application/octet-stream')
+
+
+def body(response):
+    return json.loads(response.data.decode())
+
+
+def test_interrupted_upload_is_resumed_and_committed(api):
+    imageid = api.create_image()
+    contents = make_hex(os.urandom(1200))
+    chunks = [contents[start:start + CHUNK] for start in range(0, len(contents), CHUNK)]
+    assert len(chunks) == 4
+    url = start(api, imageid)
+
+    # sent out of order, then interrupted
+    for number in (4, 1, 3):
+        assert put(api, url, number, chunks[number - 1]).status_code == 200
+    assert [chunk['number'] for chunk in body(api.request('GET', url))['chunks']] == [1, 3, 4]
+    response = api.request('POST', url + '/commit')
+    assert response.status_code == 400 and body(response)['missing'] == [2]
+
+    # the missing chunk is sent, and a chunk sent again replaces the previous one
+    assert put(api, url, 2, chunks[1]).status_code == 200
+    assert put(api, url, 1, chunks[0]).status_code == 200
+    response = api.request('POST', url + '/commit')
+    assert response.status_code == 200, response.data
+    assert Image.query.get(imageid).confirmed
+    assert UploadSession.query.count() == 0
+    response = api.request('GET', '/image/%s/binary' % imageid, headers={'Accept-Encoding': 'identity'})
+    assert response.data == contents
+
+
+def test_small_chunks_are_rejected_on_commit(api):
+    imageid = api.create_image()
+    url = start(api, imageid)
+    contents = make_hex(os.urandom(600))
+    put(api, url, 1, contents[:100])
+    put(api, url, 2, contents[100:])
+    response = api.request('POST', url + '/commit')
+    assert response.status_code == 400 and body(response)['chunks'] == [1]
+
+
+def test_invalid_file_ends_the_session(api):
+    imageid = api.create_image()
+    url = start(api, imageid)
+    put(api, url, 1, b'not an intel hex file\n')
+    assert api.request('POST', url + '/commit').status_code == 400
+    assert not Image.query.get(imageid).confirmed
+    assert UploadSession.query.count() == 0
+
+
+def test_oversized_chunk_and_given_up_session(api, monkeypatch):
+    monkeypatch.setattr(CONFIG, 'max_chunk_size', 10)
+    imageid = api.create_image()
+    url = start(api, imageid)
+    assert put(api, url, 1, b'x' * 11).status_code == 413
+    assert api.request('DELETE', url).status_code == 200
+    assert api.request('GET', url).status_code == 404
+
+
+def test_store_failures_are_reported(api, monkeypatch):
+    def fail(*args, **kwargs):
+        raise StorageError("store unavailable")
+
+    imageid = api.create_image()
+    contents = make_hex(os.urandom(100))
+    with monkeypatch.context() as store:
+        store.setattr(storage, 'start_multipart', fail)
+        response = api.request('POST', '/image/%s/binary/sessions' % imageid)
+        assert response.status_code == 400 and body(response)['message'] == "store unavailable"
+
+    url = start(api, imageid)
+    with monkeypatch.context() as store:
+        for operation in ('put_part', 'list_parts'):
+            store.setattr(storage, operation, fail)
+        for response in (put(api, url, 1, contents), api.request('GET', url), api.request('POST', url + '/commit')):
+            assert response.status_code == 400 and body(response)['message'] == "store unavailable"
+
+    # the session outlives the failed commit
+    assert put(api, url, 1, contents).status_code == 200
+    with monkeypatch.context() as store:
+        store.setattr(storage, 'complete_multipart', fail)
+        assert api.request('POST', url + '/commit').status_code == 400
+    assert api.request('POST', url + '/commit').status_code == 200
+    assert Image.query.get(imageid).confirmed
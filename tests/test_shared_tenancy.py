@@ -0,0 +1,43 @@
+import json
+import os
+
+from ImageManager.DatabaseModels import Binary, Image
+
+from conftest import make_hex
+
+
+def body(response):
+    return json.loads(response.data.decode())
+
+
+def test_tenants_only_see_their_images(api, other_api):
+    contents = make_hex(os.urandom(1024))
+    imageid = api.create_image(label='shared-label')
+    assert api.upload(imageid, contents).status_code == 200
+
+    assert body(other_api.request('GET', '/image')) == []
+    assert body(other_api.request('GET', '/image?label=shared-label')) == []
+    assert imageid.encode() not in other_api.request('GET', '/image/changes').data
+    for method, url in (('GET', '/image/%s'), ('GET', '/image/%s/binary'), ('DELETE', '/image/%s/binary'),
+                        ('DELETE', '/image/%s'), ('POST', '/image/%s/binary/sessions')):
+        assert other_api.request(method, url % imageid).status_code == 404, (method, url)
+    assert other_api.upload(imageid, contents).status_code == 404
+    response = other_api.request('DELETE', '/image/batch', data=json.dumps([imageid]), content_type='application/json')
+    assert [entry['status'] for entry in body(response)] == [404]
+
+    assert [image['id'] for image in body(api.request('GET', '/image'))] == [imageid]
+    assert Image.query.get(imageid).confirmed
+
+
+def test_identical_binaries_are_not_shared_across_tenants(api, other_api):
+    contents = make_hex(os.urandom(1024))
+    mine, theirs = api.create_image(), other_api.create_image()
+    assert api.upload(mine, contents).status_code == 200
+    assert other_api.upload(theirs, contents).status_code == 200
+    binaries = Binary.query.order_by(Binary.tenant).all()
+    assert [(binary.tenant, binary.refcount) for binary in binaries] == [('admin', 1), ('other', 1)]
+    assert binaries[0].blob != binaries[1].blob
+
+    assert api.request('DELETE', '/image/%s' % mine).status_code == 200
+    response = other_api.request('GET', '/image/%s/binary' % theirs, headers={'Accept-Encoding': 'identity'})
+    assert response.status_code == 200 and response.data == contents
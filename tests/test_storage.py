@@ -0,0 +1,22 @@
+import pytest
+
+from ImageManager.StorageBackend import FilesystemBackend, StorageBackend
+
+
+def test_backends_must_implement_every_operation():
+    class PartialBackend(StorageBackend):
+        def put(self, bucket, key, data, content_type='application/octet-stream', metadata=None):
+            return ''
+
+    with pytest.raises(TypeError):
+        PartialBackend()
+    with pytest.raises(TypeError):
+        StorageBackend()
+
+
+def test_filesystem_backend_round_trip(tmp_path):
+    storage = FilesystemBackend(str(tmp_path))
+    storage.make_bucket('images')
+    storage.put('images', 'admin/a.hex', b'contents')
+    assert storage.get('images', 'admin/a.hex') == b'contents'
+    assert [obj.object_name for obj in storage.list('images', 'admin/', recursive=True)] == ['admin/a.hex']
@@ -0,0 +1,26 @@
+import sqlalchemy
+
+from ImageManager import TenancyManager
+from ImageManager.DatabaseModels import db
+from ImageManager.TenancyManager import upgrade_tenants
+
+
+def index_names():
+    return set(index['name'] for index in sqlalchemy.inspect(db.engine).get_indexes('images'))
+
+
+def test_requests_do_not_upgrade_tenants(api, monkeypatch):
+    def upgrade_tenant(tenant, db):
+        raise AssertionError("schema upgraded on the request path")
+
+    monkeypatch.setattr(TenancyManager, 'upgrade_tenant', upgrade_tenant)
+    api.create_image()
+    TenancyManager.invalidate_tenant()
+    assert api.request('GET', '/image').status_code == 200
+
+
+def test_upgrade_restores_missing_indexes(client):
+    db.engine.execute('DROP INDEX ix_images_tenant_label')
+    assert 'ix_images_tenant_label' not in index_names()
+    upgrade_tenants(db)
+    assert 'ix_images_tenant_label' in index_names()
@@ -0,0 +1,64 @@
+import json
+import os
+
+from ImageManager import ImageManager, UploadManager
+from ImageManager.conf import CONFIG
+from ImageManager.DatabaseModels import Binary, Image, storage
+from ImageManager.StorageBackend import StorageError
+from ImageManager.StorageManager import object_location
+
+from conftest import make_hex
+
+
+def stored_objects():
+    return sorted(obj.object_name for obj in storage.list(*object_location('admin', '')))
+
+
+def test_upload_and_download(api):
+    imageid = api.create_image()
+    contents = make_hex(os.urandom(1000))
+    assert api.upload(imageid, contents).status_code == 200
+    assert Image.query.get(imageid).confirmed
+    response = api.request('GET', '/image/%s/binary' % imageid, headers={'Accept-Encoding': 'identity'})
+    assert response.status_code == 200 and response.data == contents
+    assert api.upload(imageid, contents).status_code == 400
+
+
+def test_store_failure_while_streaming_aborts_the_upload(api, monkeypatch):
+    # small parts, so that they are sent while the form is parsed
+    monkeypatch.setattr(UploadManager, 'MIN_PART_SIZE', 1024)
+    monkeypatch.setattr(CONFIG, 'upload_part_size', 1024)
+    aborted = []
+
+    def put_part(*args):
+        raise StorageError("store unavailable")
+
+    def abort_multipart(bucket, key, upload_id):
+        aborted.append(key)
+
+    monkeypatch.setattr(storage, 'put_part', put_part)
+    monkeypatch.setattr(storage, 'abort_multipart', abort_multipart)
+    monkeypatch.setattr(CONFIG, 'compression', 'none')
+
+    imageid = api.create_image()
+    response = api.upload(imageid, make_hex(os.urandom(4096)))
+    assert response.status_code == 400
+    assert json.loads(response.data.decode())['message'] == "store unavailable"
+    assert aborted and all(key.endswith('.hex') for key in aborted)
+    assert not Image.query.get(imageid).confirmed
+
+
+def test_concurrent_upload_of_the_same_binary_conflicts(api, monkeypatch):
+    contents = make_hex(os.urandom(1000))
+    first, second = api.create_image(fw_version='1'), api.create_image(fw_version='2')
+    assert api.upload(first, contents).status_code == 200
+    stored = stored_objects()
+
+    # the other upload committed its binary after this one looked it up
+    monkeypatch.setattr(ImageManager, 'acquire_binary', lambda sha256: None)
+    response = api.upload(second, contents)
+    assert response.status_code == 409, response.data
+    assert not Image.query.get(second).confirmed
+    assert Binary.query.one().refcount == 1
+    # the objects written by the losing upload are removed
+    assert stored_objects() == stored